@@ -0,0 +1,228 @@
+from __future__ import annotations
+import os
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from alert_models import AlertFilters
+from json_stream import json_default
+
+CACHE_MAX_ENTRIES = int(os.environ.get('ALERT_CACHE_MAX_ENTRIES', 256))
+CACHE_TTL_SECONDS = float(os.environ.get('ALERT_CACHE_TTL_SECONDS', 3600))
+
+# One row table holding a counter that every ingestion batch bumps. Cache
+# keys include it, so entries go stale exactly when new listing events land.
+# Sales use ingestion_state, rentals keep their own, see rental_alerts
+DATA_VERSION_TABLE = 'ingestion_state'
+
+
+def data_version_ddl(table: str) -> str:
+    return f"""
+CREATE TABLE IF NOT EXISTS {table} (
+    id int PRIMARY KEY DEFAULT 1 CHECK (id = 1),
+    data_version bigint NOT NULL DEFAULT 0,
+    updated_at timestamptz NOT NULL DEFAULT now()
+);
+INSERT INTO {table} (id) VALUES (1) ON CONFLICT DO NOTHING;
+"""
+
+
+def bump_data_version_sql(table: str) -> str:
+    return f"""
+INSERT INTO {table} (id, data_version, updated_at) VALUES (1, 1, now())
+ON CONFLICT (id) DO UPDATE
+SET data_version = {table}.data_version + 1, updated_at = now()
+RETURNING data_version
+"""
+
+
+def data_version_column(table: str) -> str:
+
+    # Selected alongside the filter lookups, see query_with_version
+    return f"(select data_version from {table} where id = 1)"
+
+
+DATA_VERSION_DDL = data_version_ddl(DATA_VERSION_TABLE)
+BUMP_DATA_VERSION_SQL = bump_data_version_sql(DATA_VERSION_TABLE)
+
+# Postgres' undefined_table, before ingestion has created the table
+UNDEFINED_TABLE = '42P01'
+
+
+def query_with_version(db, sql: str, params: dict, table: str = DATA_VERSION_TABLE) -> list[dict]:
+
+    """
+    Runs a lookup that selects data_version_column(table). Until ingestion
+    has created table, Postgres rejects the whole statement, so it is run
+    again with version 0 in its place, the same as a table with no row yet.
+    """
+
+    try:
+        return db.query(sql, params=params)
+    except Exception as e:
+        if getattr(e, 'pgcode', None) != UNDEFINED_TABLE:
+            raise
+        return db.query(sql.replace(data_version_column(table), '0'), params=params)
+
+
+def current_data_version(db, table: str = DATA_VERSION_TABLE) -> int:
+    rows = query_with_version(db, f"select {data_version_column(table)} as data_version", None, table)
+    return rows[0]['data_version'] or 0
+
+
+def bump_data_version(db, table: str = DATA_VERSION_TABLE) -> int:
+
+    """
+    Call once per ingestion batch, after its rows are committed.
+    """
+
+    return db.query(bump_data_version_sql(table))[0]['data_version']
+
+
+def filters_hash(filters: AlertFilters) -> str:
+
+    """
+    Stable hash of the filter values. List order doesn't change which
+    listings match, so lists are sorted first.
+    """
+
+    normalized = {
+        k: sorted(v, key=str) if isinstance(v, list) else v
+        for k, v in filters.__dict__.items()
+    }
+    raw = json.dumps(normalized, sort_keys=True, default=str)
+    return hashlib.sha1(raw.encode()).hexdigest()
+
+
+def cache_key(filters: AlertFilters, data_version: int, today: str, namespace: str = 'alerts', **paging) -> str:
+
+    """
+    today is part of the key because the 'new' flags depend on it.
+    namespace goes with the data version, 'rentals' for rental alerts.
+    """
+
+    paging = json.dumps(paging, sort_keys=True, default=str)
+    return f"{namespace}:{data_version}:{today}:{filters_hash(filters)}:{hashlib.sha1(paging.encode()).hexdigest()[:16]}"
+
+
+class LRUCache:
+
+    """
+    In-process LRU with a per-entry TTL. Lives at module level so it is
+    shared by warm invocations of the same worker.
+    """
+
+    def __init__(self, max_entries: int = CACHE_MAX_ENTRIES, ttl: float = CACHE_TTL_SECONDS):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: str, value, ttl: float = None):
+        expires = time.monotonic() + (ttl if ttl is not None else self.ttl)
+        with self._lock:
+            self._entries[key] = (expires, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self, prefix: str = None):
+        with self._lock:
+            if prefix is None:
+                self._entries.clear()
+                return
+            for key in [x for x in self._entries if x.startswith(prefix)]:
+                del self._entries[key]
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class RedisBackend:
+
+    """
+    Shared backend so workers can reuse each other's results. Takes any
+    client with redis-py's get/set(ex=) methods.
+    """
+
+    def __init__(self, client, ttl: float = CACHE_TTL_SECONDS):
+        self.client = client
+        self.ttl = ttl
+
+    @classmethod
+    def from_url(cls, url: str, ttl: float = CACHE_TTL_SECONDS):
+        import redis
+        return cls(redis.Redis.from_url(url), ttl=ttl)
+
+    def get(self, key: str):
+        raw = self.client.get(key)
+        return json.loads(raw) if raw is not None else None
+
+    def set(self, key: str, value, ttl: float = None):
+        self.client.set(key, json.dumps(value, default=json_default), ex=int(ttl if ttl is not None else self.ttl))
+
+
+class AlertResultCache:
+
+    """
+    Local LRU in front of an optional shared backend. Anything cached under
+    an older data version is dropped as soon as a newer one is seen. Each
+    cache_key namespace has its own data version.
+    """
+
+    def __init__(self, local: LRUCache = None, shared=None):
+        self.local = local if local is not None else LRUCache()
+        self.shared = shared
+        self.data_versions = {}
+        self.hits = 0
+        self.misses = 0
+
+    def observe_version(self, data_version: int, namespace: str = 'alerts'):
+
+        # Only a newer version makes the local entries stale. A lagging
+        # replica can report an older one, which must not throw them away
+        seen = self.data_versions.get(namespace)
+        if seen is not None and data_version <= seen:
+            return
+        if seen is not None:
+            self.local.clear(prefix=f'{namespace}:')
+        self.data_versions[namespace] = data_version
+
+    def get(self, key: str):
+        value = self.local.get(key)
+        if value is None and self.shared is not None:
+            value = self.shared.get(key)
+            if value is not None:
+                self.local.set(key, value)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def set(self, key: str, value):
+        self.local.set(key, value)
+        if self.shared is not None:
+            self.shared.set(key, value)
+
+
+def default_cache() -> AlertResultCache:
+    redis_url = os.environ.get('ALERT_CACHE_REDIS_URL')
+    shared = RedisBackend.from_url(redis_url) if redis_url else None
+    return AlertResultCache(shared=shared)
+
+
+RESULT_CACHE = default_cache()
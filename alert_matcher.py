@@ -0,0 +1,518 @@
+from __future__ import annotations
+import re
+import sys
+import time
+import random
+import datetime
+from bisect import bisect_left
+from collections import deque
+from query_compiler import filter_params
+from get_matching_listings import filters_from_row
+from new_today import market_date
+
+# Every alert gets a bit position, and each index below answers a lookup
+# with an int bitmask of the alerts that pass it. Masks from the different
+# indexes are ANDed together, so a listing costs one lookup per filter
+# rather than one check per alert.
+
+# Range filters on the event rows, as (column, min param, max param)
+EVENT_RANGES = [
+    ('price', 'min_price', 'max_price'),
+    ('sq_ft', 'min_sq_ft', 'max_sq_ft'),
+    ('beds', 'min_beds', 'max_beds'),
+    ('baths', 'min_baths', 'max_baths'),
+    ('year_built', 'min_year_built', 'max_year_built'),
+    ('price_per_sq_ft', 'min_price_per_sq_ft', 'max_price_per_sq_ft'),
+]
+
+# Range filters on the listing, current_days_on_market is worked out from
+# date_listed at match time like CURRENT_DATE - date_listed in SQL
+LISTING_RANGES = [
+    ('num_kitchens', 'num_kitchens', None),
+    ('current_days_on_market', 'min_days_on_market', 'max_days_on_market'),
+]
+
+ACTIVE_ALERTS_SQL = "SELECT * FROM report_recipients WHERE active IS TRUE"
+
+# ILIKE wildcards and the default escape character
+LIKE_SPECIAL = re.compile(r'[%_\\]')
+
+
+def iter_bits(mask: int):
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
+
+
+class RangeIndex:
+
+    """
+    Inclusive [min, max] intervals per alert, either end optional. The
+    distinct endpoints split the number line into slots (each endpoint and
+    the gaps between them) and every slot stores the mask of alerts whose
+    interval covers it, so a lookup is one bisect.
+    """
+
+    def __init__(self):
+        self.intervals = []
+
+        # Alerts without this filter. NULL values only pass these, the
+        # same as a NULL column failing >= / <= in SQL
+        self.unbounded = 0
+        self.points = []
+        self.masks = [0]
+
+    def add(self, bit: int, low=None, high=None):
+        if low is None and high is None:
+            self.unbounded |= 1 << bit
+        elif low is None or high is None or low <= high:
+            self.intervals.append((bit, low, high))
+
+    def _slot(self, value) -> int:
+        i = bisect_left(self.points, value)
+        if i < len(self.points) and self.points[i] == value:
+            return 2 * i + 1
+        return 2 * i
+
+    def build(self):
+        self.points = sorted({x for _, low, high in self.intervals for x in (low, high) if x is not None})
+        num_slots = 2 * len(self.points) + 1
+
+        # Sweep the slots, adding bits where intervals start and dropping
+        # them after they end
+        starts = [0] * (num_slots + 1)
+        ends = [0] * (num_slots + 1)
+        for bit, low, high in self.intervals:
+            starts[0 if low is None else self._slot(low)] |= 1 << bit
+            ends[num_slots - 1 if high is None else self._slot(high)] |= 1 << bit
+
+        self.masks = []
+        active = 0
+        for slot in range(num_slots):
+            active |= starts[slot]
+            self.masks.append(active | self.unbounded)
+            active &= ~ends[slot]
+
+    def lookup(self, value) -> int:
+        if value is None:
+            return self.unbounded
+        return self.masks[self._slot(value)]
+
+
+class SetIndex:
+
+    """
+    Alerts that list a value (city, zip code, property type), keyed by
+    value, plus the alerts that don't filter on it at all. An empty list,
+    e.g. counties with no known zips, matches nothing.
+    """
+
+    def __init__(self):
+        self.by_value = {}
+        self.unfiltered = 0
+
+    def add(self, bit: int, values=None):
+        if values is None:
+            self.unfiltered |= 1 << bit
+            return
+        for value in values:
+            self.by_value[value] = self.by_value.get(value, 0) | 1 << bit
+
+    def lookup(self, *values) -> int:
+        mask = self.unfiltered
+        for value in values:
+            mask |= self.by_value.get(value, 0)
+        return mask
+
+
+class KeywordAutomaton:
+
+    """
+    Aho-Corasick over every keyword term, so a description is scanned once
+    no matter how many alerts search it. find returns the indexes of the
+    terms that occur in the text.
+    """
+
+    def __init__(self, terms: list[str]):
+        self.goto = [{}]
+        self.fail = [0]
+        self.out = [set()]
+
+        for i, term in enumerate(terms):
+            state = 0
+            for char in term:
+                if char not in self.goto[state]:
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.out.append(set())
+                    self.goto[state][char] = len(self.goto) - 1
+                state = self.goto[state][char]
+            self.out[state].add(i)
+
+        # Breadth first, so a state's fail link is done before its children
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, child in self.goto[state].items():
+                queue.append(child)
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[child] = self.goto[fallback].get(char, 0)
+                self.out[child] |= self.out[self.fail[child]]
+
+    def find(self, text: str) -> set[int]:
+        found = set()
+        state = 0
+        goto, fail, out = self.goto, self.fail, self.out
+        for char in text:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if out[state]:
+                found |= out[state]
+        return found
+
+
+def like_regex(pattern: str) -> re.Pattern:
+
+    """
+    An ILIKE pattern as a regex, for the rare terms that contain %, _ or
+    a backslash and so can't go through the automaton.
+    """
+
+    parts = []
+    escaped = False
+    for char in pattern:
+        if escaped:
+            parts.append(re.escape(char))
+            escaped = False
+        elif char == '\\':
+            escaped = True
+        elif char == '%':
+            parts.append('.*')
+        elif char == '_':
+            parts.append('.')
+        else:
+            parts.append(re.escape(char))
+    return re.compile(''.join(parts), re.IGNORECASE | re.DOTALL)
+
+
+class KeywordIndex:
+
+    """
+    description ILIKE ANY (patterns) for every alert at once. lookup gives
+    the alerts with a pattern that matches, plus the unfiltered alerts.
+    """
+
+    def __init__(self):
+        self.term_bits = {}
+        self.pattern_bits = {}
+        self.regexes = []
+        self.unfiltered = 0
+        self.automaton = None
+        self.terms = []
+
+    def add(self, bit: int, patterns: list[str] | None):
+
+        # patterns is None when the alert doesn't filter on keywords. An
+        # empty list (keywords that were all blank) matches nothing, as
+        # ILIKE ANY ('{}') does
+        if patterns is None:
+            self.unfiltered |= 1 << bit
+            return
+        for pattern in patterns:
+            term = pattern[1:-1]
+            if LIKE_SPECIAL.search(term):
+                self.pattern_bits[pattern] = self.pattern_bits.get(pattern, 0) | 1 << bit
+            else:
+                self.term_bits[term] = self.term_bits.get(term, 0) | 1 << bit
+
+    def build(self):
+        self.terms = list(self.term_bits)
+        self.automaton = KeywordAutomaton(self.terms)
+        self.regexes = [(like_regex(x), bits) for x, bits in self.pattern_bits.items()]
+
+    def lookup(self, description: str | None, candidates: int = -1) -> int:
+
+        """
+        Regex patterns are only tried for alerts still in candidates.
+        """
+
+        mask = self.unfiltered
+        if description is None:
+            return mask
+        for i in self.automaton.find(description.lower()):
+            mask |= self.term_bits[self.terms[i]]
+        for regex, bits in self.regexes:
+            if bits & candidates & ~mask and regex.fullmatch(description):
+                mask |= bits
+        return mask
+
+
+def biggest_price_drop(events: list[dict]) -> float | None:
+
+    """
+    final_fields.biggest_price_drop for one listing's filtered events:
+    the latest event per price (DISTINCT ON), in date order, then the
+    largest absolute change between neighbours.
+    """
+
+    by_price = {}
+    for event in events:
+        kept = by_price.get(event['price'])
+        if kept is None or event['event_date'] > kept['event_date']:
+            by_price[event['price']] = event
+    prices = [x['price'] for x in sorted(by_price.values(), key=lambda x: x['event_date'])]
+    diffs = [abs(b - a) for a, b in zip(prices, prices[1:])]
+    return max(diffs) if diffs else None
+
+
+def _as_dict(obj) -> dict:
+
+    # ListingEvent/ListingMeta models or plain rows
+    return obj if isinstance(obj, dict) else obj.to_dict()
+
+
+class AlertMatcher:
+
+    """
+    Every active alert compiled into one in-memory index, for routing
+    newly ingested listings to the alerts they satisfy without running the
+    alert query once per alert. Follows the SQL path in ilike keyword mode.
+
+        matcher = AlertMatcher.load(db)
+        alert_ids = matcher.match(listing_meta, listing_events)
+    """
+
+    def __init__(self, report_recipients: list[dict]):
+        self.alert_ids = []
+        self.params = []
+        self.all_alerts = 0
+        self.price_reduction = 0
+
+        self.event_ranges = {column: RangeIndex() for column, _, _ in EVENT_RANGES}
+        self.listing_ranges = {column: RangeIndex() for column, _, _ in LISTING_RANGES}
+        self.geo = SetIndex()
+        self.property_types = SetIndex()
+        self.keywords = KeywordIndex()
+        self.exclude_keywords = KeywordIndex()
+
+        for row in report_recipients:
+            self._add(row)
+
+        for index in [*self.event_ranges.values(), *self.listing_ranges.values()]:
+            index.build()
+        self.keywords.build()
+        self.exclude_keywords.build()
+
+    @classmethod
+    def load(cls, db) -> AlertMatcher:
+        return cls(db.query(ACTIVE_ALERTS_SQL))
+
+    def _add(self, row: dict):
+        bit = len(self.alert_ids)
+        self.alert_ids.append(row['id'])
+        self.all_alerts |= 1 << bit
+
+        # The same set filters and values the SQL path binds
+        params = filter_params(filters_from_row(row), keyword_mode='ilike')
+        self.params.append(params)
+
+        for column, low, high in EVENT_RANGES:
+            self.event_ranges[column].add(bit, params.get(low), params.get(high))
+        for column, low, high in LISTING_RANGES:
+            self.listing_ranges[column].add(bit, params.get(low), params.get(high))
+
+        geo = None
+        if 'cities' in params or 'zip_codes' in params:
+            geo = [('city', x) for x in params.get('cities', [])] + [('zip', x) for x in params.get('zip_codes', [])]
+        self.geo.add(bit, geo)
+        self.property_types.add(bit, params.get('property_types'))
+        self.keywords.add(bit, params.get('keywords'))
+
+        # Alerts without exclude_keywords never get excluded
+        if 'exclude_keywords' in params:
+            self.exclude_keywords.add(bit, params['exclude_keywords'])
+
+        if 'price_reduction' in params:
+            self.price_reduction |= 1 << bit
+
+    def match(self, meta, events: list, today: datetime.date = None) -> list:
+
+        """
+        Ids of the alerts whose results the listing would show up in.
+        events should be the listing's whole price history, since
+        price_reduction looks at the changes between them.
+        """
+
+        meta = _as_dict(meta)
+        events = [_as_dict(x) for x in events]
+
+        # ListingMeta has no active flag, ingestion only sends live listings
+        if meta.get('active', True) is not True or not events:
+            return []
+
+        today = today or market_date()
+        date_listed = meta.get('date_listed')
+        current_days_on_market = None
+        if date_listed:
+            current_days_on_market = (today - datetime.date.fromisoformat(str(date_listed)[:10])).days
+
+        mask = self.all_alerts
+        mask &= self.listing_ranges['num_kitchens'].lookup(meta.get('num_kitchens'))
+        mask &= self.listing_ranges['current_days_on_market'].lookup(current_days_on_market)
+        mask &= self.geo.lookup(('city', meta.get('city')), ('zip', meta.get('zip_code')))
+        mask &= self.property_types.lookup(meta.get('property_type'))
+        if mask:
+            mask &= self.keywords.lookup(meta.get('description'), mask)
+        if mask:
+            mask &= ~self.exclude_keywords.lookup(meta.get('description'), mask)
+
+        # A listing shows up when any one of its events passes the ranges
+        matched = 0
+        event_masks = []
+        for event in events:
+            event_mask = mask
+            for column, index in self.event_ranges.items():
+                if not event_mask:
+                    break
+                event_mask &= index.lookup(event[column])
+            event_masks.append(event_mask)
+            matched |= event_mask
+
+        # price_reduction depends on which events each alert kept. Alerts
+        # that kept the same events share the drop
+        drops = {}
+        for bit in iter_bits(matched & self.price_reduction):
+            kept = tuple(i for i, x in enumerate(event_masks) if x >> bit & 1)
+            if kept not in drops:
+                drops[kept] = biggest_price_drop([events[i] for i in kept])
+            if drops[kept] is None or drops[kept] < self.params[bit]['price_reduction']:
+                matched &= ~(1 << bit)
+
+        return [self.alert_ids[bit] for bit in iter_bits(matched)]
+
+    def __repr__(self):
+        return f'AlertMatcher - {len(self.alert_ids)} alerts'
+
+
+def random_alert(rng: random.Random, alert_id: int) -> dict:
+
+    """
+    A report_recipients row with a random mix of filters, for the
+    randomized check below.
+    """
+
+    from synthetic_data import CITY_ZIPS, PROPERTY_TYPES, BENCH_OWNER_ID
+    from keyword_search import SYNONYMS
+
+    row = {'id': alert_id, 'owner_id': BENCH_OWNER_ID, 'recipient_email': 'bench@example.com', 'active': True}
+    ranges = {
+        'price': (100000, 1900000, 50000), 'sq_ft': (500, 5600, 100), 'beds': (0, 8, 1),
+        'baths': (0, 6, 1), 'year_built': (1890, 2026, 5), 'price_per_sq_ft': (20, 1500, 10),
+    }
+    for column, (low, high, step) in ranges.items():
+        if rng.random() < 0.3:
+            row[f'min_{column}'] = rng.randrange(low, high, step)
+        if rng.random() < 0.3:
+            row[f'max_{column}'] = rng.randrange(row.get(f'min_{column}', low) or low, high + step, step)
+    if rng.random() < 0.3:
+        row['cities'] = rng.sample(sorted({x for x, _ in CITY_ZIPS}), rng.randint(1, 3))
+    if rng.random() < 0.2:
+        row['zip_codes'] = rng.sample([x for _, x in CITY_ZIPS], rng.randint(1, 4))
+    if rng.random() < 0.2:
+        row['counties'] = rng.sample(['Salt Lake', 'Utah County', 'weber', 'Washington', 'Cache', 'Nowhere'], rng.randint(1, 2))
+    if rng.random() < 0.05:
+        row['entire_state'] = True
+    if rng.random() < 0.2:
+        row['property_types'] = rng.sample(PROPERTY_TYPES, rng.randint(1, 3))
+    words = ['pool', 'motivated', 'fixer upper', 'views', 'garage', 'tlc', 'open floor', 'yard', 'fixer_upper', 'sell%offers', ' , ']
+    if rng.random() < 0.3:
+        row['keywords'] = ', '.join(rng.sample(words, rng.randint(1, 3)))
+        row['enhance_keywords'] = rng.random() < 0.5 and any(x in SYNONYMS for x in row['keywords'].split(', '))
+    if rng.random() < 0.2:
+        row['exclude_keywords'] = ', '.join(rng.sample(words, rng.randint(1, 2)))
+    if rng.random() < 0.1:
+        row['num_kitchens'] = 2
+    if rng.random() < 0.2:
+        row['min_days_on_market'] = rng.randint(0, 90)
+    if rng.random() < 0.2:
+        row['max_days_on_market'] = rng.randint(row.get('min_days_on_market', 0), 200)
+    if rng.random() < 0.2:
+        row['price_reduction'] = rng.randrange(5000, 80000, 5000)
+    return row
+
+
+if __name__ == '__main__':
+
+    # python alert_matcher.py [num_alerts] [num_events] [seed]
+    # Random alerts against a synthetic dataset: every listing is routed
+    # through the matcher, and each alert's result set is compared with the
+    # SQL path as run by fake_db
+    # python alert_matcher.py [num_alerts] [num_events] [seed] --dsn scratch-db
+    # Same, but loads the dataset into Postgres and compares with the
+    # compiled listing query run there
+    import argparse
+    from synthetic_data import EVENT_COLUMNS, META_COLUMNS, generate_dataset, load_postgres
+    from fake_db import FakeDatabase
+    from query_compiler import compile_listings_query
+
+    parser = argparse.ArgumentParser(description='Check the alert matcher against the SQL path')
+    parser.add_argument('num_alerts', type=int, nargs='?', default=500)
+    parser.add_argument('num_events', type=int, nargs='?', default=20000)
+    parser.add_argument('seed', type=int, nargs='?', default=0)
+    parser.add_argument('--dsn')
+    args = parser.parse_args()
+    num_alerts = args.num_alerts
+
+    # Postgres counts days on market from its CURRENT_DATE, the market date
+    rng = random.Random(args.seed)
+    dataset = generate_dataset(args.num_events, seed=args.seed, today=market_date())
+    alerts = [random_alert(rng, i + 1) for i in range(num_alerts)]
+
+    start = time.perf_counter()
+    matcher = AlertMatcher(alerts)
+    print(f'{matcher} built in {(time.perf_counter() - start) * 1000:.1f}ms')
+
+    events_by_mls = {}
+    for row in dataset.events:
+        events_by_mls.setdefault(row[0], []).append(dict(zip(EVENT_COLUMNS, row)))
+
+    matched = {x['id']: set() for x in alerts}
+    start = time.perf_counter()
+    for row in dataset.meta:
+        meta = dict(zip(META_COLUMNS, row))
+        for alert_id in matcher.match(meta, events_by_mls[meta['mls_number']], today=dataset.today):
+            matched[alert_id].add(meta['mls_number'])
+    elapsed = time.perf_counter() - start
+    print(f'routed {len(dataset.meta)} listings in {elapsed * 1000:.1f}ms ({elapsed / len(dataset.meta) * 1e6:.1f}us per listing)')
+
+    if args.dsn:
+        from db_pool import ConnectionPool
+        pool = ConnectionPool(dsn=args.dsn)
+        with pool.connection() as db:
+            load_postgres(db, dataset)
+
+        def expected_listings(params: dict, query) -> set:
+            with pool.connection() as db:
+                return {x['mls_number'] for x in db.query(query.sql, params=params)}
+        source = 'Postgres'
+    else:
+        fake = FakeDatabase(dataset)
+
+        def expected_listings(params: dict, query) -> set:
+            return {x['mls_number'] for x in fake.listing_rows(params)}
+        source = 'fake_db'
+
+    mismatched = 0
+    for alert in alerts:
+        query, params = compile_listings_query(filters_from_row(alert), page_size=10 ** 9, keyword_mode='ilike')
+        expected = expected_listings(params, query)
+        if expected != matched[alert['id']]:
+            mismatched += 1
+            print(f"alert {alert['id']}: {len(expected - matched[alert['id']])} missing, "
+                  f"{len(matched[alert['id']] - expected)} extra")
+    print(f'{num_alerts - mismatched}/{num_alerts} alerts match the SQL path on {source}')
+    sys.exit(1 if mismatched else 0)
@@ -0,0 +1,124 @@
+from __future__ import annotations
+import base64
+import pydantic
+import json_stream
+import response_encoding
+from typing import Union
+from seller_motivation import SellerMotivationScore
+
+# Models the alerts Lambda uses, kept apart from umc_models so importing
+# them doesn't load the scraper and rental models
+
+
+class GoodApiResponse:
+
+    def __init__(
+            self,
+            status_code: int,
+            body: Union[dict, list, None],
+            empty_string_to_none: bool = False,
+            headers: dict = None,
+            accept_encoding: str = None,
+    ):
+        self.status_code = status_code
+        self.body = body
+        self.empty_string_to_none = empty_string_to_none
+        self.headers = headers or {}
+        self.accept_encoding = accept_encoding
+
+    def get_response(self) -> dict:
+
+        headers = {
+            'Access-Control-Allow-Headers': 'Content-Type,If-None-Match',
+            'Access-Control-Allow-Origin': '*',
+            'Access-Control-Allow-Methods': 'OPTIONS,POST,GET',
+            'Access-Control-Expose-Headers': 'ETag',
+            "content-type": "application/json",
+            **self.headers,
+        }
+
+        # A None body (e.g. 304 Not Modified) goes out empty
+        body = '' if self.body is None else json_stream.dumps(self.body, empty_string_to_none=self.empty_string_to_none)
+
+        # Without accept_encoding the body is never compressed
+        if self.accept_encoding is None:
+            return {'statusCode': self.status_code, 'headers': headers, 'body': body}
+
+        headers['Vary'] = 'Accept-Encoding'
+        encoding = None
+        if len(body) >= response_encoding.MIN_COMPRESS_BYTES:
+            encoding = response_encoding.choose_encoding(self.accept_encoding)
+        if encoding is None:
+            return {'statusCode': self.status_code, 'headers': headers, 'body': body}
+
+        # Compressed bytes go through API Gateway base64 encoded. The
+        # ETag turns weak, as the bytes differ per encoding
+        headers['Content-Encoding'] = encoding
+        if headers.get('ETag', '').startswith('"'):
+            headers['ETag'] = 'W/' + headers['ETag']
+        compressed = response_encoding.compress(body.encode(), encoding)
+        return {
+            'statusCode': self.status_code,
+            'headers': headers,
+            'body': base64.b64encode(compressed).decode(),
+            'isBase64Encoded': True,
+        }
+
+    def iter_body(self, chunk_size: int = json_stream.CHUNK_SIZE):
+
+        """
+        The JSON body in chunks, for streamed or compressed responses.
+        """
+
+        return json_stream.iter_json(
+            self.body,
+            empty_string_to_none=self.empty_string_to_none,
+            chunk_size=chunk_size,
+        )
+
+    def __repr__(self):
+        return f'UmcApiResponse'
+
+
+class AlertFilters(pydantic.BaseModel):
+    min_price: float = None
+    max_price: float = None
+    min_sq_ft: int = None
+    max_sq_ft: int = None
+    min_beds: int = None
+    max_beds: int = None
+    min_baths: int = None
+    max_baths: int = None
+    min_year_built: int = None
+    max_year_built: int = None
+    min_days_on_market: int = None
+    max_days_on_market: int = None
+    min_price_per_sq_ft: float = None
+    max_price_per_sq_ft: float = None
+    price_reduction: float = None
+    num_kitchens: int = None
+    cities: list = None
+    zip_codes: list = None
+    counties: list = None
+    entire_state: bool = None
+    property_types: list = None
+    seller_motivation_score: SellerMotivationScore = None
+    keywords: str = None
+    enhance_keywords: bool = None
+    exclude_keywords: Union[str, list] = None #comma separated string
+
+
+class RentalAlertFilters(pydantic.BaseModel):
+    min_price: float = None
+    max_price: float = None
+    min_beds: int = None
+    max_beds: int = None
+    min_baths: int = None
+    max_baths: int = None
+    min_sq_ft: int = None
+    max_sq_ft: int = None
+    pets_allowed: bool = None
+    available_by: str = None # %Y-%m-%d, available on or before
+    amenities: list = None # all of them, property or community
+    cities: list = None
+    zip_codes: list = None
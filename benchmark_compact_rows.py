@@ -0,0 +1,214 @@
+from __future__ import annotations
+import gc
+import copy
+import json
+import time
+import tracemalloc
+import json_stream
+import instrumentation
+import get_matching_listings
+from db_pool import ResultRows
+from alert_models import AlertFilters, GoodApiResponse
+from field_projection import FIELD_PROFILES, parse_fields
+from benchmark_nest_events import make_event_rows
+
+TODAY = get_matching_listings.current_day()
+
+# Handlers run without writing their request log lines
+instrumentation.EMIT = lambda line: None
+
+
+def to_rows(data: list[dict]) -> ResultRows:
+
+    # What return_rows gets from the cursor
+    names = list(data[0]) if data else []
+    return ResultRows(names, [tuple(row[x] for x in names) for row in data])
+
+
+def aggregate(rows: list[dict]) -> list[dict]:
+
+    """
+    nested_listings rows from final_fields rows, via nest_events.
+    """
+
+    listings = get_matching_listings.nest_events(copy.deepcopy(rows), min_days_on_market=30, today=TODAY)
+    for listing in listings:
+        listing['num_price_drops'] = len([x for x in listing['events'] if x['price_diff'] < 0])
+        del listing['seller_motivation_score']
+    return listings
+
+
+def encodings(results: list) -> tuple[str, ...]:
+
+    """
+    Every way a page gets encoded: the response body, streamed, with
+    empty strings nulled, and for the shared cache.
+    """
+
+    body = {'filter_id': 22, 'num_results': len(results), 'results': results}
+    return (
+        GoodApiResponse(status_code=200, body=body).get_response()['body'],
+        ''.join(json_stream.iter_json(body, chunk_size=4096)),
+        json_stream.dumps(body, empty_string_to_none=True),
+        json.dumps(body, default=json_stream.json_default),
+    )
+
+
+def check_parity(num_seeds: int = 10) -> int:
+
+    """
+    The records serialize to exactly the bytes the dicts do, across
+    query modes, paging, projections and comparables.
+    """
+
+    checked = 0
+    projections = [FIELD_PROFILES['full'], FIELD_PROFILES['card'], parse_fields('mls_number'), parse_fields('price,new,events')]
+    for seed in range(num_seeds):
+        rows = make_event_rows(2000, seed=seed)
+        rows.sort(key=lambda x: (x['mls_number'], x['event_date']), reverse=True)
+        rows[seed]['seller_motivation'] = None
+        rows[seed + 1]['description'] = ''
+        rows[seed + 2]['price_per_sq_ft'] = float('nan')
+
+        for aggregated, data in [(False, rows), (True, aggregate(rows))]:
+            for use_cursor, page_size in [(False, 500), (True, 500), (True, len(data) + 1)]:
+                for min_days in (None, 30):
+                    filters = AlertFilters(min_days_on_market=min_days)
+                    expected = get_matching_listings.build_results(copy.deepcopy(data), filters, page_size, use_cursor, aggregated, TODAY)
+                    actual = get_matching_listings.build_results(to_rows(data), filters, page_size, use_cursor, aggregated, TODAY)
+                    assert expected[1] == actual[1], (seed, aggregated, use_cursor, min_days)
+
+                    for projection in projections:
+                        projected = projection.apply(expected[0]), projection.apply(actual[0])
+                        assert encodings(projected[0]) == encodings(projected[1]), (seed, aggregated, use_cursor, projection)
+                        checked += 1
+
+                    # Comparables go on last, after the projection
+                    comparables = [{'zip_code': '84101', 'n': i} if i % 3 else None for i in range(len(expected[0]))]
+                    for listing, comparable in zip(expected[0], comparables):
+                        listing['comparables'] = comparable
+                    with_comparables = get_matching_listings.compact_rows.append_field(actual[0], 'comparables', comparables)
+                    assert encodings(expected[0]) == encodings(with_comparables)
+
+                    # new_mls in place of the per listing checks
+                    if not aggregated:
+                        new_mls = frozenset(x['mls_number'] for x in expected[0] if x['new'])
+                        indexed = get_matching_listings.build_results(to_rows(data), filters, page_size, use_cursor, aggregated, TODAY, new_mls)
+                        assert [x['mls_number'] for x in indexed[0]] == [x['mls_number'] for x in expected[0]]
+
+    empty = get_matching_listings.build_results(ResultRows([], []), AlertFilters(), 500, True, False, TODAY)
+    assert empty == ([], None)
+    return checked
+
+
+def check_handler(dsn: str = None) -> int:
+
+    """
+    Whole handler bodies on the in-memory fake, or on the scratch Postgres
+    at dsn, with and without ALERTS_COMPACT_ROWS, for every alert and a
+    few query variants.
+    """
+
+    from new_today import market_date
+    from synthetic_data import BENCH_OWNER_ID, generate_dataset
+    from alert_cache import RESULT_CACHE
+    from benchmark_pipeline import make_pool
+
+    # Postgres counts days on market from its CURRENT_DATE, the market date
+    dataset = generate_dataset(20000, seed=0, today=market_date())
+    pool = make_pool(dataset, dsn)
+
+    def body(alert_id: int, query: dict) -> str:
+        RESULT_CACHE.local.clear()
+        event = {
+            'queryStringParameters': {'user_id': BENCH_OWNER_ID, 'email': None, **query},
+            'pathParameters': {'alert_id': str(alert_id)},
+        }
+        res = get_matching_listings.handler(event)
+        assert res['statusCode'] == 200, res['body'][:200]
+        return res['body']
+
+    checked = 0
+    queries = [{}, {'fields': 'card'}, {'cursor': ''}, {'fields': 'price,events', 'page': '2'}]
+    for aggregated in (False, True):
+        get_matching_listings.AGGREGATE_IN_SQL = aggregated
+        for alert in dataset.report_recipients:
+            for query in queries:
+                get_matching_listings.COMPACT_ROWS = False
+                expected = body(alert['id'], query)
+                get_matching_listings.COMPACT_ROWS = True
+                assert body(alert['id'], query) == expected, (alert['id'], aggregated, query)
+                checked += 1
+    get_matching_listings.COMPACT_ROWS = get_matching_listings.AGGREGATE_IN_SQL = False
+    pool.close()
+    return checked
+
+
+def measure(build, fetched: ResultRows, projection) -> dict:
+
+    """
+    Retained bytes of one built page, what the result cache holds on to,
+    and peak bytes while building and serializing it. The fetched rows
+    are allocated before tracing, as both paths start from them.
+    """
+
+    # A full collection also empties the tuple and dict free lists, which
+    # would otherwise hand out memory tracemalloc never sees
+    gc.collect()
+    tracemalloc.start()
+    page = projection.apply(build(fetched))
+    retained, _ = tracemalloc.get_traced_memory()
+    GoodApiResponse(status_code=200, body={'results': page}).get_response()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del page
+
+    start = time.perf_counter()
+    for _ in range(5):
+        page = projection.apply(build(fetched))
+        GoodApiResponse(status_code=200, body={'results': page}).get_response()
+    return {'retained': retained, 'peak': peak, 'ms': (time.perf_counter() - start) / 5 * 1000}
+
+
+if __name__ == '__main__':
+
+    # python benchmark_compact_rows.py [--dsn scratch-db]
+    # With --dsn the handler bodies are checked on the synthetic dataset
+    # loaded into Postgres, so both paths start from the rows it returns
+    import argparse
+    parser = argparse.ArgumentParser(description='Check and measure compact_rows against row dicts')
+    parser.add_argument('--dsn', help='scratch Postgres to load the data into, instead of the in-memory fake')
+    args = parser.parse_args()
+
+    print(f'{check_parity()} page encodings match')
+    print(f"{check_handler(args.dsn)} handler bodies match on {'Postgres' if args.dsn else 'fake_db'}")
+
+    def dicts(aggregated: bool):
+
+        # Same as return_rows=False: a dict per fetched row
+        def build(fetched: ResultRows) -> list:
+            data = [dict(zip(fetched.names, row)) for row in fetched.rows]
+            return get_matching_listings.build_results(data, AlertFilters(), len(data) + 1, False, aggregated, TODAY)[0]
+        return build
+
+    def records(aggregated: bool):
+        def build(fetched: ResultRows) -> list:
+            return get_matching_listings.build_results(fetched, AlertFilters(), len(fetched) + 1, False, aggregated, TODAY)[0]
+        return build
+
+    print(f"{'mode':<11} {'fields':<6} {'listings':>8} {'dict KiB':>9} {'rec KiB':>8} {'dict peak':>10} {'rec peak':>9} {'dict ms':>8} {'rec ms':>7}")
+    for num_rows in (2500, 25000):
+        rows = make_event_rows(num_rows, seed=num_rows)
+        for aggregated, data in [(False, rows), (True, aggregate(rows))]:
+            fetched = to_rows(data)
+            for name in ('full', 'card'):
+                projection = FIELD_PROFILES[name]
+                a = measure(dicts(aggregated), fetched, projection)
+                b = measure(records(aggregated), fetched, projection)
+                num_listings = len(records(aggregated)(fetched))
+                print(
+                    f"{'aggregated' if aggregated else 'rows':<11} {name:<6} {num_listings:>8}"
+                    f" {a['retained'] / 1024:>9.0f} {b['retained'] / 1024:>8.0f}"
+                    f" {a['peak'] / 1024:>10.0f} {b['peak'] / 1024:>9.0f}"
+                    f" {a['ms']:>8.2f} {b['ms']:>7.2f}"
+                )
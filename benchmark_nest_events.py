@@ -0,0 +1,160 @@
+from __future__ import annotations
+import copy
+import json
+import random
+import datetime
+import time
+from get_matching_listings import nest_events, seller_motivation_score, current_day
+
+TODAY = current_day()
+
+
+def make_event_rows(num_rows: int, seed: int = 0, events_per_listing: int = 5) -> list[dict]:
+
+    """
+    Builds rows shaped like the final_fields CTE output, one row per
+    price event, so nest_events can be measured without a database.
+    """
+
+    rng = random.Random(seed)
+    today = datetime.datetime.strptime(TODAY, '%Y-%m-%d')
+    rows = []
+    listing_num = 0
+    while len(rows) < num_rows:
+
+        listing_num += 1
+        mls_number = str(1000000 + listing_num)
+        num_events = min(rng.randint(1, events_per_listing * 2 - 1), num_rows - len(rows))
+        days_on_market = rng.randint(0, 200)
+        price = float(rng.randrange(200000, 1500000, 5000))
+
+        # Events oldest to newest, the same order LEAD walks them in
+        dates = sorted(
+            today - datetime.timedelta(days=rng.randint(0, days_on_market), seconds=rng.randint(0, 86399))
+            for _ in range(num_events)
+        )
+        prices = [price]
+        for _ in range(num_events - 1):
+            prices.append(prices[-1] + rng.choice([-1, -1, -1, 1]) * rng.randrange(5000, 50000, 1000))
+
+        events = []
+        for i, (event_date, event_price) in enumerate(zip(dates, prices)):
+            new_price = prices[i + 1] if i + 1 < num_events else None
+            events.append({
+                'mls_number': mls_number,
+                'date_listed': (today - datetime.timedelta(days=days_on_market)).strftime('%Y-%m-%d'),
+                'price': event_price,
+                'event_date': event_date.strftime('%Y-%m-%d %H:%M:%S'),
+                'beds': rng.randint(1, 6),
+                'baths': rng.randint(1, 4),
+                'street_address': f'{rng.randint(100, 9999)} S {rng.randint(100, 9999)} E',
+                'city': rng.choice(['Salt Lake City', 'Provo', 'Ogden', 'Sandy', 'Lehi']),
+                'sq_ft': rng.randint(700, 5000),
+                'year_built': rng.randint(1900, 2024),
+                'price_per_sq_ft': round(event_price / rng.randint(700, 5000), 2),
+                'images': [f'https://images.example.com/{mls_number}/{n}.jpg' for n in range(rng.randint(5, 30))],
+                'property_type': rng.choice(['Single Family', 'Condo', 'Townhouse']),
+                'seller_motivation': rng.random() < 0.2,
+                'num_kitchens': rng.randint(1, 2),
+                'status': 'Active',
+                'days_on_market': days_on_market,
+                'description': 'Lovely home ' * rng.randint(10, 80),
+                'url': f'https://listings.example.com/{mls_number}',
+                'active': True,
+                'current_days_on_market': days_on_market,
+                'rn': num_events - i,
+                'new_price': new_price,
+                'price_diff': new_price - event_price if new_price is not None else None,
+            })
+
+        rows.extend(events)
+
+    # Postgres gives no ordering guarantee here, so shuffle like a real result set
+    rng.shuffle(rows)
+    return rows
+
+
+def legacy_nest_events(data: list[dict], min_days_on_market: int | None) -> list[dict]:
+
+    """
+    The original quadratic implementation, kept to check output parity.
+    """
+
+    base_meta = [x for x in data if x['rn'] == 1]
+    for listing in base_meta:
+
+        mls_num = listing['mls_number']
+
+        listing['events'] = []
+        extra_events = [
+            x for x in data
+            if x['mls_number'] == mls_num
+            and x['price_diff'] is not None
+            and x['price_diff'] != 0.0
+        ]
+
+        listing['new'] = False
+        all_dates = [y['event_date'][:10] for y in extra_events]
+        if TODAY in all_dates:
+            listing['new'] = True
+
+        if (
+            listing['current_days_on_market'] == 0
+            or listing['current_days_on_market'] == min_days_on_market
+        ):
+            listing['new'] = True
+
+        for event in extra_events:
+            event_obj = {
+                'mls_number': event['mls_number'],
+                'event_date': event['event_date'],
+                'new_price': event['new_price'],
+                'old_price': event['price'],
+                'price_diff': event['price_diff'],
+            }
+            listing['events'].append(event_obj)
+
+        listing['seller_motivation_score'] = seller_motivation_score(listing)
+        listing['events'] = sorted(listing['events'], key=lambda k: k['event_date'], reverse=True)
+
+    return base_meta
+
+
+def time_call(func, data: list[dict], repeat: int = 3) -> float:
+
+    """
+    Best-of-n wall time in seconds. Each run gets a fresh copy because
+    nest_events mutates the listing rows in place.
+    """
+
+    best = float('inf')
+    for _ in range(repeat):
+        rows = copy.deepcopy(data)
+        start = time.perf_counter()
+        func(rows, min_days_on_market=None)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+if __name__ == '__main__':
+
+    # Check the new engine gives the same output as the old one
+    sample = make_event_rows(5000, seed=1)
+    expected = json.dumps(legacy_nest_events(copy.deepcopy(sample), min_days_on_market=30))
+    actual = json.dumps(nest_events(copy.deepcopy(sample), min_days_on_market=30))
+    assert expected == actual, 'nest_events output differs from the legacy implementation'
+    print('output parity: ok')
+
+    # Per-row cost should stay flat as the number of event rows grows
+    print(f"{'rows':>8} {'seconds':>10} {'us/row':>8}")
+    for num_rows in [1000, 10000, 50000, 100000]:
+        data = make_event_rows(num_rows, seed=num_rows)
+        seconds = time_call(nest_events, data)
+        print(f"{num_rows:>8} {seconds:>10.4f} {seconds / num_rows * 1e6:>8.2f}")
+
+    # The legacy version only at small sizes, it is quadratic
+    print('legacy:')
+    for num_rows in [1000, 5000]:
+        data = make_event_rows(num_rows, seed=num_rows)
+        seconds = time_call(legacy_nest_events, data, repeat=1)
+        print(f"{num_rows:>8} {seconds:>10.4f} {seconds / num_rows * 1e6:>8.2f}")
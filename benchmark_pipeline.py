@@ -0,0 +1,264 @@
+from __future__ import annotations
+import os
+import sys
+import json
+import time
+import argparse
+import datetime
+import platform
+import subprocess
+import tracemalloc
+import get_matching_listings
+import get_alerts_dashboard
+import alert_cache
+import instrumentation
+from alert_cache import DATA_VERSION_DDL
+from db_pool import ConnectionPool
+from fake_db import FakeDatabase, FakeDriver
+from query_compiler import FILTER_LOOKUP_SQL, compile_listings_query
+from synthetic_data import ALERT_PROFILES, BENCH_OWNER_ID, generate_dataset, load_postgres
+from alert_models import GoodApiResponse
+
+STAGES = ['filter_lookup', 'sql_build', 'listing_query', 'nest_events', 'serialize', 'handler']
+DEFAULT_SIZES = [10000, 100000, 1000000]
+PAGE_SIZE = 500
+
+# Handlers run without writing their request log lines
+instrumentation.EMIT = lambda line: None
+
+
+def percentiles(samples: list[float]) -> dict:
+    ordered = sorted(samples)
+
+    def pick(q):
+        return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+    return {
+        'p50_ms': round(pick(0.50) * 1000, 3),
+        'p95_ms': round(pick(0.95) * 1000, 3),
+        'p99_ms': round(pick(0.99) * 1000, 3),
+        'mean_ms': round(sum(ordered) / len(ordered) * 1000, 3),
+    }
+
+
+def run_stages(pool: ConnectionPool, alert_id: int) -> tuple[dict, int, int]:
+
+    """
+    One request split into the handler's stages, each timed on its own.
+    Returns seconds per stage, payload bytes and number of results.
+    """
+
+    timings = {}
+    with pool.connection() as db:
+
+        start = time.perf_counter()
+        rows = db.query(FILTER_LOOKUP_SQL, params={'alert_id': alert_id, 'user_id': BENCH_OWNER_ID, 'email': None})
+        filters = get_matching_listings.filters_from_row(rows[0])
+        timings['filter_lookup'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        query, params = compile_listings_query(
+            filters,
+            page_size=PAGE_SIZE,
+            aggregate=get_matching_listings.AGGREGATE_IN_SQL,
+            today=get_matching_listings.current_day(),
+            source=get_matching_listings.QUERY_SOURCE,
+        )
+        timings['sql_build'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        data = db.query_compiled(
+            query,
+            params,
+            return_columns=get_matching_listings.use_columnar(),
+            return_rows=get_matching_listings.COMPACT_ROWS,
+        )
+        timings['listing_query'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    results, _ = get_matching_listings.build_results(data, filters, PAGE_SIZE, use_cursor=False)
+    timings['nest_events'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    body = GoodApiResponse(status_code=200, body={'num_results': len(results), 'results': results}).get_response()['body']
+    timings['serialize'] = time.perf_counter() - start
+
+    return timings, len(body.encode()), len(results)
+
+
+def run_handler(alert_id: int, query: dict = None, headers: dict = None) -> dict:
+    alert_cache.RESULT_CACHE.local.clear()
+    event = {
+        'queryStringParameters': {'user_id': BENCH_OWNER_ID, 'email': None, **(query or {})},
+        'pathParameters': {'alert_id': str(alert_id)},
+        'headers': headers or {},
+    }
+    res = get_matching_listings.handler(event)
+    if res['statusCode'] != 200:
+        raise RuntimeError(f"handler returned {res['statusCode']}: {res['body'][:200]}")
+    return res
+
+
+def run_dashboard() -> dict:
+    alert_cache.RESULT_CACHE.local.clear()
+    res = get_alerts_dashboard.handler({'queryStringParameters': {'user_id': BENCH_OWNER_ID}})
+    if res['statusCode'] != 200:
+        raise RuntimeError(f"dashboard returned {res['statusCode']}: {res['body'][:200]}")
+    return res
+
+
+def benchmark_dashboard(dataset, iterations: int) -> dict:
+
+    """
+    The dashboard against what the frontend does without it, one card
+    request per alert in sequence. Both start from an empty cache.
+    """
+
+    alert_ids = [x['id'] for x in dataset.report_recipients]
+    samples = {'separate_calls': [], 'dashboard': []}
+    for _ in range(iterations):
+        start = time.perf_counter()
+        separate_bytes = sum(len(run_handler(x, query={'fields': 'card'})['body']) for x in alert_ids)
+        samples['separate_calls'].append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        dashboard_bytes = len(run_dashboard()['body'])
+        samples['dashboard'].append(time.perf_counter() - start)
+
+    return {
+        'stages': {name: percentiles(x) for name, x in samples.items()},
+        'num_alerts': len(alert_ids),
+        'payload_bytes': {'separate_calls': separate_bytes, 'dashboard': dashboard_bytes},
+    }
+
+
+def make_pool(dataset, dsn: str = None) -> ConnectionPool:
+
+    """
+    Loads dataset into the scratch Postgres at dsn, or the in-memory
+    fake without one, and points the handler at it.
+    """
+
+    if dsn:
+        pool = ConnectionPool(dsn=dsn)
+        with pool.connection() as db:
+            load_postgres(db, dataset)
+            for statement in DATA_VERSION_DDL.split(';'):
+                if statement.strip():
+                    db.query(statement)
+    else:
+        pool = ConnectionPool(driver=FakeDriver(FakeDatabase(dataset)))
+
+    # The handlers read the module level pool
+    get_matching_listings.POOL = pool
+    get_alerts_dashboard.POOL = pool
+    return pool
+
+
+def benchmark_size(num_events: int, iterations: int, seed: int, dsn: str = None) -> dict:
+    dataset = generate_dataset(num_events, seed=seed)
+    pool = make_pool(dataset, dsn)
+
+    results = {}
+    for profile in ALERT_PROFILES:
+        alert_id = dataset.alert_id(profile)
+        samples = {stage: [] for stage in STAGES}
+        payload_bytes = num_results = 0
+
+        for _ in range(iterations):
+            timings, payload_bytes, num_results = run_stages(pool, alert_id)
+            for stage, seconds in timings.items():
+                samples[stage].append(seconds)
+
+            start = time.perf_counter()
+            run_handler(alert_id)
+            samples['handler'].append(time.perf_counter() - start)
+
+        # Peak Python memory for one full request
+        tracemalloc.start()
+        run_handler(alert_id)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        results[profile] = {
+            'stages': {stage: percentiles(x) for stage, x in samples.items()},
+            'peak_memory_bytes': peak,
+            'payload_bytes': payload_bytes,
+            'num_results': num_results,
+        }
+        print(
+            f"{num_events:>8} {profile:<12} handler p50 {results[profile]['stages']['handler']['p50_ms']:>9.2f}ms"
+            f"  peak {peak / 2**20:>7.2f}MiB  payload {payload_bytes / 2**20:>6.2f}MiB  results {num_results}"
+        )
+
+    dashboard = results['dashboard'] = benchmark_dashboard(dataset, iterations)
+    print(
+        f"{num_events:>8} dashboard    {dashboard['num_alerts']} separate calls p50 {dashboard['stages']['separate_calls']['p50_ms']:>9.2f}ms"
+        f" -> dashboard p50 {dashboard['stages']['dashboard']['p50_ms']:>9.2f}ms"
+        f"  payload {dashboard['payload_bytes']['separate_calls'] / 2**20:.2f} -> {dashboard['payload_bytes']['dashboard'] / 2**20:.2f}MiB"
+    )
+
+    return results
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def compare(old_path: str, new_path: str):
+
+    """
+    Prints p50 changes per stage between two result files.
+    """
+
+    old = json.load(open(old_path))
+    new = json.load(open(new_path))
+    print(f"{old['commit']} ({old['backend']}) -> {new['commit']} ({new['backend']})")
+    for size, profiles in new['results'].items():
+        for profile, result in profiles.items():
+            before = old['results'].get(size, {}).get(profile)
+            if not before:
+                continue
+            for stage, stats in result['stages'].items():
+                a, b = before['stages'][stage]['p50_ms'], stats['p50_ms']
+                change = (b - a) / a * 100 if a else 0.0
+                flag = '  <-- slower' if change > 10 else ''
+                print(f"{size:>8} {profile:<12} {stage:<14} {a:>9.2f} -> {b:>9.2f}ms {change:>+7.1f}%{flag}")
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmark the GetMatchingListings pipeline on synthetic data')
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES, help='number of listing events')
+    parser.add_argument('--iterations', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--dsn', help='scratch Postgres to load the data into, instead of the in-memory fake')
+    parser.add_argument('--out', help='where to save the JSON results')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='diff two saved result files')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        sys.exit(0)
+
+    commit = git_commit()
+    output = {
+        'commit': commit,
+        'created': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'backend': 'postgres' if args.dsn else 'fake',
+        'iterations': args.iterations,
+        'seed': args.seed,
+        'results': {},
+    }
+    for num_events in args.sizes:
+        output['results'][str(num_events)] = benchmark_size(num_events, args.iterations, args.seed, dsn=args.dsn)
+
+    out = args.out or os.path.join('bench_results', f'pipeline-{commit}.json')
+    os.makedirs(os.path.dirname(out) or '.', exist_ok=True)
+    with open(out, 'w') as f:
+        json.dump(output, f, indent=2)
+    print(f'saved {out}')
@@ -0,0 +1,178 @@
+from __future__ import annotations
+import os
+import json
+import time
+import random
+import argparse
+import datetime
+import platform
+import tracemalloc
+import alert_cache
+import instrumentation
+import rental_alerts
+import get_matching_rentals
+from db_pool import ConnectionPool
+from alert_models import GoodApiResponse
+from benchmark_pipeline import git_commit, percentiles
+from synthetic_data import RENTAL_ALERT_PROFILES, BENCH_OWNER_ID, generate_rental_dataset, load_rental_postgres
+
+STAGES = ['filter_lookup', 'sql_build', 'listing_query', 'serialize', 'handler']
+DEFAULT_SIZES = [10000, 100000, 1000000]
+PAGE_SIZE = 500
+SOURCES = ['events', 'state']
+
+# Handlers run without writing their request log lines
+instrumentation.EMIT = lambda line: None
+
+
+def run_stages(pool: ConnectionPool, alert_id: int, source: str, today: str) -> tuple[dict, int, list[dict]]:
+
+    """
+    One request split into the handler's stages, each timed on its own.
+    Returns seconds per stage, payload bytes and the results.
+    """
+
+    timings = {}
+    with pool.connection() as db:
+
+        start = time.perf_counter()
+        rows = db.query(rental_alerts.RENTAL_FILTER_LOOKUP_SQL, params={'alert_id': alert_id, 'user_id': BENCH_OWNER_ID, 'email': None})
+        filters = get_matching_rentals.rental_filters_from_row(rows[0])
+        timings['filter_lookup'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        query, params = rental_alerts.compile_rental_query(filters, today=today, page_size=PAGE_SIZE, source=source)
+        timings['sql_build'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        results = db.query_compiled(query, params)
+        timings['listing_query'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    body = GoodApiResponse(status_code=200, body={'num_results': len(results), 'results': results}).get_response()['body']
+    timings['serialize'] = time.perf_counter() - start
+
+    return timings, len(body.encode()), results
+
+
+def run_handler(alert_id: int, query: dict = None) -> dict:
+    alert_cache.RESULT_CACHE.local.clear()
+    event = {
+        'queryStringParameters': {'user_id': BENCH_OWNER_ID, 'email': None, **(query or {})},
+        'pathParameters': {'alert_id': str(alert_id)},
+    }
+
+    res = get_matching_rentals.handler(event)
+    if res['statusCode'] != 200:
+        raise RuntimeError(f"handler returned {res['statusCode']}: {res['body'][:200]}")
+    return res
+
+
+def walk_cursor(alert_id: int, page_size: int) -> list[dict]:
+
+    """
+    Every result, following next_cursor from the first page.
+    """
+
+    results, cursor = [], ''
+    while cursor is not None:
+        body = json.loads(run_handler(alert_id, query={'cursor': cursor})['body'])
+        results.extend(body['results'])
+        cursor = body['next_cursor']
+    return results
+
+
+def benchmark_size(num_events: int, iterations: int, seed: int, dsn: str) -> dict:
+    dataset = generate_rental_dataset(num_events, seed=seed)
+    today = dataset.today.strftime('%Y-%m-%d')
+    pool = ConnectionPool(dsn=dsn)
+    with pool.connection() as db:
+        load_rental_postgres(db, dataset)
+        start = time.perf_counter()
+        rental_alerts.rebuild(db)
+        rebuild_seconds = time.perf_counter() - start
+    get_matching_rentals.POOL = pool
+    get_matching_rentals.TODAY = today
+
+    results = {'rebuild_seconds': round(rebuild_seconds, 3), 'profiles': {}}
+    for profile in RENTAL_ALERT_PROFILES:
+        alert_id = dataset.alert_id(profile)
+        results['profiles'][profile] = {}
+        outputs = {}
+        for source in SOURCES:
+            get_matching_rentals.RENTAL_QUERY_SOURCE = source
+            samples = {stage: [] for stage in STAGES}
+            for _ in range(iterations):
+                timings, payload_bytes, outputs[source] = run_stages(pool, alert_id, source, today)
+                for stage, seconds in timings.items():
+                    samples[stage].append(seconds)
+
+                start = time.perf_counter()
+                run_handler(alert_id)
+                samples['handler'].append(time.perf_counter() - start)
+
+            tracemalloc.start()
+            run_handler(alert_id)
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+            results['profiles'][profile][source] = {
+                'stages': {stage: percentiles(x) for stage, x in samples.items()},
+                'peak_memory_bytes': peak,
+                'payload_bytes': payload_bytes,
+                'num_results': len(outputs[source]),
+            }
+
+        # The state table has to give exactly what the raw tables do
+        assert outputs['state'] == outputs['events'], f'{profile}: state and events results differ'
+
+        # Cursor pages add up to the same listings as one big offset page
+        expected = json.loads(run_handler(alert_id, query={'page': '1'})['body'])['results']
+        if len(expected) < PAGE_SIZE:
+            assert walk_cursor(alert_id, PAGE_SIZE) == expected, f'{profile}: cursor pages differ'
+
+        events, state = (results['profiles'][profile][x]['stages'] for x in SOURCES)
+        print(
+            f"{num_events:>8} {profile:<11} listing_query p50 {events['listing_query']['p50_ms']:>9.2f}ms -> {state['listing_query']['p50_ms']:>7.2f}ms"
+            f"  handler p50 {events['handler']['p50_ms']:>9.2f}ms -> {state['handler']['p50_ms']:>7.2f}ms"
+            f"  results {results['profiles'][profile]['state']['num_results']}"
+        )
+
+    # What ingestion pays instead: refreshing the listings a batch touched
+    listing_ids = random.Random(seed).sample([x[0] for x in dataset.meta], min(1000, len(dataset.meta)))
+    with pool.connection() as db:
+        start = time.perf_counter()
+        rental_alerts.apply_ingested_rentals(db, listing_ids)
+        results['refresh_1000_seconds'] = round(time.perf_counter() - start, 3)
+    print(f"{num_events:>8} rebuild {rebuild_seconds:.2f}s, refresh of 1000 listings {results['refresh_1000_seconds']:.3f}s")
+    return results
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmark GetMatchingRentals on synthetic rentals, state table vs raw tables')
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES, help='number of rental listing events')
+    parser.add_argument('--iterations', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--dsn', required=True, help='scratch Postgres to load the data into')
+    parser.add_argument('--out', help='where to save the JSON results')
+    args = parser.parse_args()
+
+    commit = git_commit()
+    output = {
+        'commit': commit,
+        'created': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'backend': 'postgres',
+        'iterations': args.iterations,
+        'seed': args.seed,
+        'results': {},
+    }
+    for num_events in args.sizes:
+        output['results'][str(num_events)] = benchmark_size(num_events, args.iterations, args.seed, args.dsn)
+
+    out = args.out or os.path.join('bench_results', f'rentals-{commit}.json')
+    os.makedirs(os.path.dirname(out) or '.', exist_ok=True)
+    with open(out, 'w') as f:
+        json.dump(output, f, indent=2)
+    print(f'saved {out}')
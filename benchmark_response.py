@@ -0,0 +1,101 @@
+from __future__ import annotations
+import json
+import time
+import base64
+import argparse
+import get_matching_listings
+import instrumentation
+import listing_state
+from benchmark_pipeline import make_pool, percentiles, run_handler
+from synthetic_data import ALERT_PROFILES, generate_dataset
+from response_encoding import brotli_module
+
+# Handlers run without writing their request log lines
+instrumentation.EMIT = lambda line: None
+
+# (fields, Accept-Encoding) per variant, the first is the baseline
+VARIANTS = [
+    ('full', ''),
+    ('full', 'gzip'),
+    ('full', 'br'),
+    ('card', ''),
+    ('card', 'gzip'),
+    ('card', 'br'),
+]
+
+
+def measure(alert_id: int, fields: str, encoding: str, iterations: int) -> dict:
+
+    """
+    Handler time on a result cache miss, and the response size both as the
+    Lambda returns it (base64 when compressed) and as the client gets it.
+    """
+
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        res = run_handler(alert_id, query={'fields': fields}, headers={'Accept-Encoding': encoding})
+        samples.append(time.perf_counter() - start)
+
+    body = res['body']
+    wire = len(base64.b64decode(body)) if res.get('isBase64Encoded') else len(body.encode())
+    return {
+        'handler': percentiles(samples),
+        'lambda_bytes': len(body),
+        'wire_bytes': wire,
+        'content_encoding': res['headers'].get('Content-Encoding'),
+    }
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Response size and handler time per field profile and encoding')
+    parser.add_argument('--events', type=int, default=100000, help='number of listing events')
+    parser.add_argument('--iterations', type=int, default=7)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--dsn', help='scratch Postgres to load the data into, instead of the in-memory fake')
+    parser.add_argument('--mode', choices=['rows', 'aggregated', 'state'], default='aggregated',
+                        help='listing query mode; aggregated and state pages hold 500 listings')
+    parser.add_argument('--out', help='where to save the JSON results')
+    args = parser.parse_args()
+
+    if args.mode == 'state' and not args.dsn:
+        parser.error('--mode state needs --dsn')
+    if not brotli_module():
+        print('brotli is not installed, br requests fall back to gzip')
+
+    dataset = generate_dataset(args.events, seed=args.seed)
+    pool = make_pool(dataset, args.dsn)
+    get_matching_listings.AGGREGATE_IN_SQL = args.mode == 'aggregated'
+    get_matching_listings.QUERY_SOURCE = 'state' if args.mode == 'state' else 'events'
+    if args.mode == 'state':
+        with pool.connection() as db:
+            listing_state.create_table(db)
+            listing_state.rebuild(db)
+
+    results = {}
+    for profile in ALERT_PROFILES:
+        alert_id = dataset.alert_id(profile)
+
+        # Warm the pool and the prepared statements first
+        for fields, encoding in VARIANTS:
+            measure(alert_id, fields, encoding, 1)
+
+        results[profile] = {}
+        for fields, encoding in VARIANTS:
+            result = measure(alert_id, fields, encoding, args.iterations)
+            results[profile][f"{fields}/{encoding or 'identity'}"] = result
+
+        base = results[profile]['full/identity']
+        for name, result in results[profile].items():
+            print(
+                f"{profile:<12} {name:<15} handler p50 {result['handler']['p50_ms']:>8.2f}ms"
+                f" ({(result['handler']['p50_ms'] / base['handler']['p50_ms'] - 1) * 100:>+6.1f}%)"
+                f"  wire {result['wire_bytes'] / 1024:>8.1f}KiB ({result['wire_bytes'] / base['wire_bytes']:>6.1%})"
+                f"  lambda {result['lambda_bytes'] / 1024:>8.1f}KiB"
+            )
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump({'mode': args.mode, 'backend': 'postgres' if args.dsn else 'fake', 'events': args.events, 'results': results}, f, indent=2)
+        print(f'saved {args.out}')
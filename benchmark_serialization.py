@@ -0,0 +1,65 @@
+from __future__ import annotations
+import json
+import time
+import tracemalloc
+import json_stream
+from umc_models import ResponseEncoder
+from get_matching_listings import nest_events
+from benchmark_nest_events import make_event_rows
+
+
+def make_body(num_listings: int = 500, nan_fraction: float = 0.0, seed: int = 0) -> dict:
+
+    """
+    A response body shaped like the handler's, with num_listings results.
+    nan_fraction of the listings get a NaN price_per_sq_ft.
+    """
+
+    rows = make_event_rows(num_listings * 5, seed=seed)
+    results = nest_events(rows, min_days_on_market=None)[:num_listings]
+    for i, listing in enumerate(results):
+        if nan_fraction and i % round(1 / nan_fraction) == 0:
+            listing['price_per_sq_ft'] = float('nan')
+    return {'filter_id': 22, 'num_results': len(results), 'results': results}
+
+
+def measure(func, body: dict, repeat: int = 5) -> tuple[float, int, int]:
+
+    """
+    Best-of-n seconds, peak traced memory in bytes, and output size.
+    """
+
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        out = func(body)
+        best = min(best, time.perf_counter() - start)
+
+    tracemalloc.start()
+    out = func(body)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return best, peak, out if isinstance(out, int) else len(out)
+
+
+def legacy(body: dict) -> str:
+    return json.dumps(body, cls=ResponseEncoder)
+
+
+def streamed(body: dict) -> int:
+
+    # Consume chunks as a streaming response would, without joining them
+    return sum(len(chunk) for chunk in json_stream.iter_json(body))
+
+
+if __name__ == '__main__':
+
+    print(f"{'payload':<14} {'serializer':<12} {'ms':>8} {'peak MiB':>9} {'MiB out':>8}")
+    for label, nan_fraction in [('no NaN', 0.0), ('5% NaN', 0.05)]:
+        body = make_body(nan_fraction=nan_fraction)
+        assert legacy(body) == json_stream.dumps(body), 'output differs from ResponseEncoder'
+        assert legacy(body) == ''.join(json_stream.iter_json(body)), 'streamed output differs'
+
+        for name, func in [('legacy', legacy), ('dumps', json_stream.dumps), ('iter_json', streamed)]:
+            seconds, peak, size = measure(func, body)
+            print(f"{label:<14} {name:<12} {seconds * 1000:>8.1f} {peak / 2**20:>9.2f} {size / 2**20:>8.2f}")
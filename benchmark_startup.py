@@ -0,0 +1,85 @@
+from __future__ import annotations
+import sys
+import json
+import time
+import argparse
+import statistics
+import subprocess
+
+# Lambda entry points, plus umc_models for comparison
+HANDLERS = {
+    'alerts': 'get_matching_listings',
+    'rentals': 'get_matching_rentals',
+    'dashboard': 'get_alerts_dashboard',
+    'umc_models': 'umc_models',
+}
+
+# Runs in a fresh interpreter so nothing is already imported
+MEASURE = """
+import sys, time, json, importlib
+
+def rss_kb():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except OSError:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return 0
+
+before = rss_kb()
+start = time.perf_counter()
+importlib.import_module(sys.argv[1])
+import_ms = (time.perf_counter() - start) * 1000
+print(json.dumps({
+    'import_ms': import_ms,
+    'rss_mb': rss_kb() / 1024,
+    'rss_delta_mb': (rss_kb() - before) / 1024,
+    'heavy_modules': sorted(x for x in ('pandas', 'numpy', 'dateutil', 'psycopg2', 'redis') if x in sys.modules),
+}))
+"""
+
+
+def measure(module: str, runs: int) -> dict:
+
+    """
+    Imports module in runs fresh interpreters. process_ms is the whole
+    interpreter start plus import, closest to what a cold start pays.
+    """
+
+    samples = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        out = subprocess.check_output([sys.executable, '-c', MEASURE, module], text=True)
+        sample = json.loads(out)
+        sample['process_ms'] = (time.perf_counter() - start) * 1000
+        samples.append(sample)
+
+    return {
+        'module': module,
+        'import_ms': round(statistics.median(x['import_ms'] for x in samples), 1),
+        'process_ms': round(statistics.median(x['process_ms'] for x in samples), 1),
+        'rss_mb': round(statistics.median(x['rss_mb'] for x in samples), 1),
+        'rss_delta_mb': round(statistics.median(x['rss_delta_mb'] for x in samples), 1),
+        'heavy_modules': samples[0]['heavy_modules'],
+    }
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Import time and RSS for each Lambda handler')
+    parser.add_argument('--runs', type=int, default=7)
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    args = parser.parse_args()
+
+    results = {name: measure(module, args.runs) for name, module in HANDLERS.items()}
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        for name, x in results.items():
+            print(
+                f"{name:<12} import {x['import_ms']:>7.1f}ms  process {x['process_ms']:>7.1f}ms  "
+                f"rss {x['rss_mb']:>6.1f}MB (+{x['rss_delta_mb']:.1f})  heavy: {', '.join(x['heavy_modules']) or '-'}"
+            )
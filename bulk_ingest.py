@@ -0,0 +1,575 @@
+from __future__ import annotations
+import io
+import os
+import csv
+import sys
+import json
+import time
+import argparse
+import pydantic
+import delta_feed
+import listing_state
+import new_today
+from alert_cache import DATA_VERSION_DDL
+from umc_models import ListingEvent, ListingMeta, empty_string_to_none
+
+# Scraped records committed per transaction. Bigger batches amortize the
+# round trips, smaller ones lose less work on a crash
+BATCH_SIZE = int(os.environ.get('INGEST_BATCH_SIZE', 5000))
+
+# Rejected records kept for the report, the count is always exact
+MAX_REPORTED_ERRORS = 100
+
+EVENT_FIELDS = list(ListingEvent.__fields__)
+META_FIELDS = list(ListingMeta.__fields__)
+
+# How far each input has been committed. Written in the same transaction
+# as the batch, so a resumed load neither skips nor repeats a batch
+CHECKPOINT_DDL = """
+CREATE TABLE IF NOT EXISTS ingestion_checkpoints (
+    source text PRIMARY KEY,
+    position bigint NOT NULL,
+    records bigint NOT NULL DEFAULT 0,
+    updated_at timestamptz NOT NULL DEFAULT now()
+);
+"""
+
+CHECKPOINT_SQL = "SELECT position, records FROM ingestion_checkpoints WHERE source = %(source)s"
+
+SAVE_CHECKPOINT_SQL = """
+INSERT INTO ingestion_checkpoints (source, position, records, updated_at)
+VALUES (%(source)s, %(position)s, %(records)s, now())
+ON CONFLICT (source) DO UPDATE SET
+    position = EXCLUDED.position,
+    records = EXCLUDED.records,
+    updated_at = now()
+"""
+
+# Per connection staging tables the batch is COPYed into. seq is the
+# record's place in the batch, so later scrapes of a listing win
+STAGING_DDL = f"""
+CREATE TEMP TABLE IF NOT EXISTS ingest_events (seq int, LIKE listing_events) ON COMMIT DELETE ROWS;
+CREATE TEMP TABLE IF NOT EXISTS ingest_meta (seq int, {', '.join(f'{x} text' for x in META_FIELDS)}) ON COMMIT DELETE ROWS;
+"""
+
+# Loaders would race on the NOT EXISTS checks, so one batch at a time
+LOCK_SQL = "SELECT pg_advisory_xact_lock(hashtext('listing_events'))"
+
+# Events already stored under the same (mls_number, price, event_date), or
+# repeated within the batch, are skipped
+INSERT_EVENTS_SQL = f"""
+WITH inserted AS (
+    INSERT INTO listing_events ({', '.join(EVENT_FIELDS)})
+    SELECT DISTINCT ON (s.mls_number, s.price, s.event_date) {', '.join(f's.{x}' for x in EVENT_FIELDS)}
+    FROM ingest_events s
+    WHERE NOT EXISTS (
+        SELECT 1 FROM listing_events le
+        WHERE le.mls_number = s.mls_number
+        AND le.event_date = s.event_date
+        AND le.price = s.price
+    )
+    ORDER BY s.mls_number, s.price, s.event_date, s.seq
+    RETURNING mls_number
+)
+SELECT mls_number, count(*) AS num_events FROM inserted GROUP BY mls_number
+"""
+
+# images is staged as JSON text. listing_meta may hold it as jsonb, json or
+# a text array, so it is converted to whichever the column is
+IMAGES_TYPE_SQL = """
+SELECT format_type(atttypid, atttypmod) AS type FROM pg_attribute
+WHERE attrelid = 'listing_meta'::regclass AND attname = 'images'
+"""
+
+
+def images_value(column_type: str) -> str:
+    if column_type.endswith('[]'):
+        return f"CASE WHEN s.images IS NOT NULL THEN ARRAY(SELECT jsonb_array_elements_text(s.images::jsonb))::{column_type} END"
+    return f"s.images::{column_type}"
+
+
+def compared(table: str, column: str) -> str:
+
+    # json has no equality operator, so images is compared as jsonb
+    return f'to_jsonb({table}.{column})' if column == 'images' else f'{table}.{column}'
+
+
+def upsert_meta_sql(images_type: str = 'jsonb') -> str:
+
+    """
+    Scrapes repeat the meta of listings that haven't changed, those rows
+    are left alone so they don't count as changes. New listings are
+    active, the scraper only sees listings that are on the market.
+    """
+
+    values = ', '.join(
+        images_value(images_type) if x == 'images' else f's.{x}::date' if x == 'date_listed'
+        else f's.{x}::int' if x == 'num_kitchens' else f's.{x}'
+        for x in META_FIELDS
+    )
+    return f"""
+WITH upserted AS (
+    INSERT INTO listing_meta ({', '.join(META_FIELDS)}, active)
+    SELECT DISTINCT ON (s.mls_number) {values}, TRUE
+    FROM ingest_meta s
+    ORDER BY s.mls_number, s.seq DESC
+    ON CONFLICT (mls_number) DO UPDATE SET
+        {', '.join(f'{x} = EXCLUDED.{x}' for x in META_FIELDS[1:])}
+    WHERE ({', '.join(compared('listing_meta', x) for x in META_FIELDS[1:])})
+    IS DISTINCT FROM ({', '.join(compared('EXCLUDED', x) for x in META_FIELDS[1:])})
+    RETURNING mls_number
+)
+SELECT mls_number FROM upserted
+"""
+
+STATE_TABLE_SQL = "SELECT to_regclass('listing_current_state') IS NOT NULL AS exists"
+
+_MISSING = object()
+
+
+def _to_str(value):
+    return value if type(value) is str else _MISSING
+
+
+def _to_int(value):
+    if type(value) is int:
+        return value
+    if type(value) is str:
+        try:
+            return int(value)
+        except ValueError:
+            pass
+    return _MISSING
+
+
+def _to_float(value):
+    if type(value) is float or type(value) is int:
+        return float(value)
+    if type(value) is str:
+        try:
+            return float(value)
+        except ValueError:
+            pass
+    return _MISSING
+
+
+def _to_list(value):
+    return value if type(value) is list else _MISSING
+
+
+# Conversions that give the same value pydantic would, for the input types
+# scrapers actually produce. Anything else goes through the model
+FAST_CONVERTERS = {str: _to_str, int: _to_int, float: _to_float, list: _to_list}
+
+
+def validate_batch(model, records: list[dict]) -> tuple[list[tuple | None], list[tuple[int, str]]]:
+
+    """
+    Validates records against a pydantic model a column at a time, without
+    building a model instance per record. Returns one tuple of field values
+    per record (None where it was rejected) and the rejects as (index,
+    error). Records the fast conversions can't vouch for are validated by
+    the model itself, so the result is always what model(**record) gives.
+    """
+
+    columns = []
+    suspect = set()
+    for field in model.__fields__.values():
+        convert = FAST_CONVERTERS.get(field.outer_type_)
+        column = []
+        for i, record in enumerate(records):
+            value = record.get(field.name, _MISSING)
+            if value is _MISSING or value is None:
+                if field.required or (value is None and not field.allow_none):
+                    suspect.add(i)
+                column.append(None if value is None else field.default)
+                continue
+            value = convert(value) if convert is not None else _MISSING
+            if value is _MISSING:
+                suspect.add(i)
+            column.append(value)
+        columns.append(column)
+
+    rows = list(zip(*columns)) if columns else [() for _ in records]
+    rejected = []
+    for i in sorted(suspect):
+        try:
+            instance = model(**records[i])
+        except pydantic.ValidationError as e:
+            rows[i] = None
+            rejected.append((i, ' '.join(str(e).split())))
+            continue
+        rows[i] = tuple(getattr(instance, x) for x in model.__fields__)
+    return rows, rejected
+
+
+def read_lines(path: str, start: int = 0):
+
+    """
+    Non-empty lines of a JSON lines file from byte offset start, each with
+    the offset just past it.
+    """
+
+    with open(path, 'rb') as f:
+        f.seek(start)
+        offset = start
+        for line in f:
+            offset += len(line)
+            if line.strip():
+                yield offset, line
+
+
+def copy_rows(db, table: str, columns: list[str], rows: list[tuple]):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow(
+            json.dumps(x) if isinstance(x, list) else ('' if x is None else x)
+            for x in row
+        )
+    buffer.seek(0)
+    cur = db.conn.raw.cursor()
+    try:
+        cur.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)", buffer)
+    finally:
+        cur.close()
+
+
+class BulkLoader:
+
+    """
+    Streams scraped listings from a JSON lines file into listing_events and
+    listing_meta.
+
+    Each line is one scrape: the ListingEvent fields, plus the ListingMeta
+    fields when it has a url. Records are validated a batch at a time, COPYed
+    into staging tables and inserted with one statement per table, skipping
+    events that are already stored. Each batch commits together with the
+    listing_current_state and listing_new_days refreshes (where those
+    tables exist), the data version bump and change log from
+    delta_feed.publish_changes, and the input offset it reached. Running
+    again on the same source resumes after the last committed batch.
+    """
+
+    def __init__(self, pool, batch_size: int = BATCH_SIZE):
+        self.pool = pool
+        self.batch_size = batch_size
+        self.errors = []
+        self.stats = {}
+        self.has_new_days = False
+        self.upsert_meta_sql = upsert_meta_sql()
+
+    def setup(self, db):
+        for statement in (CHECKPOINT_DDL + DATA_VERSION_DDL + delta_feed.LISTING_CHANGES_DDL + STAGING_DDL).split(';'):
+            if statement.strip():
+                db.query(statement)
+        self.upsert_meta_sql = upsert_meta_sql(db.query(IMAGES_TYPE_SQL)[0]['type'])
+
+    def checkpoint(self, db, source: str) -> tuple[int, int]:
+        rows = db.query(CHECKPOINT_SQL, params={'source': source})
+        return (rows[0]['position'], rows[0]['records']) if rows else (0, 0)
+
+    def _parse(self, lines: list[tuple[int, bytes]]) -> tuple[list[int], list[dict]]:
+        offsets, records = [], []
+        for offset, line in lines:
+            try:
+                record = json.loads(line)
+            except ValueError as e:
+                record = e
+            if not isinstance(record, dict):
+                self._reject(offset, f'not a JSON object: {line[:80]!r}')
+                continue
+
+            # Scrapers leave blanks as empty strings
+            offsets.append(offset)
+            records.append(empty_string_to_none(record))
+        return offsets, records
+
+    def _reject(self, offset: int, error: str):
+        self.stats['rejected'] += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append((offset, error))
+
+    def _load_batch(self, db, source: str, lines: list[tuple[int, bytes]], has_state: bool):
+        offsets, records = self._parse(lines)
+        events, event_rejects = validate_batch(ListingEvent, records)
+        meta_index = [i for i, x in enumerate(records) if 'url' in x]
+        metas, meta_rejects = validate_batch(ListingMeta, [records[i] for i in meta_index])
+
+        rejected = dict(event_rejects)
+        rejected.update((meta_index[j], error) for j, error in meta_rejects)
+        for i, error in sorted(rejected.items()):
+            self._reject(offsets[i], f"{records[i].get('mls_number')}: {error}")
+
+        event_rows = [(i, *row) for i, row in enumerate(events) if i not in rejected]
+        meta_rows = [(i, *row) for i, row in zip(meta_index, metas) if i not in rejected]
+
+        with db.transaction():
+            db.query(LOCK_SQL)
+            copy_rows(db, 'ingest_events', ['seq'] + EVENT_FIELDS, event_rows)
+            copy_rows(db, 'ingest_meta', ['seq'] + META_FIELDS, meta_rows)
+            inserted = db.query(INSERT_EVENTS_SQL)
+            upserted = db.query(self.upsert_meta_sql)
+
+            changed = sorted({x['mls_number'] for x in inserted} | {x['mls_number'] for x in upserted})
+            if changed:
+                if has_state:
+                    listing_state.apply_ingested_events(db, changed)
+                if self.has_new_days:
+                    new_today.apply_ingested_events(db, changed)
+                self.stats['data_version'] = delta_feed.publish_changes(db, changed)
+
+            self.stats['records'] += len(lines)
+            db.query(SAVE_CHECKPOINT_SQL, params={
+                'source': source,
+                'position': lines[-1][0],
+                'records': self.stats['records'],
+            })
+
+        num_inserted = sum(x['num_events'] for x in inserted)
+        self.stats['events_inserted'] += num_inserted
+        self.stats['duplicate_events'] += len(event_rows) - num_inserted
+        self.stats['meta_changed'] += len(upserted)
+        self.stats['listings_changed'] += len(changed)
+        self.stats['batches'] += 1
+
+    def run(self, path: str, source: str = None, max_batches: int = None) -> dict:
+
+        """
+        Loads path from its last checkpoint. source names the checkpoint and
+        defaults to the absolute path. max_batches stops early, e.g. to
+        spread a backfill over several runs.
+        """
+
+        source = source or os.path.abspath(path)
+        start = time.perf_counter()
+        self.errors = []
+
+        with self.pool.connection() as db:
+            self.setup(db)
+            has_state = db.query(STATE_TABLE_SQL)[0]['exists']
+            self.has_new_days = db.query(new_today.NEW_DAYS_TABLE_SQL)[0]['exists']
+            position, records = self.checkpoint(db, source)
+            self.stats = {
+                'source': source,
+                'resumed_from': position,
+                'records': records,
+                'events_inserted': 0,
+                'duplicate_events': 0,
+                'meta_changed': 0,
+                'listings_changed': 0,
+                'rejected': 0,
+                'batches': 0,
+                'data_version': None,
+            }
+
+            batch = []
+            for line in read_lines(path, position):
+                batch.append(line)
+                if len(batch) >= self.batch_size:
+                    self._load_batch(db, source, batch, has_state)
+                    batch = []
+                    if max_batches is not None and self.stats['batches'] >= max_batches:
+                        break
+            else:
+                if batch:
+                    self._load_batch(db, source, batch, has_state)
+
+        seconds = time.perf_counter() - start
+        loaded = self.stats['records'] - records
+        self.stats['seconds'] = round(seconds, 3)
+        self.stats['records_per_second'] = round(loaded / seconds, 1) if seconds else None
+        return self.stats
+
+
+if __name__ == '__main__':
+
+    # python bulk_ingest.py scrape.jsonl --dsn ...
+    #     loads a scrape file, resuming from its checkpoint
+    # python bulk_ingest.py --synthetic [--dsn scratch-db]
+    #     checks validate_batch against pydantic, and with a scratch
+    #     database compares throughput with row by row inserts, then
+    #     checks a crashed load resumes to the same tables
+    import random
+    import tempfile
+    from db_pool import ConnectionPool
+
+    parser = argparse.ArgumentParser(description='Bulk load scraped listings')
+    parser.add_argument('path', nargs='?')
+    parser.add_argument('--dsn')
+    parser.add_argument('--source')
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    parser.add_argument('--synthetic', action='store_true')
+    parser.add_argument('--events', type=int, default=100000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    if not args.synthetic:
+        if not args.path or not args.dsn:
+            sys.exit('a path and --dsn are required unless running --synthetic')
+        loader = BulkLoader(ConnectionPool(dsn=args.dsn), batch_size=args.batch_size)
+        print(loader.run(args.path, source=args.source))
+        for offset, error in loader.errors:
+            print(f'rejected line ending at byte {offset}: {error}')
+        sys.exit(0)
+
+    from synthetic_data import EVENT_COLUMNS, META_COLUMNS, SCHEMA_DDL, generate_dataset
+
+    rng = random.Random(args.seed)
+    dataset = generate_dataset(args.events, seed=args.seed)
+    metas = {x[0]: dict(zip(META_COLUMNS, x)) for x in dataset.meta}
+
+    # One scrape per event, carrying its listing's meta, with some of the
+    # values as strings and a few records broken the ways scrapes break
+    records = []
+    for row in dataset.events:
+        record = dict(zip(EVENT_COLUMNS, row))
+        record.update({k: v for k, v in metas[record['mls_number']].items() if k in META_FIELDS})
+        draw = rng.random()
+        if draw < 0.1:
+            record['price'] = str(record['price'])
+            record['beds'] = str(record['beds'])
+        elif draw < 0.11:
+            record['sq_ft'] = float(record['sq_ft'])
+        elif draw < 0.115:
+            record['description'] = ''
+        elif draw < 0.118:
+            del record['price']
+        elif draw < 0.12:
+            record['sq_ft'] = 'n/a'
+        records.append(record)
+
+    # validate_batch gives exactly what the models do
+    def by_model(model, record):
+        try:
+            return tuple(model(**record).dict().values())
+        except pydantic.ValidationError:
+            return None
+
+    sample = [empty_string_to_none(x) for x in records[:20000]]
+    odd = [{'mls_number': 1, 'url': b'u', 'price': True, 'sq_ft': '12', 'days_on_market': ' 3 ',
+            'status': None, 'beds': 2.0, 'baths': '2.5', 'year_built': 1999, 'event_date': 5, 'images': ('a',)}]
+    for model in (ListingEvent, ListingMeta):
+        rows, rejected = validate_batch(model, sample + odd)
+        assert rows == [by_model(model, x) for x in sample + odd]
+        assert [i for i, _ in rejected] == [i for i, x in enumerate(rows) if x is None]
+
+        start = time.perf_counter()
+        validate_batch(model, sample)
+        batch_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        for record in sample:
+            by_model(model, record)
+        model_seconds = time.perf_counter() - start
+        print(f'{model.__name__:<13} {len(sample)} records: validate_batch {batch_seconds * 1000:.1f}ms, '
+              f'one model each {model_seconds * 1000:.1f}ms ({model_seconds / batch_seconds:.1f}x)')
+    print('validate_batch matches the models')
+
+    if not args.dsn:
+        sys.exit(0)
+
+    path = os.path.join(tempfile.mkdtemp(), 'scrape.jsonl')
+    with open(path, 'w') as f:
+        for record in records:
+            f.write(json.dumps(record) + '\n')
+
+    pool = ConnectionPool(dsn=args.dsn)
+
+    def reset():
+        with pool.connection() as db:
+            for statement in SCHEMA_DDL.split(';'):
+                if statement.strip():
+                    db.query(statement)
+            db.query('DROP TABLE IF EXISTS listing_current_state')
+            db.query('DROP TABLE IF EXISTS listing_new_days')
+            db.query('TRUNCATE listing_events, listing_meta')
+            db.query('DROP TABLE IF EXISTS ingestion_checkpoints')
+
+    def snapshot() -> tuple:
+        with pool.connection() as db:
+            events = db.query(f"SELECT {', '.join(EVENT_FIELDS)} FROM listing_events ORDER BY mls_number, event_date, price")
+            meta = db.query(f"SELECT * FROM listing_meta ORDER BY mls_number")
+        return events, meta
+
+    # Row by row: a model per record, a lookup and an insert per event
+    reset()
+    baseline = records[:min(len(records), 5000)]
+    start = time.perf_counter()
+    with pool.connection() as db:
+        for record in baseline:
+            record = empty_string_to_none(record)
+            try:
+                event = ListingEvent(**record).to_dict()
+                meta = ListingMeta(**record).to_dict()
+            except pydantic.ValidationError:
+                continue
+            exists = db.query(
+                'SELECT 1 FROM listing_events WHERE mls_number = %(mls_number)s AND event_date = %(event_date)s AND price = %(price)s',
+                params=event,
+            )
+            if not exists:
+                db.query(f"INSERT INTO listing_events ({', '.join(EVENT_FIELDS)}) VALUES ({', '.join(f'%({x})s' for x in EVENT_FIELDS)})", params=event)
+            meta['images'] = json.dumps(meta['images'])
+            db.query(
+                f"INSERT INTO listing_meta ({', '.join(META_FIELDS)}, active) VALUES ({', '.join(f'%({x})s' for x in META_FIELDS)}, TRUE) "
+                f"ON CONFLICT (mls_number) DO UPDATE SET {', '.join(f'{x} = EXCLUDED.{x}' for x in META_FIELDS[1:])}",
+                params=meta,
+            )
+    row_seconds = time.perf_counter() - start
+    print(f'row by row: {len(baseline)} records in {row_seconds:.2f}s, {len(baseline) / row_seconds:.0f} records/s')
+
+    # The same records through the loader match the row by row tables
+    expected = snapshot()
+    with open(path + '.head', 'w') as f:
+        for record in baseline:
+            f.write(json.dumps(record) + '\n')
+    loader = BulkLoader(pool, batch_size=args.batch_size)
+    reset()
+    loader.run(path + '.head')
+    assert snapshot() == expected
+    print(f"bulk, same {len(baseline)} records: {loader.stats['records_per_second']:.0f} records/s, same tables")
+
+    # Everything in one go, keeping listing_new_days up to date on the
+    # way, then again: all duplicates
+    reset()
+    with pool.connection() as db:
+        new_today.create_table(db)
+    stats = dict(BulkLoader(pool, batch_size=args.batch_size).run(path))
+    print(f'bulk: {stats}')
+    full = snapshot()
+    with pool.connection() as db:
+        new_days_sql = 'SELECT day, kind, mls_number FROM listing_new_days ORDER BY 1, 2, 3'
+        incremental = db.query(new_days_sql)
+        new_today.rebuild(db)
+        assert db.query(new_days_sql) == incremental
+    print(f'listing_new_days: {len(incremental)} rows, same as a rebuild')
+    again = BulkLoader(pool, batch_size=args.batch_size).run(path, source='again')
+    assert again['events_inserted'] == 0 and again['listings_changed'] == 0 and snapshot() == full
+    print(f"reload: {again['duplicate_events']} duplicates skipped, nothing changed")
+
+    class CrashingLoader(BulkLoader):
+
+        # Dies inside the third batch's transaction, after its inserts
+        def _load_batch(self, db, source, lines, has_state):
+            if self.stats['batches'] == 2:
+                with db.transaction():
+                    copy_rows(db, 'ingest_events', ['seq'] + EVENT_FIELDS, [(0, 'crashed', 1.0, 1, 1.0, 0, 'Active', 1, 1, 2000, '2020-01-01 00:00:00')])
+                    db.query(INSERT_EVENTS_SQL)
+
+                    # The process dies here, and its connection with it
+                    db.conn.raw.close()
+                    raise RuntimeError('killed')
+            super()._load_batch(db, source, lines, has_state)
+
+    reset()
+    try:
+        CrashingLoader(pool, batch_size=args.batch_size).run(path)
+    except RuntimeError:
+
+        # The process would have died with its connections
+        pool.close()
+    partial = BulkLoader(pool, batch_size=args.batch_size).run(path, max_batches=2)
+    resumed = BulkLoader(pool, batch_size=args.batch_size).run(path)
+    assert partial['resumed_from'] > 0 and resumed['resumed_from'] > partial['resumed_from']
+    assert resumed['records'] == stats['records'] and snapshot() == full
+    print(f"crash after 2 batches, then 2 more, then the rest: same tables as one load")
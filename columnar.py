@@ -0,0 +1,318 @@
+from __future__ import annotations
+import numpy as np
+from db_pool import ResultColumns
+from pagination import encode_cursor, listing_end_cursor
+
+# Columnar versions of nest_events, score_listings and seller_motivation_score
+# from get_matching_listings. Everything up to the final listing dicts
+# works on whole columns; the dicts are built once, in response order.
+# numpy is only imported when ALERTS_COLUMNAR is on
+
+
+def as_float(values: list) -> np.ndarray:
+
+    # None becomes NaN, which every comparison treats as false
+    return np.array(values, dtype=float)
+
+
+def is_true(values: list) -> np.ndarray:
+
+    # Same as `x is True` for a boolean column that may hold None
+    return np.array([False if x is None else x for x in values], dtype=bool)
+
+
+def motivation_scores(seller_motivation: np.ndarray, days_on_market: np.ndarray, num_price_drops: np.ndarray) -> np.ndarray:
+
+    """
+    seller_motivation_score for every listing at once.
+    """
+
+    score = np.where(seller_motivation, 4, 0)
+
+    # Days on market, with the same overlapping buckets as the row version
+    score += np.select(
+        [(days_on_market > 90) & (days_on_market < 180), days_on_market > 60, days_on_market > 30],
+        [3, 2, 1],
+        default=0,
+    )
+
+    # Price drops, capped at 3 points
+    score += np.minimum(num_price_drops, 3)
+
+    return np.where(score >= 6, 'High', np.where(score >= 3, 'Moderate', 'Undetected'))
+
+
+def new_flags(new_today: np.ndarray, days_on_market: np.ndarray, min_days_on_market: int | None) -> np.ndarray:
+    new = new_today | (days_on_market == 0)
+    if min_days_on_market is not None:
+        new |= days_on_market == min_days_on_market
+    return new
+
+
+def take(column: list, index: np.ndarray) -> list:
+    return [column[i] for i in index.tolist()]
+
+
+def listing_dicts(columns: ResultColumns, index: np.ndarray, drop: tuple[str, ...] = ()) -> list[dict]:
+
+    """
+    One dict per row in index, with the columns in select order.
+    """
+
+    names = [x for x in columns.names if x not in drop]
+    values = [take(columns[x], index) for x in names]
+    return [dict(zip(names, row)) for row in zip(*values)]
+
+
+def nest_columns(
+        columns: ResultColumns,
+        min_days_on_market: int | None,
+        today: str,
+        new_mls: frozenset = None,
+) -> tuple[list[dict], np.ndarray]:
+
+    """
+    nest_events for final_fields rows. Returns the listings in the order
+    their rn = 1 rows came in, and their 'new' flags.
+    """
+
+    mls = np.array(columns['mls_number'], dtype=object)
+    _, codes = np.unique(mls, return_inverse=True)
+    num_codes = int(codes.max()) + 1 if len(codes) else 0
+
+    base = np.flatnonzero(np.array(columns['rn']) == 1)
+    price_diff = as_float(columns['price_diff'])
+    changed = np.flatnonzero(~np.isnan(price_diff) & (price_diff != 0))
+
+    # Drop counts and events new today, per listing
+    changed_codes = codes[changed]
+    dates = np.array(take(columns['event_date'], changed), dtype=str)
+    drops = np.bincount(changed_codes[price_diff[changed] < 0], minlength=num_codes)
+    new_today = np.bincount(changed_codes[np.char.startswith(dates, today)], minlength=num_codes) > 0
+
+    # Events grouped by listing, newest first. lexsort is stable, so equal
+    # dates keep their row order like sorted(reverse=True) does
+    date_rank = np.unique(dates, return_inverse=True)[1] if len(dates) else dates
+    order = np.lexsort((-date_rank, changed_codes)) if len(dates) else changed
+    changed = changed[order]
+    ends = np.cumsum(np.bincount(changed_codes, minlength=num_codes))
+
+    base_codes = codes[base]
+    days_on_market = as_float(take(columns['current_days_on_market'], base))
+    if new_mls is not None:
+        new = np.array([x in new_mls for x in take(columns['mls_number'], base)], dtype=bool)
+    else:
+        new = new_flags(new_today[base_codes], days_on_market, min_days_on_market)
+    scores = motivation_scores(is_true(take(columns['seller_motivation'], base)), days_on_market, drops[base_codes])
+
+    # Only now build dicts: the events, then the listings around them
+    event_rows = zip(
+        take(columns['mls_number'], changed),
+        take(columns['event_date'], changed),
+        take(columns['new_price'], changed),
+        take(columns['price'], changed),
+        take(columns['price_diff'], changed),
+    )
+    events = [
+        {'mls_number': m, 'event_date': d, 'new_price': n, 'old_price': p, 'price_diff': x}
+        for m, d, n, p, x in event_rows
+    ]
+
+    listings = listing_dicts(columns, base)
+    for listing, code, is_new, score in zip(listings, base_codes.tolist(), new.tolist(), scores.tolist()):
+        listing['events'] = events[ends[code - 1] if code else 0:ends[code]]
+        listing['new'] = is_new
+        listing['seller_motivation_score'] = score
+
+    return listings, new
+
+
+def score_columns(columns: ResultColumns) -> tuple[list[dict], np.ndarray]:
+
+    """
+    score_listings for nested_listings rows, which already carry their
+    events, drop counts and 'new' flags.
+    """
+
+    index = np.arange(len(columns))
+    scores = motivation_scores(
+        is_true(columns['seller_motivation']),
+        as_float(columns['current_days_on_market']),
+        np.array(columns['num_price_drops'], dtype=np.int64),
+    )
+    listings = listing_dicts(columns, index, drop=('num_price_drops',))
+    for listing, score in zip(listings, scores.tolist()):
+        listing['seller_motivation_score'] = score
+    return listings, np.array(columns['new'], dtype=bool)
+
+
+def trim_partial_columns(columns: ResultColumns, page_size: int) -> tuple[ResultColumns, str | None]:
+
+    """
+    pagination.trim_partial_listing on columns.
+    """
+
+    if len(columns) < page_size:
+        return columns, None
+
+    mls = columns['mls_number']
+    keep = np.flatnonzero(np.array(mls, dtype=object) != mls[-1])
+
+    # A single listing with more events than a page, see trim_partial_listing
+    if not len(keep):
+        return columns, listing_end_cursor(mls[-1])
+
+    trimmed = ResultColumns(columns.names, [take(columns[x], keep) for x in columns.names])
+    return trimmed, encode_cursor(trimmed['mls_number'][-1], trimmed['event_date'][-1])
+
+
+def build_results(
+        columns: ResultColumns,
+        min_days_on_market: int | None,
+        page_size: int,
+        use_cursor: bool,
+        aggregated: bool,
+        today: str,
+        new_mls: frozenset = None,
+) -> tuple[list[dict], str | None]:
+
+    """
+    get_matching_listings.build_results for a ResultColumns, with the
+    same output.
+    """
+
+    # Empty results may not even carry column names
+    if not len(columns):
+        return [], None
+
+    next_cursor = None
+    if aggregated:
+        if use_cursor and len(columns) >= page_size:
+            next_cursor = encode_cursor(columns['mls_number'][-1], columns['event_date'][-1])
+        listings, new = score_columns(columns)
+    else:
+        if use_cursor:
+            columns, next_cursor = trim_partial_columns(columns, page_size)
+        listings, new = nest_columns(columns, min_days_on_market, today, new_mls)
+
+    # New listings first, otherwise in query order
+    order = np.concatenate([np.flatnonzero(new), np.flatnonzero(~new)])
+    return [listings[i] for i in order.tolist()], next_cursor
+
+
+if __name__ == '__main__':
+
+    # python columnar.py
+    # Parity with the row-wise path, then timings at a few page sizes
+    # python columnar.py --dsn scratch-db
+    # Also loads the synthetic dataset into Postgres and checks both paths
+    # on what the compiled listing query returns there, as columns and as
+    # row dicts
+    import argparse
+    import copy
+    import json
+    import time
+    import get_matching_listings
+    from alert_models import AlertFilters
+    from benchmark_nest_events import make_event_rows
+
+    parser = argparse.ArgumentParser(description='Check columnar against the row-wise path')
+    parser.add_argument('--dsn')
+    parser.add_argument('--events', type=int, default=20000)
+    args = parser.parse_args()
+
+    today = get_matching_listings.current_day()
+
+    def to_columns(rows: list[dict]) -> ResultColumns:
+        names = list(rows[0]) if rows else []
+        return ResultColumns(names, [[row[x] for row in rows] for x in names])
+
+    def aggregate(rows: list[dict]) -> list[dict]:
+
+        # nested_listings rows from final_fields rows, via nest_events
+        listings = get_matching_listings.nest_events(copy.deepcopy(rows), min_days_on_market=30)
+        for listing in listings:
+            listing['num_price_drops'] = len([x for x in listing['events'] if x['price_diff'] < 0])
+            del listing['seller_motivation_score']
+        return listings
+
+    checked = 0
+    for seed in range(20):
+        rows = make_event_rows(2000, seed=seed)
+        rows.sort(key=lambda x: (x['mls_number'], x['event_date']), reverse=True)
+        rows[seed]['seller_motivation'] = None
+        for aggregated, data in [(False, rows), (True, aggregate(rows))]:
+            for use_cursor, page_size in [(False, 500), (True, 500), (True, len(data) + 1)]:
+                for min_days in (None, 30):
+                    filters = AlertFilters(min_days_on_market=min_days)
+                    expected = get_matching_listings.build_results(copy.deepcopy(data), filters, page_size, use_cursor, aggregated, today)
+                    actual = build_results(to_columns(data), min_days, page_size, use_cursor, aggregated, today)
+                    assert json.dumps(expected) == json.dumps(actual), (seed, aggregated, use_cursor, min_days)
+                    checked += 1
+
+                    # new_mls in place of the per listing checks, both ways
+                    if not aggregated:
+                        new_mls = frozenset(x['mls_number'] for x in expected[0] if x['new'])
+                        rows_new = get_matching_listings.build_results(copy.deepcopy(data), filters, page_size, use_cursor, aggregated, today, new_mls)
+                        columns_new = build_results(to_columns(data), min_days, page_size, use_cursor, aggregated, today, new_mls)
+                        assert json.dumps(expected) == json.dumps(rows_new) == json.dumps(columns_new), (seed, use_cursor, min_days)
+    assert build_results(ResultColumns([], []), None, 500, True, False, today) == ([], None)
+    print(f'{checked} cases match build_results')
+
+    if args.dsn:
+        from db_pool import ConnectionPool
+        from new_today import market_date
+        from query_compiler import compile_listings_query
+        from synthetic_data import generate_dataset, load_postgres
+
+        # Postgres counts days on market from its CURRENT_DATE, the market date
+        dataset = generate_dataset(args.events, today=market_date())
+        pool = ConnectionPool(dsn=args.dsn)
+        with pool.connection() as db:
+            load_postgres(db, dataset)
+
+        checked = 0
+        with pool.connection() as db:
+            for alert in dataset.report_recipients:
+                filters = get_matching_listings.filters_from_row(alert)
+                for aggregated in (False, True):
+                    for use_cursor, page_size in [(False, 500), (True, 500), (True, 10 ** 6)]:
+                        query, params = compile_listings_query(
+                            filters, page_size=page_size, use_cursor=use_cursor, aggregate=aggregated, today=today,
+                        )
+                        rows = db.query_compiled(query, params)
+                        columns = db.query_compiled(query, params, return_columns=True)
+                        expected = get_matching_listings.build_results(rows, filters, page_size, use_cursor, aggregated, today)
+                        actual = build_results(columns, filters.min_days_on_market, page_size, use_cursor, aggregated, today)
+                        assert json.dumps(expected, default=str) == json.dumps(actual, default=str), (alert['nickname'], aggregated, use_cursor)
+                        checked += 1
+        pool.close()
+        print(f'{checked} cases match build_results on Postgres')
+
+    def best(func, repeat: int = 5) -> float:
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            func()
+            times.append(time.perf_counter() - start)
+        return min(times) * 1000
+
+    # Both from the tuples the cursor fetches, so each side pays for
+    # building its own rows or columns
+    print(f"{'mode':<11} {'rows':>7} {'dicts ms':>9} {'columns ms':>11}")
+    filters = AlertFilters()
+    for num_rows in (500, 5000, 50000):
+        rows = make_event_rows(num_rows, seed=num_rows)
+        for aggregated, data in [(False, rows), (True, aggregate(rows))]:
+            names = list(data[0])
+            fetched = [tuple(row[x] for x in names) for row in data]
+
+            def run_dicts():
+                rows = [dict(zip(names, row)) for row in fetched]
+                get_matching_listings.build_results(rows, filters, num_rows, False, aggregated)
+
+            def run_columns():
+                columns = ResultColumns(names, [list(x) for x in zip(*fetched)])
+                build_results(columns, None, num_rows, False, aggregated, today)
+
+            print(f"{'aggregated' if aggregated else 'rows':<11} {len(data):>7} {best(run_dicts):>9.2f} {best(run_columns):>11.2f}")
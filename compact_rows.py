@@ -0,0 +1,157 @@
+from __future__ import annotations
+from db_pool import ResultRows
+from pagination import encode_cursor, listing_end_cursor, next_listing_cursor
+from row_records import Record, record_type, project, append_field
+from seller_motivation import motivation_score
+
+# Row versions of nest_events, score_listings and the field projection
+# that keep every listing and event as a tuple of values. A dict per row
+# carries its own hash table of the same 25 keys; a Record only holds the
+# tuple, and the field names live once per schema on its class. Records
+# read like read-only dicts and json_stream encodes them as the dicts they
+# stand for, so the response bytes don't change
+
+# Fields of a nested price change event, in the order nest_events builds them
+EVENT_FIELDS = ('mls_number', 'event_date', 'new_price', 'old_price', 'price_diff')
+
+# What nest_events adds after a listing row's own columns
+NESTED_FIELDS = ('events', 'new', 'seller_motivation_score')
+
+
+def trim_partial_rows(rows: ResultRows, page_size: int) -> tuple[list[tuple], str | None]:
+
+    """
+    pagination.trim_partial_listing on row tuples.
+    """
+
+    data = rows.rows
+    if len(data) < page_size:
+        return data, None
+
+    mls = rows.names.index('mls_number')
+    last_mls = data[-1][mls]
+    complete = [x for x in data if x[mls] != last_mls]
+
+    # A single listing with more events than a page, see pagination.trim_partial_listing
+    if not complete:
+        return data, listing_end_cursor(last_mls)
+
+    last_row = complete[-1]
+    return complete, encode_cursor(last_row[mls], last_row[rows.names.index('event_date')])
+
+
+def nest_rows(
+        names: list[str],
+        data: list[tuple],
+        min_days_on_market: int | None,
+        today: str,
+        new_mls: frozenset = None,
+) -> list[Record]:
+
+    """
+    nest_events for final_fields row tuples, with the same fields in the
+    same order. Each listing is built once, with its events, 'new' flag
+    and motivation score, instead of being filled in afterwards.
+    """
+
+    index = {x: i for i, x in enumerate(names)}
+    mls, rn, price, event_date = index['mls_number'], index['rn'], index['price'], index['event_date']
+    new_price, price_diff, days = index['new_price'], index['price_diff'], index['current_days_on_market']
+    seller_motivation = index['seller_motivation']
+    listing_type = record_type(tuple(names) + NESTED_FIELDS)
+    event_type = record_type(EVENT_FIELDS)
+
+    # Index the price change events by mls_number in a single pass
+    base_rows = []
+    events_by_mls = {}
+    for row in data:
+        if row[rn] == 1:
+            base_rows.append(row)
+
+        diff = row[price_diff]
+        if diff is not None and diff != 0.0:
+            event = event_type((row[mls], row[event_date], row[new_price], row[price], diff))
+            events_by_mls.setdefault(row[mls], []).append(event)
+
+    listings = []
+    for row in base_rows:
+
+        # Newest first, ties in row order like sorted(reverse=True)
+        extra_events = events_by_mls.get(row[mls], [])
+        events = sorted(extra_events, key=lambda x: x.row[1], reverse=True)
+
+        # Same checks as nest_events, or the index in their place
+        if new_mls is not None:
+            new = row[mls] in new_mls
+        else:
+            new = (
+                any(x.row[1][:10] == today for x in extra_events)
+                or row[days] == 0
+                or row[days] == min_days_on_market
+            )
+
+        num_price_drops = len([x for x in extra_events if x.row[4] < 0])
+        score = motivation_score(row[seller_motivation], row[days], num_price_drops)
+        listings.append(listing_type(row + (events, new, score)))
+
+    return listings
+
+
+def score_rows(names: list[str], data: list[tuple]) -> list[Record]:
+
+    """
+    score_listings for nested_listings row tuples: num_price_drops goes,
+    seller_motivation_score comes last.
+    """
+
+    index = {x: i for i, x in enumerate(names)}
+    drops, events = index['num_price_drops'], index['events']
+    days, seller_motivation = index['current_days_on_market'], index['seller_motivation']
+    listing_type = record_type(tuple(names[:drops]) + tuple(names[drops + 1:]) + ('seller_motivation_score',))
+
+    listings = []
+    for row in data:
+        num_price_drops = row[drops]
+        if num_price_drops is None:
+            num_price_drops = len([x for x in row[events] if x.get('price_diff') < 0])
+        score = motivation_score(row[seller_motivation], row[days], num_price_drops)
+        listings.append(listing_type(row[:drops] + row[drops + 1:] + (score,)))
+
+    return listings
+
+
+def build_results(
+        rows: ResultRows,
+        min_days_on_market: int | None,
+        page_size: int,
+        use_cursor: bool,
+        aggregated: bool,
+        today: str,
+        new_mls: frozenset = None,
+) -> tuple[list[Record], str | None]:
+
+    """
+    get_matching_listings.build_results for a ResultRows, giving records
+    that serialize to the same JSON.
+    """
+
+    # Empty results may not even carry column names
+    if not len(rows):
+        return [], None
+
+    next_cursor = None
+    if aggregated:
+        listings = score_rows(rows.names, rows.rows)
+        if use_cursor:
+            next_cursor = next_listing_cursor(listings, page_size)
+    else:
+        data = rows.rows
+        if use_cursor:
+            data, next_cursor = trim_partial_rows(rows, page_size)
+        listings = nest_rows(rows.names, data, min_days_on_market, today, new_mls)
+
+    # New listings first, otherwise in query order
+    new = type(listings[0]).index['new'] if listings else 0
+    new_items = [x for x in listings if x.row[new] is True]
+    old_items = [x for x in listings if x.row[new] is False]
+    return new_items + old_items, next_cursor
@@ -0,0 +1,395 @@
+from __future__ import annotations
+import os
+import re
+import time
+import threading
+from contextlib import contextmanager
+
+# Idle connections older than this get a SELECT 1 before they are reused.
+# Lambda freezes between invocations, and NAT/RDS proxies drop idle sockets
+STALE_AFTER_SECONDS = float(os.environ.get('DB_STALE_AFTER_SECONDS', 60))
+MAX_POOL_SIZE = int(os.environ.get('DB_MAX_POOL_SIZE', 4))
+
+# Startup options for each new connection. Sessions run on the market's
+# time zone so CURRENT_DATE, and with it days on market, agrees with
+# new_today.market_date. Empty sends none, e.g. through a proxy that
+# rejects them
+SESSION_OPTIONS = os.environ.get('DB_SESSION_OPTIONS', '-c TimeZone=America/Denver')
+
+# The -c name=value pairs of SESSION_OPTIONS, set after connecting when
+# postgres_utils opens the connection
+SESSION_SETTINGS = re.findall(r'-c\s*([\w.]+)=(\S+)', SESSION_OPTIONS)
+
+
+class PooledConnection:
+
+    """
+    A raw DB-API connection plus the bookkeeping the pool needs.
+    """
+
+    def __init__(self, raw, connect_ms: float):
+        self.raw = raw
+        self.connect_ms = connect_ms
+        self.last_used = time.monotonic()
+
+        # Names of the prepared statements that exist on this connection
+        self.prepared = set()
+
+        # Set once the pool has closed it for good
+        self.discarded = False
+
+    def __repr__(self):
+        return f'PooledConnection - {id(self.raw)}'
+
+
+class ResultColumns:
+
+    """
+    A result set held column by column, as returned with return_columns.
+    len() is the number of rows and result['price'] one column's values.
+    """
+
+    def __init__(self, names: list[str], columns: list[list]):
+        self.names = names
+        self.columns = dict(zip(names, columns))
+        self.num_rows = len(columns[0]) if columns else 0
+
+    def __getitem__(self, name: str) -> list:
+        return self.columns[name]
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.columns
+
+    def __len__(self):
+        return self.num_rows
+
+    def __repr__(self):
+        return f'ResultColumns - {self.num_rows} rows'
+
+
+class ResultRows:
+
+    """
+    A result set as the driver's row tuples plus the column names once,
+    as returned with return_rows. compact_rows turns them into records.
+    """
+
+    def __init__(self, names: list[str], rows: list[tuple]):
+        self.names = names
+        self.rows = rows
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __repr__(self):
+        return f'ResultRows - {len(self.rows)} rows'
+
+
+class Session:
+
+    """
+    What callers get from ConnectionPool.connection(). Everything run
+    through one session uses the same connection, so the filter lookup and
+    the listing query share a single handshake.
+    """
+
+    def __init__(self, pool: ConnectionPool, conn: PooledConnection, fresh: bool):
+        self.pool = pool
+        self.conn = conn
+
+        # Time spent opening connections for this session, 0 when warm
+        self.connect_ms = conn.connect_ms if fresh else 0.0
+        self.warm = not fresh
+        self.num_queries = 0
+
+        # Inside transaction(), where nothing is retried
+        self.transaction_open = False
+
+    def query(self, sql: str, params: dict | None = None, return_dataframe: bool = False):
+
+        """
+        Same contract as postgres_utils.query_postgres_sql.
+        """
+
+        rows = self._run(lambda cur: cur.execute(sql, params))
+        if return_dataframe:
+            import pandas as pd
+            return pd.DataFrame(rows)
+        return rows
+
+    def query_compiled(
+            self,
+            query,
+            params: dict,
+            return_dataframe: bool = False,
+            return_columns: bool = False,
+            return_rows: bool = False,
+    ):
+
+        """
+        Runs a query_compiler.CompiledQuery as a prepared statement,
+        preparing it the first time this connection sees its shape.
+        return_columns gives a ResultColumns instead of row dicts, and
+        return_rows a ResultRows. return_columns wins if both are set.
+        """
+
+        def run(cur):
+            if query.name not in self.conn.prepared:
+                cur.execute(query.prepare_sql())
+                self.conn.prepared.add(query.name)
+            cur.execute(query.execute_sql(), params)
+
+        rows = self._run(run, return_columns, return_rows)
+        if return_dataframe:
+            import pandas as pd
+            return pd.DataFrame(rows)
+        return rows
+
+    @contextmanager
+    def transaction(self):
+
+        """
+        Runs the statements inside as one transaction. None of them is
+        retried on a new connection, so a dropped connection or a failed
+        COMMIT raises instead of reporting work that was rolled back.
+        """
+
+        self._run(lambda cur: cur.execute('BEGIN'))
+        self.transaction_open = True
+        try:
+            yield self
+        except Exception:
+            if not self.conn.discarded and not getattr(self.conn.raw, 'closed', False):
+                try:
+                    self._run(lambda cur: cur.execute('ROLLBACK'))
+                except Exception:
+                    pass
+            raise
+        else:
+            self._run(lambda cur: cur.execute('COMMIT'))
+        finally:
+            self.transaction_open = False
+
+    def in_transaction(self) -> bool:
+
+        """
+        Whether an explicit transaction is open on the connection, e.g.
+        after a BEGIN. Drivers that can't tell are taken to be idle.
+        """
+
+        if self.transaction_open:
+            return True
+        status = getattr(self.conn.raw, 'get_transaction_status', None)
+        if status is None:
+            return False
+
+        # psycopg2's TRANSACTION_STATUS_INTRANS and _INERROR
+        return status() in (2, 3)
+
+    def _run(self, execute, return_columns: bool = False, return_rows: bool = False) -> list[dict] | ResultColumns | ResultRows:
+
+        # A warm connection can fail on first use if the socket died while
+        # the worker was frozen. Then, and only then, the statement is run
+        # again once on a new connection: not when the statement itself
+        # failed (a timeout, a deadlock) and not inside a transaction,
+        # whose earlier statements went down with the old connection
+        retry = self.warm and not self.in_transaction()
+        for attempt in range(2):
+            try:
+                cur = self.conn.raw.cursor()
+                try:
+                    execute(cur)
+                    self.num_queries += 1
+                    if cur.description is None:
+                        if return_columns:
+                            return ResultColumns([], [])
+                        return ResultRows([], []) if return_rows else []
+                    columns = [x[0] for x in cur.description]
+
+                    # Transposing in C is much cheaper than a dict per row
+                    if return_columns:
+                        rows = cur.fetchall()
+                        values = [list(x) for x in zip(*rows)] if rows else [[] for _ in columns]
+                        return ResultColumns(columns, values)
+
+                    # The tuples as fetched, without a dict per row
+                    if return_rows:
+                        return ResultRows(columns, cur.fetchall())
+                    return [dict(zip(columns, row)) for row in cur.fetchall()]
+                finally:
+                    cur.close()
+            except self.pool.disconnect_errors as e:
+                if not self.pool.is_dead(self.conn, e):
+                    raise
+                self.pool.discard(self.conn)
+                if attempt or not retry:
+                    raise
+                self.conn = self.pool.open()
+                self.connect_ms += self.conn.connect_ms
+                self.warm = False
+
+
+class ConnectionPool:
+
+    """
+    Keeps connections open across warm invocations. Nothing is imported or
+    connected until the first query, so cold starts only pay for what they
+    use. Without a dsn or driver, connections come from
+    postgres_utils.get_connection, with the same host, credentials and
+    settings as query_postgres_sql. A dsn connects there instead, e.g. a
+    scratch database for benchmarks. driver is any DB-API module and
+    defaults to psycopg2, which makes it easy to swap in a fake for tests
+    and benchmarks.
+    """
+
+    def __init__(
+            self,
+            dsn: str = None,
+            driver=None,
+            max_size: int = MAX_POOL_SIZE,
+            stale_after: float = STALE_AFTER_SECONDS,
+    ):
+        self.dsn = dsn
+        self._driver = driver
+        self.use_postgres_utils = dsn is None and driver is None
+        self.max_size = max_size
+        self.stale_after = stale_after
+        self._idle = []
+        self._lock = threading.Lock()
+        self.num_connects = 0
+        self.num_reconnects = 0
+
+    @property
+    def driver(self):
+        if self._driver is None:
+            import psycopg2
+            self._driver = psycopg2
+        return self._driver
+
+    @property
+    def disconnect_errors(self) -> tuple:
+        return (self.driver.OperationalError, self.driver.InterfaceError)
+
+    def open(self) -> PooledConnection:
+        start = time.perf_counter()
+        if self.use_postgres_utils:
+            raw = self._connect_postgres_utils()
+        elif SESSION_OPTIONS:
+            raw = self.driver.connect(self.dsn or '', options=SESSION_OPTIONS)
+        else:
+            raw = self.driver.connect(self.dsn or '')
+        raw.autocommit = True
+        if self.use_postgres_utils and SESSION_SETTINGS:
+            cur = raw.cursor()
+            for name, value in SESSION_SETTINGS:
+                cur.execute("SELECT set_config(%s, %s, false)", (name, value))
+            cur.close()
+        self.num_connects += 1
+        return PooledConnection(raw, connect_ms=(time.perf_counter() - start) * 1000)
+
+    def _connect_postgres_utils(self):
+
+        # The deployed connection settings, rather than whatever libpq's
+        # defaults point at
+        import postgres_utils
+        return postgres_utils.get_connection()
+
+    def is_dead(self, conn: PooledConnection, error: Exception) -> bool:
+
+        """
+        Whether error means the connection is gone, rather than that the
+        statement failed on a healthy one. psycopg2 raises cancels,
+        deadlocks and serialization failures as OperationalError too.
+        """
+
+        return isinstance(error, self.driver.InterfaceError) or bool(getattr(conn.raw, 'closed', False))
+
+    def discard(self, conn: PooledConnection):
+        if conn.discarded:
+            return
+        conn.discarded = True
+        self.num_reconnects += 1
+        try:
+            conn.raw.close()
+        except Exception:
+            pass
+
+    def _is_healthy(self, conn: PooledConnection) -> bool:
+        if getattr(conn.raw, 'closed', False):
+            return False
+        if time.monotonic() - conn.last_used < self.stale_after:
+            return True
+        try:
+            cur = conn.raw.cursor()
+            cur.execute('SELECT 1')
+            cur.fetchall()
+            cur.close()
+            return True
+        except self.disconnect_errors:
+            return False
+
+    def checkout(self) -> tuple[PooledConnection, bool]:
+
+        """
+        Returns a healthy connection and whether it was just opened.
+        """
+
+        while True:
+            with self._lock:
+                conn = self._idle.pop() if self._idle else None
+            if conn is None:
+                return self.open(), True
+            if self._is_healthy(conn):
+                return conn, False
+            self.discard(conn)
+
+    def checkin(self, conn: PooledConnection):
+        conn.last_used = time.monotonic()
+        with self._lock:
+            if len(self._idle) < self.max_size:
+                self._idle.append(conn)
+                return
+        conn.raw.close()
+
+    @contextmanager
+    def connection(self):
+        conn, fresh = self.checkout()
+        session = Session(self, conn, fresh)
+        try:
+            yield session
+        except Exception as e:
+
+            # Autocommit, so a failed statement leaves nothing open. Only
+            # a dead connection is dropped, and only once
+            if session.conn.discarded:
+                raise
+            if self.is_dead(session.conn, e):
+                self.discard(session.conn)
+            else:
+                self.checkin(session.conn)
+            raise
+        else:
+            self.checkin(session.conn)
+
+    def warm(self):
+
+        """
+        Opens a connection ahead of the first request, e.g. during the
+        Lambda init phase.
+        """
+
+        conn, fresh = self.checkout()
+        self.checkin(conn)
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.raw.close()
+
+
+# Module level so it survives between warm invocations of the same worker
+POOL = ConnectionPool()
+
+if os.environ.get('DB_PREWARM') == '1':
+    POOL.warm()
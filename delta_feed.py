@@ -0,0 +1,133 @@
+from __future__ import annotations
+import json
+import base64
+import hashlib
+from alert_cache import BUMP_DATA_VERSION_SQL
+
+# Which listings each data version touched. Ingestion writes it through
+# publish_changes, and since-mode requests read it to find the listings
+# that changed after the client's token
+LISTING_CHANGES_DDL = """
+CREATE TABLE IF NOT EXISTS listing_changes (
+    data_version bigint NOT NULL,
+    mls_number text NOT NULL,
+    changed_at timestamptz NOT NULL DEFAULT now(),
+    PRIMARY KEY (data_version, mls_number)
+);
+"""
+
+# Bumps the version and logs the listings under it in one statement, so a
+# client can never see the new version without its changes
+PUBLISH_CHANGES_SQL = f"""
+WITH bumped AS ({BUMP_DATA_VERSION_SQL.strip()}),
+logged AS (
+    INSERT INTO listing_changes (data_version, mls_number)
+    SELECT bumped.data_version, m FROM bumped, unnest(%(mls_numbers)s::text[]) m
+    ON CONFLICT DO NOTHING
+)
+SELECT data_version FROM bumped
+"""
+
+PRUNE_CHANGES_SQL = "DELETE FROM listing_changes WHERE changed_at < now() - %(keep)s::interval"
+
+# The oldest version still on record tells whether everything after the
+# token is there, or pruning already dropped some of it
+CHANGED_SINCE_SQL = """
+SELECT
+    (SELECT min(data_version) FROM listing_changes) AS oldest_version,
+    ARRAY(
+        SELECT DISTINCT mls_number FROM listing_changes
+        WHERE data_version > %(since_version)s
+        ORDER BY mls_number
+    ) AS mls_numbers
+"""
+
+# Past this many changed listings a delta saves little, send everything
+MAX_DELTA_LISTINGS = 2000
+
+
+class InvalidSince(ValueError):
+    pass
+
+
+def encode_since(data_version: int, today: str) -> str:
+
+    """
+    The token a client passes back as since. today is in it because days
+    on market filters and 'new' flags move with the date even when no
+    data changes, so a token from another day gets a full response.
+    """
+
+    raw = json.dumps([data_version, today], separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_since(token: str) -> tuple[int, str]:
+    try:
+        padded = token + '=' * (-len(token) % 4)
+        data_version, today = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    except (ValueError, TypeError):
+        raise InvalidSince('Invalid since token')
+
+    if not isinstance(data_version, int) or isinstance(data_version, bool) or not isinstance(today, str):
+        raise InvalidSince('Invalid since token')
+    return data_version, today
+
+
+def make_etag(key: str, meta=None) -> str:
+
+    """
+    Strong ETag for a response, from the same key the result cache uses,
+    which already covers the data version, date, filters and paging.
+    meta is whatever else goes in the body, the alert_meta fields, so
+    renaming an alert or changing its recipients changes the ETag.
+    """
+
+    raw = key if meta is None else key + '|' + json.dumps(meta, sort_keys=True, default=str)
+    return '"' + hashlib.sha1(raw.encode()).hexdigest()[:20] + '"'
+
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+
+    # Weak comparison, as If-None-Match uses
+    candidates = [x.strip() for x in if_none_match.split(',')]
+    return etag in candidates or f'W/{etag}' in candidates
+
+
+def changed_since(db, since_version: int) -> list[str] | None:
+
+    """
+    mls_numbers changed after since_version, or None when the change log
+    no longer covers that far back.
+    """
+
+    row = db.query(CHANGED_SINCE_SQL, params={'since_version': since_version})[0]
+    if row['oldest_version'] is None or row['oldest_version'] > since_version + 1:
+        return None
+    return row['mls_numbers']
+
+
+def create_table(db):
+    db.query(LISTING_CHANGES_DDL)
+
+
+def publish_changes(db, mls_numbers: list[str]) -> int:
+
+    """
+    Call once per ingestion batch after its rows are committed (and
+    listing_state.apply_ingested_events has run). Bumps the data version
+    and logs the touched listings under it. Returns the new version.
+    """
+
+    rows = db.query(PUBLISH_CHANGES_SQL, params={'mls_numbers': sorted(set(mls_numbers))})
+    return rows[0]['data_version']
+
+
+def prune_changes(db, keep: str = '7 days'):
+
+    # Tokens older than what's kept just get a full response
+    db.query(PRUNE_CHANGES_SQL, params={'keep': keep})
@@ -0,0 +1,378 @@
+from __future__ import annotations
+import os
+import sys
+import time
+import datetime
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import json_stream
+from alert_models import AlertFilters
+from alert_cache import current_data_version
+from alert_matcher import AlertMatcher
+from query_compiler import filter_shape, compile_listings_query
+from get_matching_listings import alert_meta, build_results, filters_from_row
+from new_today import market_date
+
+# Listings per digest, the same as one page of the alerts endpoint
+DIGEST_LIMIT = 500
+
+# Digests written per INSERT. Bodies can be a few hundred KB each
+WRITE_BATCH = 100
+
+DIGEST_DDL = """
+CREATE TABLE IF NOT EXISTS alert_digests (
+    alert_id int NOT NULL,
+    digest_date date NOT NULL,
+    cadence text,
+    data_version bigint,
+    num_results int NOT NULL,
+    body json NOT NULL,
+    created_at timestamptz NOT NULL DEFAULT now(),
+    PRIMARY KEY (alert_id, digest_date)
+);
+"""
+
+ACTIVE_ALERTS_SQL = """
+SELECT * FROM report_recipients
+WHERE active IS TRUE
+AND (%(cadence)s IS NULL OR cadence = %(cadence)s)
+ORDER BY id
+"""
+
+# zip_code isn't in the listing rows, the shared scan needs it for geo filters
+LISTING_ZIPS_SQL = "SELECT mls_number, zip_code FROM listing_meta WHERE active IS TRUE"
+
+# One statement per batch. The rows parameter is a JSON array built with the
+# already serialized bodies spliced in, so they aren't encoded twice
+WRITE_DIGESTS_SQL = """
+INSERT INTO alert_digests (alert_id, digest_date, cadence, data_version, num_results, body)
+SELECT alert_id, digest_date, cadence, data_version, num_results, body
+FROM json_populate_recordset(NULL::alert_digests, %(rows)s)
+ON CONFLICT (alert_id, digest_date) DO UPDATE SET
+    cadence = EXCLUDED.cadence,
+    data_version = EXCLUDED.data_version,
+    num_results = EXCLUDED.num_results,
+    body = EXCLUDED.body,
+    created_at = now()
+"""
+
+# Filters that only look at the listing, not its events. Alerts with
+# nothing else set get the same events and price changes as an unfiltered
+# query, so they are all served from one shared scan
+LISTING_ONLY_FILTERS = {
+    'cities', 'zip_codes', 'counties', 'property_types', 'keywords', 'exclude_keywords',
+    'num_kitchens', 'min_days_on_market', 'max_days_on_market',
+}
+SHARED_SCAN = 'shared'
+
+# Query results by key, filled in before the worker processes fork so they
+# inherit it instead of having rows pickled over to them
+_BATCH = {}
+
+
+def query_key(filters: AlertFilters, params: dict) -> tuple:
+
+    # Alerts with the same key would run exactly the same query
+    frozen = tuple(sorted((k, tuple(v) if isinstance(v, list) else v) for k, v in params.items()))
+    return (filter_shape(filters), frozen)
+
+
+def render_digest(task: tuple) -> tuple[int, int, str]:
+
+    """
+    Scores, orders and serializes one alert's listings. Runs in the worker
+    processes. Returns the alert id, the number of results and the body.
+    """
+
+    row, key, indices = task
+    rows = _BATCH[key]
+    if indices is not None:
+        rows = [rows[i] for i in indices]
+
+    filters = filters_from_row(row)
+
+    # Rows can be shared between alerts, so each alert scores its own copy
+    listings = [dict(x) for x in rows]
+
+    # The shared scan ran without new_min_days
+    if key == SHARED_SCAN and filters.min_days_on_market:
+        for listing in listings:
+            if listing['current_days_on_market'] == filters.min_days_on_market:
+                listing['new'] = True
+
+    results, _ = build_results(listings, filters, DIGEST_LIMIT, use_cursor=False, aggregated=True)
+    body = json_stream.dumps({
+        **alert_meta(row, filters),
+        'num_results': len(results),
+        'results': results,
+    })
+    return row['id'], len(results), body
+
+
+class DigestJob:
+
+    """
+    Builds the listings digest for every active alert on a cadence.
+
+    Alerts that only filter on listing fields are matched against one
+    shared scan of all listings with AlertMatcher. The rest run one query
+    per distinct set of filters, so identical alerts share a query and
+    alerts of the same shape share a prepared statement. Scoring and
+    serialization are fanned out over a process pool, and digests are
+    written to alert_digests in batches.
+    """
+
+    def __init__(
+            self,
+            pool,
+            cadence: str = None,
+            today: datetime.date = None,
+            workers: int = None,
+            write: bool = True,
+    ):
+        self.pool = pool
+        self.cadence = cadence
+        self.today = today or market_date()
+        if not workers:
+            workers = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+        self.workers = workers
+        self.write = write
+        self.stats = {}
+
+    def plan(self, alerts: list[dict]) -> tuple[list[dict], dict]:
+
+        """
+        Splits alerts into those served by the shared scan and the rest
+        grouped by query key, each group with its filters and params.
+        """
+
+        shared = []
+        groups = {}
+        for row in alerts:
+            filters = filters_from_row(row)
+            if set(filter_shape(filters)) <= LISTING_ONLY_FILTERS:
+                shared.append(row)
+                continue
+            query, params = compile_listings_query(
+                filters,
+                page_size=DIGEST_LIMIT,
+                aggregate=True,
+                today=self.today.strftime('%Y-%m-%d'),
+            )
+            group = groups.setdefault(query_key(filters, params), {'query': query, 'params': params, 'alerts': []})
+            group['alerts'].append(row)
+        return shared, groups
+
+    def _shared_scan(self, db, alerts: list[dict]) -> list[tuple]:
+
+        """
+        One unfiltered query for all listing-only alerts, then each alert
+        keeps the listings AlertMatcher routes to it, in the same order and
+        up to the same limit as its own query would.
+        """
+
+        query, params = compile_listings_query(
+            AlertFilters(),
+            page_size=10 ** 9,
+            aggregate=True,
+            today=self.today.strftime('%Y-%m-%d'),
+        )
+        rows = db.query_compiled(query, params)
+        zips = {x['mls_number']: x['zip_code'] for x in db.query(LISTING_ZIPS_SQL)}
+        _BATCH[SHARED_SCAN] = rows
+
+        matcher = AlertMatcher(alerts)
+        indices = {x['id']: [] for x in alerts}
+        for i, row in enumerate(rows):
+            meta = {**row, 'zip_code': zips.get(row['mls_number'])}
+            for alert_id in matcher.match(meta, [row], today=self.today):
+                if len(indices[alert_id]) < DIGEST_LIMIT:
+                    indices[alert_id].append(i)
+
+        return [(x, SHARED_SCAN, indices[x['id']]) for x in alerts]
+
+    def _write(self, db, data_version: int, digests: list[tuple]):
+        if not digests:
+            return
+        digest_date = self.today.strftime('%Y-%m-%d')
+        cadence = json_stream.dumps(self.cadence)
+        parts = [
+            f'{{"alert_id": {alert_id}, "digest_date": "{digest_date}", "cadence": {cadence}, '
+            f'"data_version": {data_version}, "num_results": {num_results}, "body": {body}}}'
+            for alert_id, num_results, body in digests
+        ]
+        db.query(WRITE_DIGESTS_SQL, params={'rows': '[' + ', '.join(parts) + ']'})
+
+    def run(self) -> dict:
+        start = time.perf_counter()
+        _BATCH.clear()
+
+        with self.pool.connection() as db:
+            if self.write:
+                db.query(DIGEST_DDL)
+            data_version = current_data_version(db)
+            alerts = db.query(ACTIVE_ALERTS_SQL, params={'cadence': self.cadence})
+            shared, groups = self.plan(alerts)
+
+            tasks = self._shared_scan(db, shared) if shared else []
+            for key, group in groups.items():
+                _BATCH[key] = db.query_compiled(group['query'], group['params'])
+                tasks.extend((x, key, None) for x in group['alerts'])
+        query_seconds = time.perf_counter() - start
+
+        # Fork after the queries so the workers already have _BATCH
+        render_start = time.perf_counter()
+        if self.workers > 1 and 'fork' in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context('fork')
+            with ProcessPoolExecutor(max_workers=self.workers, mp_context=context) as executor:
+                digests = list(executor.map(render_digest, tasks, chunksize=max(1, len(tasks) // (self.workers * 4))))
+        else:
+            digests = [render_digest(x) for x in tasks]
+        render_seconds = time.perf_counter() - render_start
+
+        write_start = time.perf_counter()
+        if self.write:
+            with self.pool.connection() as db:
+                for i in range(0, len(digests), WRITE_BATCH):
+                    self._write(db, data_version, digests[i:i + WRITE_BATCH])
+        write_seconds = time.perf_counter() - write_start
+
+        total_seconds = time.perf_counter() - start
+        _BATCH.clear()
+        self.digests = digests
+        self.stats = {
+            'alerts': len(tasks),
+            'queries': len(groups) + (1 if shared else 0),
+            'shared_scan_alerts': len(shared),
+            'workers': self.workers,
+            'query_seconds': round(query_seconds, 3),
+            'render_seconds': round(render_seconds, 3),
+            'write_seconds': round(write_seconds, 3),
+            'total_seconds': round(total_seconds, 3),
+            'alerts_per_second': round(len(tasks) / total_seconds, 1) if total_seconds else None,
+        }
+        return self.stats
+
+
+def sequential_digests(pool, alerts: list[dict], today: datetime.date) -> dict:
+
+    """
+    What the per-request path costs: one query and one render per alert,
+    in order. Used as the baseline and to check the batch output.
+    """
+
+    digests = {}
+    with pool.connection() as db:
+        for row in alerts:
+            filters = filters_from_row(row)
+            query, params = compile_listings_query(
+                filters,
+                page_size=DIGEST_LIMIT,
+                aggregate=True,
+                today=today.strftime('%Y-%m-%d'),
+            )
+            results, _ = build_results(db.query_compiled(query, params), filters, DIGEST_LIMIT, False, aggregated=True)
+            digests[row['id']] = json_stream.dumps({
+                **alert_meta(row, filters),
+                'num_results': len(results),
+                'results': results,
+            })
+    return digests
+
+
+def synthetic_alerts(rng, num_alerts: int) -> list[dict]:
+
+    """
+    A mix closer to real alerts than alert_matcher.random_alert alone:
+    a third only filter on area, type or keywords, a fifth reuse one of
+    the benchmark profiles (people pick the same cities and price bands),
+    the rest are random.
+    """
+
+    from synthetic_data import ALERT_PROFILES, CITY_ZIPS, PROPERTY_TYPES
+    from alert_matcher import random_alert
+
+    cities = sorted({x for x, _ in CITY_ZIPS})
+    alerts = []
+    for i in range(num_alerts):
+        draw = rng.random()
+        if draw < 0.33:
+            row = {'cities': rng.sample(cities, rng.randint(1, 3))}
+            if rng.random() < 0.3:
+                row['property_types'] = rng.sample(PROPERTY_TYPES, 2)
+            if rng.random() < 0.2:
+                row['keywords'] = rng.choice(['pool', 'motivated', 'fixer upper, tlc', 'views'])
+        elif draw < 0.53:
+            row = dict(rng.choice(list(ALERT_PROFILES.values())))
+        else:
+            row = random_alert(rng, i + 1)
+        alerts.append({
+            **row,
+            'id': i + 1,
+            'owner_id': 'bench-user',
+            'recipient_email': f'bench+{i + 1}@example.com',
+            'cadence': 'daily',
+            'active': True,
+            'nickname': f'alert-{i + 1}',
+        })
+    return alerts
+
+
+if __name__ == '__main__':
+
+    # python digest_job.py --dsn ... [--cadence daily]
+    #     builds and writes today's digests
+    # python digest_job.py --synthetic [--dsn scratch-db]
+    #     runs against the synthetic benchmark dataset (in fake_db, or
+    #     loaded into a scratch database), checks every digest against the
+    #     per-alert path and reports throughput for both. With --dsn the
+    #     per-alert path is the compiled listing query run on Postgres
+    import random
+    from db_pool import ConnectionPool
+
+    parser = argparse.ArgumentParser(description='Build listing digests for every active alert')
+    parser.add_argument('--dsn')
+    parser.add_argument('--cadence')
+    parser.add_argument('--workers', type=int)
+    parser.add_argument('--synthetic', action='store_true')
+    parser.add_argument('--alerts', type=int, default=200)
+    parser.add_argument('--events', type=int, default=20000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    workers = args.workers
+
+    if not args.synthetic:
+        if not args.dsn:
+            sys.exit('--dsn is required unless running --synthetic')
+        job = DigestJob(ConnectionPool(dsn=args.dsn), cadence=args.cadence, workers=workers)
+        print(job.run())
+        sys.exit(0)
+
+    from fake_db import FakeDatabase, FakeDriver
+    from synthetic_data import generate_dataset, load_postgres
+
+    # Postgres counts days on market from its CURRENT_DATE, the market date
+    dataset = generate_dataset(args.events, seed=args.seed, today=market_date())
+    dataset.report_recipients = synthetic_alerts(random.Random(args.seed), args.alerts)
+    if args.dsn:
+        pool = ConnectionPool(dsn=args.dsn)
+        with pool.connection() as db:
+            load_postgres(db, dataset)
+    else:
+        pool = ConnectionPool(driver=FakeDriver(FakeDatabase(dataset)))
+
+    job = DigestJob(pool, cadence='daily', today=dataset.today, workers=workers)
+    stats = job.run()
+    print(f"batch:      {stats}")
+
+    start = time.perf_counter()
+    expected = sequential_digests(pool, dataset.report_recipients, dataset.today)
+    elapsed = time.perf_counter() - start
+    print(f"sequential: {{'alerts': {len(expected)}, 'total_seconds': {elapsed:.3f}, "
+          f"'alerts_per_second': {len(expected) / elapsed:.1f}}}")
+
+    mismatched = [alert_id for alert_id, _, body in job.digests if expected[alert_id] != body]
+    source = 'Postgres' if args.dsn else 'fake_db'
+    print(f"{len(expected) - len(mismatched)}/{len(expected)} digests match the per-alert path on {source}")
+    sys.exit(1 if mismatched else 0)
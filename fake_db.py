@@ -0,0 +1,370 @@
+from __future__ import annotations
+import re
+import json
+import time
+import datetime
+from synthetic_data import SyntheticDataset, EVENT_COLUMNS, META_COLUMNS
+from field_projection import BASE_COLUMNS
+
+# The images limit from shared_sql_utils.select_list
+IMAGES_LIMIT = re.compile(r"'\$\[0 to (\d+)\]'")
+
+# Range filters from query_compiler.BASE_FILTERS as (param, column, is_min),
+# split by whether they look at the event row or the listing
+EVENT_RANGE_PARAMS = [
+    ('min_price', 'price', True), ('max_price', 'price', False),
+    ('min_sq_ft', 'sq_ft', True), ('max_sq_ft', 'sq_ft', False),
+    ('min_beds', 'beds', True), ('max_beds', 'beds', False),
+    ('min_baths', 'baths', True), ('max_baths', 'baths', False),
+    ('min_year_built', 'year_built', True), ('max_year_built', 'year_built', False),
+    ('min_price_per_sq_ft', 'price_per_sq_ft', True), ('max_price_per_sq_ft', 'price_per_sq_ft', False),
+]
+LISTING_RANGE_PARAMS = [
+    ('num_kitchens', 'num_kitchens', True),
+    ('min_days_on_market', 'current_days_on_market', True),
+    ('max_days_on_market', 'current_days_on_market', False),
+]
+
+
+def in_ranges(row: dict, params: dict, ranges: list[tuple]) -> bool:
+    for param, column, is_min in ranges:
+        if param in params:
+            value = row[column]
+            if value is None or (value < params[param] if is_min else value > params[param]):
+                return False
+    return True
+
+
+def json_number(value):
+
+    # json_agg writes float8 with no fraction as an integer
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+
+def like_to_regex(patterns: list[str]) -> re.Pattern:
+
+    """
+    ILIKE ANY (patterns) as one case-insensitive regex.
+    """
+
+    # ILIKE ANY of an empty array matches nothing
+    if not patterns:
+        return re.compile(r'(?!)')
+
+    parts = []
+    for pattern in patterns:
+        parts.append(''.join('.*' if c == '%' else '.' if c == '_' else re.escape(c) for c in pattern))
+    return re.compile('|'.join(f'(?:{x})' for x in parts), re.IGNORECASE | re.DOTALL)
+
+
+def listing_query_shape(sql: str) -> tuple[bool, list[str] | None, int | None]:
+
+    """
+    Whether a listing query is aggregated, the columns it selects (None
+    for *) and how many images it keeps.
+    """
+
+    # The outer query is the last SELECT in the statement
+    select = sql[sql.rindex('SELECT ') + len('SELECT '):]
+    select = select[:select.index(' FROM ')].strip()
+    columns = None if select == '*' else [x.strip() for x in select.split(',')]
+    limit = IMAGES_LIMIT.search(sql)
+    return 'nested_listings' in sql, columns, int(limit.group(1)) + 1 if limit else None
+
+
+class FakeDatabase:
+
+    """
+    In-memory stand-in for the alerts queries. It answers the
+    report_recipients lookup and the compiled listing query (row or
+    aggregated mode, ilike keywords) by running the same steps as the SQL
+    in Python, so the handler and benchmarks can run without Postgres.
+    """
+
+    def __init__(self, dataset: SyntheticDataset, data_version: int = 0, latency: float = 0.0):
+        self.dataset = dataset
+        self.data_version = data_version
+        self.today = dataset.today
+
+        self.meta = {row[0]: dict(zip(META_COLUMNS, row)) for row in dataset.meta}
+        self.events_by_mls = {}
+        for row in dataset.events:
+            self.events_by_mls.setdefault(row[0], []).append(dict(zip(EVENT_COLUMNS, row)))
+        self.sorted_mls = sorted(self.events_by_mls)
+        self.num_queries = 0
+
+        # Seconds each listing query takes, to make concurrent requests overlap
+        self.latency = latency
+        self.num_listing_queries = 0
+
+        # Rows written by digest_job, and delta_feed's change log
+        self.digests = []
+        self.changes = {}
+
+    def lookup_alert(self, params: dict) -> list[dict]:
+        rows = []
+        for row in self.dataset.report_recipients:
+            if str(row['id']) != str(params['alert_id']):
+                continue
+            if row['owner_id'] == params['user_id'] or row['recipient_email'] == params['email']:
+                rows.append({**row, 'data_version': self.data_version})
+        return rows
+
+    def owner_alerts(self, params: dict) -> list[dict]:
+        rows = [x for x in self.dataset.report_recipients if x['owner_id'] == params['user_id'] and x.get('active')]
+        rows = sorted(rows, key=lambda x: x['id'])[:params['limit']]
+        return [{**x, 'data_version': self.data_version} for x in rows]
+
+    def active_alerts(self, params: dict) -> list[dict]:
+        rows = [x for x in self.dataset.report_recipients if x.get('active')]
+        if params.get('cadence') is not None:
+            rows = [x for x in rows if x.get('cadence') == params['cadence']]
+        return sorted(rows, key=lambda x: x['id'])
+
+    def change_log(self, statement: str, params: dict) -> list[dict] | None:
+
+        # delta_feed's statements against listing_changes
+        if 'bumped' in statement:
+            self.data_version += 1
+            if params['mls_numbers']:
+                self.changes[self.data_version] = set(params['mls_numbers'])
+            return [{'data_version': self.data_version}]
+        if 'oldest_version' in statement:
+            changed = set()
+            for version, mls_numbers in self.changes.items():
+                if version > params['since_version']:
+                    changed |= mls_numbers
+            return [{'oldest_version': min(self.changes, default=None), 'mls_numbers': sorted(changed)}]
+        return None
+
+    def _listing_passes(self, meta: dict, params: dict, keywords, exclude) -> bool:
+        if not in_ranges(meta, params, LISTING_RANGE_PARAMS):
+            return False
+        if 'cities' in params or 'zip_codes' in params:
+            in_city = meta['city'] in params.get('cities', ())
+            in_zip = meta['zip_code'] in params.get('zip_codes', ())
+            if not (in_city or in_zip):
+                return False
+        if 'property_types' in params and meta['property_type'] not in params['property_types']:
+            return False
+        if keywords is not None and not (meta['description'] and keywords.search(meta['description'])):
+            return False
+        if exclude and meta['description'] and exclude.search(meta['description']):
+            return False
+        return True
+
+    def listing_rows(
+            self,
+            params: dict,
+            aggregate: bool = False,
+            columns: list[str] | None = None,
+            max_images: int | None = None,
+    ) -> list[dict]:
+
+        """
+        base_listings -> price_lead -> final_fields (-> nested_listings),
+        then the outer filters, ordering, paging and select list.
+        """
+
+        self.num_listing_queries += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+        if isinstance(params.get('keywords') or params.get('exclude_keywords'), str):
+            raise NotImplementedError('FakeDatabase only supports the ilike keyword mode')
+        keywords = like_to_regex(params['keywords']) if 'keywords' in params else None
+        exclude = like_to_regex(params['exclude_keywords']) if params.get('exclude_keywords') else None
+
+        cursor_mls = params.get('cursor_mls')
+        cursor_date = params.get('cursor_date')
+        offset = params.get('offset', 0)
+        wanted = offset + params['limit'] if 'limit' in params else None
+        since_mls = set(params['since_mls']) if 'since_mls' in params else None
+
+        out = []
+        for mls_number in self.sorted_mls:
+
+            # Rows come out in mls_number order, so stop once the page is full
+            if wanted is not None and len(out) >= wanted:
+                break
+            if since_mls is not None and mls_number not in since_mls:
+                continue
+            if cursor_mls is not None and mls_number < cursor_mls:
+                continue
+
+            meta = self.meta[mls_number]
+            if not meta['active']:
+                continue
+
+            date_listed = datetime.date.fromisoformat(meta['date_listed'])
+            meta = {**meta, 'current_days_on_market': (self.today - date_listed).days}
+            if not self._listing_passes(meta, params, keywords, exclude):
+                continue
+
+            # DISTINCT ON (mls_number, price) keeps the latest event per price
+            by_price = {}
+            for event in self.events_by_mls[mls_number]:
+                if not in_ranges(event, params, EVENT_RANGE_PARAMS):
+                    continue
+                kept = by_price.get(event['price'])
+                if kept is None or event['event_date'] > kept['event_date']:
+                    by_price[event['price']] = {**meta, **event}
+            if not by_price:
+                continue
+
+            # ROW_NUMBER by event_date DESC, LEAD(price) by event_date ASC
+            ordered = sorted(by_price.values(), key=lambda x: x['event_date'])
+            rows = []
+            for i, row in enumerate(ordered):
+                new_price = ordered[i + 1]['price'] if i + 1 < len(ordered) else None
+                out_row = {x: row[x] for x in BASE_COLUMNS}
+                out_row['rn'] = len(ordered) - i
+                out_row['new_price'] = new_price
+                out_row['price_diff'] = new_price - row['price'] if new_price is not None else None
+                rows.append(out_row)
+
+            diffs = [abs(x['price_diff']) for x in rows if x['price_diff'] is not None]
+            biggest_price_drop = max(diffs) if diffs else None
+            for row in rows:
+                row['biggest_price_drop'] = biggest_price_drop
+            rows.reverse()
+
+            if aggregate:
+                rows = [self._nest(rows, params)]
+
+            if 'price_reduction' in params:
+                if biggest_price_drop is None or biggest_price_drop < params['price_reduction']:
+                    continue
+
+            # Rows are already in ORDER BY mls_number, event_date DESC order
+            if mls_number == cursor_mls:
+                rows = [x for x in rows if x['event_date'] < cursor_date]
+            out.extend(rows)
+
+        out = out[offset:wanted]
+        if max_images is not None:
+            for row in out:
+                if row['images'] is not None:
+                    row['images'] = row['images'][:max_images]
+        if columns is not None:
+            out = [{x: row[x] for x in columns} for row in out]
+        return out
+
+    def _nest(self, rows: list[dict], params: dict) -> dict:
+
+        # nested_listings_cte for one listing's final_fields rows
+        listing = dict(next(x for x in rows if x['rn'] == 1))
+        changes = [x for x in rows if x['price_diff'] is not None and x['price_diff'] != 0]
+        listing['events'] = [
+            {
+                'mls_number': x['mls_number'],
+                'event_date': x['event_date'],
+                'new_price': json_number(x['new_price']),
+                'old_price': json_number(x['price']),
+                'price_diff': json_number(x['price_diff']),
+            }
+            for x in sorted(changes, key=lambda x: x['event_date'], reverse=True)
+        ]
+        listing['num_price_drops'] = len([x for x in changes if x['price_diff'] < 0])
+        listing['new'] = (
+            any(x['event_date'][:10] == params.get('today') for x in changes)
+            or listing['current_days_on_market'] == 0
+            or listing['current_days_on_market'] == params.get('new_min_days')
+        )
+        return listing
+
+    def execute(self, sql: str, params: dict | None, prepared: dict) -> list[dict] | None:
+        self.num_queries += 1
+        statement = sql.lstrip()
+        if statement.startswith('PREPARE'):
+            name = statement.split()[1]
+            prepared[name] = listing_query_shape(statement)
+            return None
+        if statement.startswith('EXECUTE'):
+            return self.listing_rows(params, *prepared[statement.split()[1]])
+        if 'report_recipients' in statement:
+            if params and 'alert_id' in params:
+                return self.lookup_alert(params)
+            if params and 'user_id' in params:
+                return self.owner_alerts(params)
+            return self.active_alerts(params or {})
+        if statement.upper().startswith('SELECT 1'):
+            return [{'?column?': 1}]
+        if 'final_fields' in statement:
+            return self.listing_rows(params, *listing_query_shape(statement))
+        if 'listing_changes' in statement:
+            return self.change_log(statement, params)
+        if 'ingestion_state' in statement:
+            return [{'data_version': self.data_version}]
+        if 'alert_digests' in statement:
+            if params and 'rows' in params:
+                self.digests.extend(json.loads(params['rows']))
+            return None
+        if statement.startswith('SELECT mls_number, zip_code FROM listing_meta'):
+            return [{'mls_number': x, 'zip_code': self.meta[x]['zip_code']} for x in self.sorted_mls if self.meta[x]['active']]
+        raise NotImplementedError(f'FakeDatabase cannot run: {statement[:80]}')
+
+
+class FakeCursor:
+
+    def __init__(self, conn: FakeConnection):
+        self.conn = conn
+        self.description = None
+        self._rows = []
+
+    def execute(self, sql: str, params: dict | None = None):
+        if self.conn.closed:
+            raise FakeDriver.InterfaceError('connection already closed')
+        rows = self.conn.db.execute(sql, params, self.conn.prepared)
+        if rows is None:
+            self.description = None
+            self._rows = []
+            return
+        # Rows are dicts that may leave out NULL columns
+        columns = list(rows[0]) if rows else []
+        if any(len(x) != len(columns) for x in rows):
+            columns = list(dict.fromkeys(k for x in rows for k in x))
+        self.description = [(x,) for x in columns]
+        self._rows = [tuple(row.get(x) for x in columns) for row in rows]
+
+    def fetchall(self) -> list[tuple]:
+        return self._rows
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+
+    def __init__(self, db: FakeDatabase):
+        self.db = db
+        self.closed = False
+        self.autocommit = True
+        self.prepared = {}
+
+    def cursor(self) -> FakeCursor:
+        return FakeCursor(self)
+
+    def close(self):
+        self.closed = True
+
+
+class FakeDriver:
+
+    """
+    Looks enough like a DB-API module for db_pool.ConnectionPool(driver=...).
+    """
+
+    class OperationalError(Exception):
+        pass
+
+    class InterfaceError(Exception):
+        pass
+
+    def __init__(self, db: FakeDatabase):
+        self.db = db
+
+    def connect(self, dsn: str = '', **options) -> FakeConnection:
+        return FakeConnection(self.db)
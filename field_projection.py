@@ -0,0 +1,114 @@
+from __future__ import annotations
+from row_records import Record, project
+
+# Columns of base_listings, the same for every query mode
+BASE_COLUMNS = (
+    'mls_number', 'date_listed', 'price', 'event_date', 'beds', 'baths', 'street_address',
+    'city', 'sq_ft', 'year_built', 'price_per_sq_ft', 'images', 'property_type',
+    'seller_motivation', 'num_kitchens', 'status', 'days_on_market', 'description', 'url',
+    'active', 'current_days_on_market',
+)
+
+# What final_fields adds in row mode, and nested_listings on top of that
+ROW_COLUMNS = BASE_COLUMNS + ('rn', 'new_price', 'price_diff', 'biggest_price_drop')
+AGGREGATED_COLUMNS = ROW_COLUMNS + ('events', 'num_price_drops', 'new')
+
+# Fields a listing in the response can have
+LISTING_FIELDS = ROW_COLUMNS + ('events', 'new', 'seller_motivation_score')
+
+# Selected whatever the fields: ordering and cursors, the price change
+# window functions, the active check, and the 'new' flag and motivation
+# score. nest_events also needs the raw price change rows, the aggregated
+# modes the nested events and drop counts
+REQUIRED_COLUMNS = ('mls_number', 'price', 'event_date', 'active', 'current_days_on_market', 'seller_motivation')
+REQUIRED_ROW_COLUMNS = ('rn', 'new_price', 'price_diff')
+REQUIRED_AGGREGATED_COLUMNS = ('events', 'num_price_drops', 'new')
+
+
+class InvalidFields(ValueError):
+    pass
+
+
+class Projection:
+
+    """
+    Which listing fields a response carries. fields None means all of
+    them. max_images keeps only the first few image URLs.
+    """
+
+    def __init__(self, fields: tuple[str, ...] | None = None, max_images: int | None = None):
+        self.fields = fields
+        self.max_images = max_images
+
+    @property
+    def key(self) -> tuple | None:
+
+        # Part of the result cache key
+        if self.fields is None and self.max_images is None:
+            return None
+        return self.fields, self.max_images
+
+    def columns(self, aggregated: bool) -> tuple[str, ...] | None:
+
+        """
+        Columns the listing query has to select, in select order. None
+        selects everything.
+        """
+
+        if self.fields is None:
+            return None
+        if aggregated:
+            available, required = AGGREGATED_COLUMNS, REQUIRED_AGGREGATED_COLUMNS
+        else:
+            available, required = ROW_COLUMNS, REQUIRED_ROW_COLUMNS
+        wanted = set(self.fields) | set(REQUIRED_COLUMNS) | set(required)
+        return tuple(x for x in available if x in wanted)
+
+    def apply(self, listings: list[dict]) -> list[dict]:
+        if self.fields is None:
+            return listings
+
+        # Records project a whole page at once
+        if listings and isinstance(listings[0], Record):
+            return project(listings, self.fields)
+        return [{k: x[k] for k in self.fields if k in x} for x in listings]
+
+    def __repr__(self):
+        return f'Projection - {self.fields}'
+
+
+# Named field sets. card is what HomeProfileCard renders: only the first
+# image is shown, and events feed the price changes dialog
+FIELD_PROFILES = {
+    'full': Projection(),
+    'card': Projection(
+        fields=(
+            'mls_number', 'price', 'price_per_sq_ft', 'street_address', 'city', 'beds', 'baths',
+            'sq_ft', 'num_kitchens', 'year_built', 'current_days_on_market', 'images', 'events',
+            'new', 'seller_motivation_score',
+        ),
+        max_images=1,
+    ),
+}
+
+
+def parse_fields(value: str | None) -> Projection:
+
+    """
+    The fields query parameter: a profile name from FIELD_PROFILES or a
+    comma separated list of LISTING_FIELDS. mls_number always comes back.
+    """
+
+    if not value:
+        return FIELD_PROFILES['full']
+    if value in FIELD_PROFILES:
+        return FIELD_PROFILES[value]
+
+    names = [x.strip() for x in value.split(',') if x.strip()]
+    unknown = [x for x in names if x not in LISTING_FIELDS]
+    if unknown:
+        raise InvalidFields(f"Unknown fields: {', '.join(unknown)}")
+
+    # Keep the response order stable whatever order they were asked in
+    wanted = set(names) | {'mls_number'}
+    return Projection(fields=tuple(x for x in LISTING_FIELDS if x in wanted))
@@ -0,0 +1,155 @@
+from __future__ import annotations
+import os
+import csv
+from functools import lru_cache
+
+# Bundled zip -> city -> county -> state table, every Utah zip USPS has
+# issued including PO box and unique ones. Counties are matched through
+# their zip codes, so this only needs updating when USPS adds or moves a
+# zip: python geography.py --build
+GEO_DATA_PATH = os.environ.get(
+    'ALERTS_GEO_DATA',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'utah_zip_codes.csv'),
+)
+
+
+def normalize_county(name: str) -> str:
+
+    """
+    'Salt Lake County', 'salt lake' and ' Salt Lake ' are the same county.
+    """
+
+    name = ' '.join(name.split()).lower()
+    if name.endswith(' county'):
+        name = name[:-len(' county')]
+    return name
+
+
+class Geography:
+
+    """
+    Lookups over the zip table, built once per process by load_geography.
+    """
+
+    def __init__(self, rows: list[dict]):
+        self.city_by_zip = {}
+        self.county_by_zip = {}
+        self.state_by_zip = {}
+        self.zips_by_county = {}
+        for row in rows:
+            zip_code = row['zip_code']
+            self.city_by_zip[zip_code] = row['city']
+            self.county_by_zip[zip_code] = row['county']
+            self.state_by_zip[zip_code] = row['state']
+            self.zips_by_county.setdefault(normalize_county(row['county']), []).append(zip_code)
+
+    def county_zips(self, counties: list[str]) -> list[str]:
+
+        """
+        Every zip code in the counties. Unknown counties have none, so an
+        alert on only those matches nothing rather than everything.
+        """
+
+        zips = set()
+        for county in counties or []:
+            zips.update(self.zips_by_county.get(normalize_county(county), []))
+        return sorted(zips)
+
+    def __repr__(self):
+        return f'Geography - {len(self.county_by_zip)} zips, {len(self.zips_by_county)} counties'
+
+
+@lru_cache(maxsize=None)
+def load_geography(path: str = GEO_DATA_PATH) -> Geography:
+    with open(path, newline='') as f:
+        return Geography(list(csv.DictReader(f)))
+
+
+def build_table(path: str = GEO_DATA_PATH, state: str = 'UT') -> int:
+
+    """
+    Rewrites the table from the USPS zip data the zipcodes package ships,
+    which has each zip's primary city and county. Only needed to build
+    it, so the package isn't a dependency of the Lambda.
+    """
+
+    import zipcodes
+
+    rows = []
+    for x in zipcodes.filter_by(state=state):
+        # Listing feeds write St. George, USPS Saint George
+        city = x['city'].replace('Saint ', 'St. ')
+        county = x['county'][:-len(' County')] if x['county'].endswith(' County') else x['county']
+        rows.append({'zip_code': x['zip_code'], 'city': city, 'county': county, 'state': x['state']})
+    rows.sort(key=lambda x: x['zip_code'])
+
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=['zip_code', 'city', 'county', 'state'], lineterminator='\n')
+        writer.writeheader()
+        writer.writerows(rows)
+    load_geography.cache_clear()
+    return len(rows)
+
+
+def geo_zip_codes(zip_codes: list[str] | None, counties: list[str] | None) -> list[str]:
+
+    """
+    The alert's zip codes plus those of its counties, deduplicated, for
+    one zip_code = ANY (...) predicate.
+    """
+
+    zips = set(zip_codes or [])
+    if counties:
+        zips.update(load_geography().county_zips(counties))
+    return sorted(zips)
+
+
+if __name__ == '__main__':
+
+    # python geography.py
+    #     offline checks against the bundled table
+    # python geography.py --build
+    #     rebuilds the table first, needs pip install zipcodes
+    # python geography.py --dsn ...
+    #     also checks every zip in listing_meta has a county
+    import time
+    import argparse
+    from synthetic_data import CITY_ZIPS
+
+    parser = argparse.ArgumentParser(description='Check the bundled zip table')
+    parser.add_argument('--build', action='store_true')
+    parser.add_argument('--dsn')
+    args = parser.parse_args()
+
+    if args.build:
+        print(f'{build_table()} zips written to {GEO_DATA_PATH}')
+
+    start = time.perf_counter()
+    geography = load_geography()
+    load_ms = (time.perf_counter() - start) * 1000
+    assert load_geography() is geography
+    print(f'{geography} loaded in {load_ms:.2f}ms')
+
+    # Utah's 29 counties, and every zip the synthetic data uses
+    assert len(geography.zips_by_county) == 29
+    assert set(geography.state_by_zip.values()) == {'UT'}
+    for city, zip_code in CITY_ZIPS:
+        assert geography.city_by_zip[zip_code] == city, (city, zip_code)
+
+    assert geography.county_by_zip['84601'] == 'Utah'
+    assert geography.county_by_zip['84101'] == 'Salt Lake'
+    assert geo_zip_codes(None, ['Salt Lake County']) == geo_zip_codes(None, [' salt  lake'])
+    assert geo_zip_codes(['84101'], ['Salt Lake']) == geo_zip_codes(None, ['Salt Lake'])
+    assert geo_zip_codes(['99999'], ['Nowhere']) == ['99999']
+    assert geo_zip_codes(None, ['Nowhere']) == []
+    assert set(geo_zip_codes(None, ['Utah'])) >= {'84601', '84604', '84057', '84058', '84043', '84059'}
+    print('lookups: ok')
+
+    # A listing whose zip isn't in the table drops out of county alerts
+    if args.dsn:
+        from db_pool import ConnectionPool
+        with ConnectionPool(dsn=args.dsn).connection() as db:
+            rows = db.query("SELECT zip_code, COUNT(*) AS n FROM listing_meta WHERE zip_code IS NOT NULL GROUP BY zip_code")
+        missing = {x['zip_code']: x['n'] for x in rows if x['zip_code'] not in geography.county_by_zip}
+        assert not missing, f'zips without a county: {missing}'
+        print(f'listing_meta: all {len(rows)} zips have a county')
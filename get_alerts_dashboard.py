@@ -0,0 +1,272 @@
+from __future__ import annotations
+import os
+import asyncio
+import get_matching_listings
+from db_pool import POOL, MAX_POOL_SIZE
+from alert_models import GoodApiResponse
+from query_compiler import OWNER_ALERTS_SQL
+from alert_cache import RESULT_CACHE, query_with_version
+from instrumentation import RequestTrace
+from single_flight import IN_FLIGHT
+from field_projection import InvalidFields, parse_fields
+from delta_feed import etag_matches, make_etag
+
+# Most alerts one dashboard loads, oldest first
+MAX_DASHBOARD_ALERTS = int(os.environ.get('DASHBOARD_MAX_ALERTS', 25))
+
+# Listing queries in flight at once, each on its own pooled connection
+DASHBOARD_CONCURRENCY = int(os.environ.get('DASHBOARD_CONCURRENCY', MAX_POOL_SIZE))
+
+# The dashboard renders HomeProfileCards
+DEFAULT_FIELDS = 'card'
+
+def handler(event: dict, context=None) -> dict:
+
+    """
+    /dashboard?user_id={}&fields={}
+    GetAlertsDashboard
+
+    The first page of every active alert the user owns, in one response,
+    instead of one GetMatchingListings call per alert. Each listing is
+    sent once, in listings keyed by mls_number; each alert lists its
+    results in order as mls_number and its own 'new' flag, plus the whole
+    listing when its version differs from the shared one. fields works as
+    in GetMatchingListings, card by default, and has to keep mls_number.
+
+    The alerts are read with one query and their listing queries run
+    concurrently. Pages are cached under the same keys GetMatchingListings
+    uses, so opening an alert from the dashboard is a cache hit.
+    """
+
+    trace = RequestTrace('GetAlertsDashboard', request_id=getattr(context, 'aws_request_id', None))
+
+    try:
+
+        query_params = event.get('queryStringParameters') or {}
+        user_id = query_params.get('user_id')
+        page_size = 500
+        today = get_matching_listings.current_day()
+        trace.set('fields', query_params.get('fields') or DEFAULT_FIELDS)
+
+        try:
+            projection = parse_fields(query_params.get('fields') or DEFAULT_FIELDS)
+            if projection.fields is not None and 'mls_number' not in projection.fields:
+                raise InvalidFields('fields has to include mls_number')
+        except InvalidFields as e:
+            res = GoodApiResponse(
+                status_code=400,
+                body={'err': str(e)}
+            )
+            return trace.respond(res)
+
+        if not user_id:
+            res = GoodApiResponse(
+                status_code=400,
+                body={'err': 'user_id is required'}
+            )
+            return trace.respond(res)
+
+        with POOL.connection() as db:
+            with trace.span('filter_lookup'):
+                rows = query_with_version(db, OWNER_ALERTS_SQL, {'user_id': user_id, 'limit': MAX_DASHBOARD_ALERTS})
+            trace.set('connect_ms', round(db.connect_ms, 1))
+            trace.set('warm', db.warm)
+
+        data_version = (rows[0].get('data_version') if rows else None) or 0
+        trace.set('data_version', data_version)
+        trace.count('alerts', len(rows))
+
+        with trace.span('parse_filters'):
+            alerts = []
+            for row in rows:
+                filters = get_matching_listings.filters_from_row(row)
+                key = get_matching_listings.results_key(filters, data_version, today, page_size=page_size, projection=projection)
+                alerts.append((row, filters, key))
+
+        # One ETag over every alert's page and the alert fields shown with it
+        etag = make_etag(
+            '|'.join(key for _, _, key in alerts) or f'dashboard:{user_id}:{data_version}',
+            [get_matching_listings.alert_meta(row, filters) for row, filters, _ in alerts],
+        )
+        request_headers = {k.lower(): v for k, v in (event.get('headers') or {}).items()}
+        if etag_matches(request_headers.get('if-none-match'), etag):
+            trace.set('cache', 'not_modified')
+            res = GoodApiResponse(status_code=304, body=None, headers={'ETag': etag})
+            return trace.respond(res)
+
+        with trace.span('cache_get'):
+            RESULT_CACHE.observe_version(data_version)
+            pages = {key: RESULT_CACHE.get(key) for _, _, key in alerts}
+        missing = [(filters, key) for _, filters, key in alerts if pages[key] is None]
+        trace.count('cache_hits', len(pages) - len(missing))
+
+        if missing:
+            with trace.span('listing_queries'):
+                loaded = asyncio.run(load_pages(missing, data_version, today, page_size, projection, trace))
+            pages.update(zip([key for _, key in missing], loaded))
+
+        with trace.span('combine'):
+            final_obj = combine_pages(user_id, [(row, filters, pages[key]) for row, filters, key in alerts])
+        trace.count('num_results', final_obj['num_listings'])
+
+        res = GoodApiResponse(
+            status_code=200,
+            body=final_obj,
+            headers={'ETag': etag},
+            accept_encoding=request_headers.get('accept-encoding', ''),
+        )
+
+    except Exception as e:
+
+        trace.error(e)
+        res = GoodApiResponse(
+            status_code=500,
+            body={'err': str(e)}
+        )
+
+    return trace.respond(res)
+
+
+async def load_pages(
+        missing: list[tuple],
+        data_version: int,
+        today: str,
+        page_size: int,
+        projection,
+        trace: RequestTrace,
+) -> list[dict]:
+
+    """
+    fetch_results for each (filters, key), at most DASHBOARD_CONCURRENCY
+    at a time. psycopg2 blocks, so each query runs in a worker thread on
+    its own pooled connection; identical alerts share one run through
+    IN_FLIGHT. Returns the pages in order.
+    """
+
+    limit = asyncio.Semaphore(DASHBOARD_CONCURRENCY)
+    shared = RESULT_CACHE.shared.get if RESULT_CACHE.shared is not None else None
+
+    def load(filters, key: str, alert_trace: RequestTrace) -> dict:
+
+        def fetch() -> dict:
+            with POOL.connection() as db:
+                results = get_matching_listings.fetch_results(
+                    db,
+                    filters,
+                    data_version,
+                    today,
+                    alert_trace,
+                    page_size=page_size,
+                    projection=projection,
+                )
+            RESULT_CACHE.set(key, results)
+            return results
+
+        return IN_FLIGHT.do(key, fetch, lookup=shared)[0]
+
+    async def run(filters, key: str) -> tuple[dict, RequestTrace]:
+
+        # Worker threads time into their own trace, merged once done
+        alert_trace = RequestTrace('GetAlertsDashboard', enabled=trace.enabled, profile_sample_rate=0, emit=lambda line: None)
+        async with limit:
+            page = await asyncio.to_thread(load, filters, key, alert_trace)
+        return page, alert_trace
+
+    done = await asyncio.gather(*(run(filters, key) for filters, key in missing))
+    for _, alert_trace in done:
+        trace.merge(alert_trace)
+    return [page for page, _ in done]
+
+
+def combine_pages(user_id: str, alerts: list[tuple[dict, object, dict]]) -> dict:
+
+    """
+    The response body from (report_recipients row, filters, page) per
+    alert. Listings that show up in several alerts are sent once; 'new'
+    depends on the alert, so it stays with the alert's results.
+    """
+
+    listings = {}
+    alert_objs = []
+    for row, filters, page in alerts:
+        results = []
+        for listing in page['results']:
+            mls_number = listing['mls_number']
+            body = {k: v for k, v in listing.items() if k != 'new'}
+            shared = listings.setdefault(mls_number, body)
+            ref = {'mls_number': mls_number, 'new': listing.get('new')}
+
+            # Row mode nests only the events that passed the alert's
+            # filters, so two alerts can see one listing differently
+            if shared is not body and shared != body:
+                ref['listing'] = body
+            results.append(ref)
+        alert_objs.append({
+            **get_matching_listings.alert_meta(row, filters),
+            'num_results': len(results),
+            'results': results,
+        })
+
+    return {
+        'owner_id': user_id,
+        'num_alerts': len(alert_objs),
+        'alerts': alert_objs,
+        'num_listings': len(listings),
+        'listings': listings,
+    }
+
+
+if __name__ == '__main__':
+
+    # Dashboard against one GetMatchingListings call per alert, on the
+    # in-memory fake with some query latency so the overlap shows
+    import json
+    import time
+    import instrumentation
+    from db_pool import ConnectionPool
+    from fake_db import FakeDatabase, FakeDriver
+    from synthetic_data import BENCH_OWNER_ID, generate_dataset
+
+    dataset = generate_dataset(20000, seed=0)
+    POOL = get_matching_listings.POOL = ConnectionPool(driver=FakeDriver(FakeDatabase(dataset, latency=0.05)))
+    instrumentation.EMIT = lambda line: None
+
+    def call(fn, event: dict) -> dict:
+        res = fn(event)
+        assert res['statusCode'] == 200, res['body'][:200]
+        return json.loads(res['body'])
+
+    RESULT_CACHE.local.clear()
+    start = time.perf_counter()
+    separate = {
+        x['id']: call(get_matching_listings.handler, {
+            'queryStringParameters': {'user_id': BENCH_OWNER_ID, 'email': None, 'fields': 'card'},
+            'pathParameters': {'alert_id': str(x['id'])},
+        })
+        for x in dataset.report_recipients
+    }
+    separate_ms = (time.perf_counter() - start) * 1000
+
+    RESULT_CACHE.local.clear()
+    start = time.perf_counter()
+    body = call(handler, {'queryStringParameters': {'user_id': BENCH_OWNER_ID}})
+    dashboard_ms = (time.perf_counter() - start) * 1000
+
+    # Same listings per alert, in the same order, each sent once
+    for alert in body['alerts']:
+        expected = separate[alert['filter_id']]['results']
+        assert [x['mls_number'] for x in alert['results']] == [x['mls_number'] for x in expected]
+        for ref, listing in zip(alert['results'], expected):
+            assert ref['new'] == listing['new']
+            shared = ref.get('listing', body['listings'][ref['mls_number']])
+            assert shared == {k: v for k, v in listing.items() if k != 'new'}
+
+    # Everything is cached now, for the dashboard and the alert pages
+    start = time.perf_counter()
+    call(handler, {'queryStringParameters': {'user_id': BENCH_OWNER_ID}})
+    cached_ms = (time.perf_counter() - start) * 1000
+
+    total = sum(x['num_results'] for x in body['alerts'])
+    own = sum('listing' in x for alert in body['alerts'] for x in alert['results'])
+    print(f"{body['num_alerts']} alerts, {total} results, {body['num_listings']} distinct listings, {own} sent per alert")
+    print(f'{len(separate)} separate calls {separate_ms:.0f}ms, dashboard {dashboard_ms:.0f}ms, cached {cached_ms:.1f}ms')
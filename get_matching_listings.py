@@ -1,26 +1,102 @@
 from __future__ import annotations
-import datetime
-from postgres_utils import query_postgres_sql
-from umc_models import AlertFilters, GoodApiResponse, SellerMotivationScore
-from shared_sql_utils import (
-    base_listings_cte,
-    price_lead_cte,
-    final_agg_cte
+import os
+import compact_rows
+from db_pool import POOL, ResultColumns, ResultRows
+from alert_models import AlertFilters, GoodApiResponse
+from query_compiler import FILTER_LOOKUP_SQL, compile_listings_query
+from pagination import InvalidCursor, decode_cursor, trim_partial_listing, next_listing_cursor
+from alert_cache import RESULT_CACHE, cache_key, query_with_version
+from instrumentation import RequestTrace
+from single_flight import IN_FLIGHT
+from field_projection import InvalidFields, Projection, parse_fields
+from market_stats import listing_comparables
+from new_today import NEW_TODAY, index_applies, market_today
+from seller_motivation import seller_motivation_score
+from delta_feed import (
+    MAX_DELTA_LISTINGS,
+    InvalidSince,
+    changed_since,
+    decode_since,
+    encode_since,
+    etag_matches,
+    make_etag,
 )
 
-TODAY = datetime.datetime.now().date().strftime('%Y-%m-%d')
+# Pins the date for benchmarks and replaying a day. None follows the
+# market's calendar, read per request so warm workers roll over at midnight
+TODAY = None
+
+# Nest events and count price drops in SQL, one row per listing, instead
+# of folding one row per event back together in nest_events
+AGGREGATE_IN_SQL = os.environ.get('ALERTS_AGGREGATE_IN_SQL') == '1'
+
+# Read those listing rows straight from listing_current_state, which
+# ingestion keeps up to date, instead of running the window functions
+QUERY_SOURCE = 'state' if os.environ.get('ALERTS_USE_LISTING_STATE') == '1' else 'events'
+
+# Fetch the listing rows as columns and nest and score them with numpy,
+# see columnar. Row mode only, see use_columnar: aggregated rows come out
+# of SQL with little left to vectorize, and are slower as columns
+COLUMNAR_RESULTS = os.environ.get('ALERTS_COLUMNAR') == '1'
+
+# Take row mode 'new' flags from listing_new_days, which ingestion keeps
+# up to date, instead of checking the date of every event returned
+NEW_TODAY_INDEX = os.environ.get('ALERTS_NEW_TODAY_INDEX') == '1'
+
+# Keep result rows as tuples with their field names held once per schema,
+# see compact_rows, instead of a dict per listing and per event. Cached
+# pages take about half the memory and serialize to the same JSON.
+# ALERTS_COLUMNAR takes precedence in row mode
+COMPACT_ROWS = os.environ.get('ALERTS_COMPACT_ROWS') == '1'
+
+def use_columnar() -> bool:
+
+    """
+    COLUMNAR_RESULTS for the configured query mode, which it only speeds
+    up in row mode.
+    """
+
+    return COLUMNAR_RESULTS and not (AGGREGATE_IN_SQL or QUERY_SOURCE == 'state')
+
+def current_day() -> str:
+    return TODAY or market_today()
 
 def handler(event: dict, context=None) -> list[dict] | dict:
 
     """
     /alerts/{alert_id}?user_id={}&email={}&page={}
+    /alerts/{alert_id}?user_id={}&email={}&cursor={}
+    /alerts/{alert_id}?user_id={}&email={}&since={}
+    /alerts/{alert_id}?user_id={}&email={}&fields={}
+    /alerts/{alert_id}?user_id={}&email={}&comparables=1
     GetMatchingListings
 
     Gets listings that match given alert filters. Assign
     seller motivation scores, and mark new listings. Organize all
     price change events under each listing.
+
+    Passing cursor (empty for the first page) switches to keyset paging,
+    which stays fast on deep pages; follow next_cursor in the response
+    until it is null. page is still supported for older clients.
+
+    Passing since (empty on the first fetch) adds next_since to the
+    response. Sending that token back returns only the matching listings
+    that changed after it, plus the mls_numbers of changed listings that
+    no longer match in removed. delta is false when a full set had to be
+    sent instead, e.g. for a token from an earlier day. Every 200 carries
+    an ETag, and If-None-Match with it gets a 304 until the data changes.
+
+    fields is a profile name, e.g. card for HomeProfileCard, or a comma
+    separated list of listing fields; columns nothing asks for aren't
+    selected. Bodies are gzip or br compressed when Accept-Encoding allows.
+
+    comparables=1 adds each listing's zip code medians from the market
+    stats cube, and its price per sq ft against the zip median.
     """
 
+    # Stage timings and counters, logged as one line when the request ends
+    trace = RequestTrace('GetMatchingListings', request_id=getattr(context, 'aws_request_id', None))
+
     # Wrap whole function in try catch for debugging
     try:
 
@@ -33,86 +109,139 @@ def handler(event: dict, context=None) -> list[dict] | dict:
         email = query_params.get('email')
         page = int(query_params.get('page', 1))
         page_size = 500
-
-        # Get alert filters for given alert id. Use email if needed
-        # when the user is coming from an email referral
-        sql = f"""select * from report_recipients where id = {alert_id}
-              and (owner_id = '{user_id}' or recipient_email = '{email}')
-              """
-        filters = query_postgres_sql(sql, return_dataframe=False)
-
-        # Account for missing filters, possible edge case.
-        if not filters:
+        trace.set('alert_id', alert_id)
+        trace.set('paging', 'cursor' if 'cursor' in query_params else 'page')
+        trace.set('fields', query_params.get('fields') or 'full')
+        use_comparables = query_params.get('comparables') in ('1', 'true')
+        today = current_day()
+
+        # Keyset paging when a cursor is passed, even an empty one, and
+        # delta responses when since is
+        use_cursor = 'cursor' in query_params
+        use_since = 'since' in query_params
+        since_version = None
+        try:
+            projection = parse_fields(query_params.get('fields'))
+            cursor = decode_cursor(query_params['cursor']) if query_params.get('cursor') else None
+            if query_params.get('since'):
+                since_version, since_date = decode_since(query_params['since'])
+
+                # Days on market and 'new' move with the date, so a token
+                # from another day can't be answered with a delta
+                if since_date != today:
+                    since_version = None
+        except (InvalidCursor, InvalidSince, InvalidFields) as e:
             res = GoodApiResponse(
-                status_code=404,
-                body={'err': 'No alert found with given id'}
+                status_code=400,
+                body={'err': str(e)}
             )
-            return res.get_response()
-
-        # Create AlertFilter object for data validation and type checking
-        base_filters = filters[0]
-        filters = AlertFilters(
-            min_price=base_filters.get('min_price'),
-            max_price=base_filters.get('max_price'),
-            min_sq_ft=base_filters.get('min_sq_ft'),
-            max_sq_ft=base_filters.get('max_sq_ft'),
-            min_beds=base_filters.get('min_beds'),
-            max_beds=base_filters.get('max_beds'),
-            min_baths=base_filters.get('min_baths'),
-            max_baths=base_filters.get('max_baths'),
-            min_year_built=base_filters.get('min_year_built'),
-            max_year_built=base_filters.get('max_year_built'),
-            min_days_on_market=base_filters.get('min_days_on_market'),
-            max_days_on_market=base_filters.get('max_days_on_market'),
-            min_price_per_sq_ft=base_filters.get('min_price_per_sq_ft'),
-            max_price_per_sq_ft=base_filters.get('max_price_per_sq_ft'),
-            price_reduction=base_filters.get('price_reduction'),
-            cities=base_filters.get('cities'),
-            zip_codes=base_filters.get('zip_codes'),
-            counties=base_filters.get('counties'),
-            entire_state=base_filters.get('entire_state'),
-            property_types=base_filters.get('property_types'),
-            seller_motivation_scores=base_filters.get('seller_motivation_scores'),
-            keywords=base_filters.get('keywords'),
-            enhance_keywords=base_filters.get('enhance_keywords'),
-            exlucde_keywords=base_filters.get('exclude_keywords'),
-            num_kitchens=base_filters.get('num_kitchens'),
-        )
-
-        # Build metadata to add into response later
-        filter_meta = {
-            'filter_id': base_filters.get('id'),
-            'owner_id': base_filters.get('owner_id'),
-            'recipient_email': base_filters.get('recipient_email'),
-            'owner_email': base_filters.get('owner_email'),
-            'nickname': base_filters.get('nickname'),
-            **filters.__dict__
-        }
-
-        # Build sql query with shared sql functions
-        sql = f"""
-        {base_listings_cte(filters)},
-        {price_lead_cte()},
-        {final_agg_cte()}
-        SELECT * FROM final_fields
-        WHERE active IS TRUE
-        {f"AND biggest_price_drop >= {filters.price_reduction}" if filters.price_reduction else ""}
-        {f"OFFSET {(page - 1) * page_size} LIMIT {page_size}"};
-        """
-
-        # Grab the listings
-        data = query_postgres_sql(sql, return_dataframe=False)
-
-        # Print out sql to use for debugging
-        print(sql)
-
-        # Nest price change events within each listing
-        data = nest_events(data, min_days_on_market=filters.min_days_on_market)
-
-        # Put the 'new' items in data at the start, otherwise keep the same order
-        new_items = [x for x in data if x['new'] is True]
-        old_items = [x for x in data if x['new'] is False]
-        data = new_items + old_items
+            return trace.respond(res)
+
+        # Both queries share one pooled connection, which stays open
+        # between warm invocations
+        with POOL.connection() as db:
+
+            # Get alert filters for given alert id. Use email if needed
+            # when the user is coming from an email referral
+            with trace.span('filter_lookup'):
+                filters = query_with_version(
+                    db,
+                    FILTER_LOOKUP_SQL,
+                    {'alert_id': alert_id, 'user_id': user_id, 'email': email},
+                )
+            trace.set('connect_ms', round(db.connect_ms, 1))
+            trace.set('warm', db.warm)
+
+            # Account for missing filters, possible edge case.
+            if not filters:
+                res = GoodApiResponse(
+                    status_code=404,
+                    body={'err': 'No alert found with given id'}
+                )
+                return trace.respond(res)
+
+            # Create AlertFilter object for data validation and type checking
+            base_filters = filters[0]
+            with trace.span('parse_filters'):
+                filters = filters_from_row(base_filters)
+
+            # Build metadata to add into response later
+            filter_meta = alert_meta(base_filters, filters)
+
+            # Results only change when ingestion bumps the data version,
+            # which comes back with the filter lookup
+            data_version = base_filters.get('data_version') or 0
+            trace.set('data_version', data_version)
+            with trace.span('cache_get'):
+                RESULT_CACHE.observe_version(data_version)
+                key = results_key(
+                    filters,
+                    data_version,
+                    today,
+                    page=None if use_cursor else page,
+                    cursor=query_params.get('cursor') if use_cursor else None,
+                    page_size=page_size,
+                    since_version=since_version,
+                    projection=projection,
+                    use_comparables=use_comparables,
+                )
+
+            # The client already has this exact response
+            etag = make_etag(key, filter_meta)
+            request_headers = {k.lower(): v for k, v in (event.get('headers') or {}).items()}
+            if etag_matches(request_headers.get('if-none-match'), etag):
+                trace.set('cache', 'not_modified')
+                res = GoodApiResponse(status_code=304, body=None, headers={'ETag': etag})
+                return trace.respond(res)
+
+            with trace.span('cache_get'):
+                cached = RESULT_CACHE.get(key)
+            trace.set('cache', 'miss' if cached is None else 'hit')
+
+            if cached is None:
+
+                def load_results() -> dict:
+
+                    # Listings changed after the since token. None means send
+                    # everything: no token, the change log doesn't go back that
+                    # far, or so much changed that a delta wouldn't be smaller
+                    delta_mls = None
+                    if since_version is not None and since_version >= data_version:
+                        delta_mls = []
+                    elif since_version is not None:
+                        with trace.span('changed_since'):
+                            delta_mls = changed_since(db, since_version)
+                        if delta_mls is not None and len(delta_mls) > MAX_DELTA_LISTINGS:
+                            delta_mls = None
+                    if use_since:
+                        trace.set('delta', delta_mls is not None)
+
+                    results = fetch_results(
+                        db,
+                        filters,
+                        data_version,
+                        today,
+                        trace,
+                        page=page,
+                        page_size=page_size,
+                        use_cursor=use_cursor,
+                        cursor=cursor,
+                        delta_mls=delta_mls,
+                        projection=projection,
+                        use_comparables=use_comparables,
+                    )
+                    RESULT_CACHE.set(key, results)
+                    return results
+
+                # Identical requests arriving together, e.g. everyone opening
+                # the same digest email, share one run of the listing query.
+                # Other workers' results turn up in the shared cache
+                shared = RESULT_CACHE.shared.get if RESULT_CACHE.shared is not None else None
+                cached, flight = IN_FLIGHT.do(key, load_results, lookup=shared)
+                trace.set('flight', flight)
+
+        data = cached['results']
+        trace.count('num_results', len(data))
 
         # Combine metadata with results for the final object
         final_obj = {
@@ -120,110 +249,338 @@ def handler(event: dict, context=None) -> list[dict] | dict:
             'num_results': len(data),
             'results': data,
         }
+        if use_cursor and not cached['delta']:
+            final_obj['next_cursor'] = cached['next_cursor']
+        if use_since:
+            final_obj['delta'] = cached['delta']
+            if cached['delta']:
+                final_obj['removed'] = cached['removed']
+            final_obj['next_since'] = encode_since(data_version, today)
 
         res = GoodApiResponse(
             status_code=200,
             body=final_obj,
+            headers={'ETag': etag},
+            accept_encoding=request_headers.get('accept-encoding', ''),
         )
 
     except Exception as e:
 
+        # Keep the traceback in the request's log line
+        trace.error(e)
         res = GoodApiResponse(
             status_code=500,
             body={'err': str(e)}
         )
 
 
-    return res.get_response()
+    return trace.respond(res)
+
+
+def results_key(
+        filters: AlertFilters,
+        data_version: int,
+        today: str,
+        page: int | None = 1,
+        cursor: str | None = None,
+        page_size: int = 500,
+        since_version: int | None = None,
+        projection: Projection = None,
+        use_comparables: bool = False,
+) -> str:
+
+    """
+    Result cache key for what fetch_results returns. page is None when
+    paging by cursor, which is the raw cursor parameter.
+    """
+
+    return cache_key(
+        filters,
+        data_version,
+        today,
+        page=page,
+        cursor=cursor,
+        page_size=page_size,
+        aggregate=AGGREGATE_IN_SQL,
+        source=QUERY_SOURCE,
+        since=since_version,
+        fields=(projection or parse_fields(None)).key,
+        comparables=use_comparables,
+    )
+
+def fetch_results(
+        db,
+        filters: AlertFilters,
+        data_version: int,
+        today: str,
+        trace: RequestTrace,
+        page: int = 1,
+        page_size: int = 500,
+        use_cursor: bool = False,
+        cursor: tuple[str, str] | None = None,
+        delta_mls: list[str] | None = None,
+        projection: Projection = None,
+        use_comparables: bool = False,
+) -> dict:
 
+    """
+    The part of a response that goes in the result cache: the listing
+    query, nested and scored, for one page or, with delta_mls, for just
+    those listings. Also used by the dashboard, so a page it loads is a
+    cache hit here.
+    """
 
-def nest_events(data: list[dict], min_days_on_market: int | None) -> list[dict]:
+    projection = projection or parse_fields(None)
+
+    # Nothing changed, so there is nothing to query
+    data = []
+    if delta_mls != []:
+
+        # Compile the listing query. The SQL text only depends on which
+        # filters are set, so it is built once per shape and the filter
+        # values go in as bind parameters
+        with trace.span('sql_build'):
+            query, params = compile_listings_query(
+                filters,
+                page=page,
+                page_size=page_size,
+                use_cursor=use_cursor,
+                cursor=cursor,
+                aggregate=AGGREGATE_IN_SQL,
+                today=today,
+                source=QUERY_SOURCE,
+                since_mls=delta_mls,
+                projection=projection,
+            )
+        trace.set('query', query.name)
+
+        # Grab the listings, as a prepared statement on the same connection
+        with trace.span('listing_query'):
+            data = db.query_compiled(
+                query,
+                params,
+                return_dataframe=False,
+                return_columns=use_columnar(),
+                return_rows=COMPACT_ROWS,
+            )
+        trace.count('rows', len(data))
+
+    # Row mode 'new' flags from the index, one lookup per day
+    # and data version in a warm worker. Alerts filtering on event
+    # columns keep the scan, see new_today.EVENT_FILTERS
+    new_mls = None
+    if NEW_TODAY_INDEX and len(data) and not (AGGREGATE_IN_SQL or QUERY_SOURCE == 'state') and index_applies(filters):
+        with trace.span('new_today'):
+            new_mls = NEW_TODAY.get(db, today, data_version, filters.min_days_on_market)
+
+    # Nest and score, new listings first. Deltas aren't paged
+    compact = isinstance(data, ResultRows)
+    with trace.span('nest_events'):
+        data, next_cursor = build_results(
+            data,
+            filters,
+            page_size,
+            use_cursor and delta_mls is None,
+            today=today,
+            new_mls=new_mls,
+        )
+    results = {'results': data, 'next_cursor': next_cursor, 'delta': delta_mls is not None}
+
+    # Changed listings that aren't in the results anymore
+    if delta_mls is not None:
+        returned = {x['mls_number'] for x in data}
+        results['removed'] = [x for x in delta_mls if x not in returned]
+
+    # Zip code context from the market stats cube, one lookup
+    # by primary key for the whole page
+    if use_comparables:
+        with trace.span('comparables'):
+            stats = listing_comparables(db, data, today)
+
+    # Drop the fields nobody asked for, including the raw row columns
+    results['results'] = projection.apply(data)
+    if use_comparables:
+        if compact:
+            results['results'] = compact_rows.append_field(results['results'], 'comparables', stats)
+        else:
+            for listing, comparable in zip(results['results'], stats):
+                listing['comparables'] = comparable
+    return results
+
+def build_results(
+        data: list[dict],
+        filters: AlertFilters,
+        page_size: int,
+        use_cursor: bool,
+        aggregated: bool = None,
+        today: str = None,
+        new_mls: frozenset = None,
+) -> tuple[list[dict], str | None]:
+
+    """
+    Turns the listing query rows into the results list, new listings
+    first, plus the next cursor when paging by cursor. aggregated says
+    whether the rows came from nested_listings, by default whatever the
+    handler is configured to query. data can also be a ResultColumns,
+    which goes through the numpy version with the same output, or a
+    ResultRows, which gives compact_rows records. today and new_mls are
+    for row mode, see nest_events.
+    """
+
+    if aggregated is None:
+        aggregated = AGGREGATE_IN_SQL or QUERY_SOURCE == 'state'
+    today = today or current_day()
+
+    if isinstance(data, ResultColumns):
+        import columnar
+        return columnar.build_results(data, filters.min_days_on_market, page_size, use_cursor, aggregated, today, new_mls)
+
+    if isinstance(data, ResultRows):
+        return compact_rows.build_results(data, filters.min_days_on_market, page_size, use_cursor, aggregated, today, new_mls)
+
+    next_cursor = None
+    if aggregated:
+
+        # Events, drop counts and 'new' flags already come from SQL
+        if use_cursor:
+            next_cursor = next_listing_cursor(data, page_size)
+        data = score_listings(data)
+
+    else:
+
+        # Keep listings whole across cursor pages
+        if use_cursor:
+            data, next_cursor = trim_partial_listing(data, page_size)
+
+        # Nest price change events within each listing
+        data = nest_events(data, min_days_on_market=filters.min_days_on_market, today=today, new_mls=new_mls)
+
+    # Put the 'new' items in data at the start, otherwise keep the same order
+    new_items = [x for x in data if x['new'] is True]
+    old_items = [x for x in data if x['new'] is False]
+    return new_items + old_items, next_cursor
+
+def alert_meta(base_filters: dict, filters: AlertFilters) -> dict:
+
+    """
+    The alert fields that go at the top of the response body.
+    """
+
+    return {
+        'filter_id': base_filters.get('id'),
+        'owner_id': base_filters.get('owner_id'),
+        'recipient_email': base_filters.get('recipient_email'),
+        'owner_email': base_filters.get('owner_email'),
+        'nickname': base_filters.get('nickname'),
+        **filters.__dict__
+    }
+
+def filters_from_row(base_filters: dict) -> AlertFilters:
+
+    """
+    Builds AlertFilters from a report_recipients row.
+    """
+
+    return AlertFilters(
+        min_price=base_filters.get('min_price'),
+        max_price=base_filters.get('max_price'),
+        min_sq_ft=base_filters.get('min_sq_ft'),
+        max_sq_ft=base_filters.get('max_sq_ft'),
+        min_beds=base_filters.get('min_beds'),
+        max_beds=base_filters.get('max_beds'),
+        min_baths=base_filters.get('min_baths'),
+        max_baths=base_filters.get('max_baths'),
+        min_year_built=base_filters.get('min_year_built'),
+        max_year_built=base_filters.get('max_year_built'),
+        min_days_on_market=base_filters.get('min_days_on_market'),
+        max_days_on_market=base_filters.get('max_days_on_market'),
+        min_price_per_sq_ft=base_filters.get('min_price_per_sq_ft'),
+        max_price_per_sq_ft=base_filters.get('max_price_per_sq_ft'),
+        price_reduction=base_filters.get('price_reduction'),
+        cities=base_filters.get('cities'),
+        zip_codes=base_filters.get('zip_codes'),
+        counties=base_filters.get('counties'),
+        entire_state=base_filters.get('entire_state'),
+        property_types=base_filters.get('property_types'),
+        seller_motivation_scores=base_filters.get('seller_motivation_scores'),
+        keywords=base_filters.get('keywords'),
+        enhance_keywords=base_filters.get('enhance_keywords'),
+        exclude_keywords=base_filters.get('exclude_keywords'),
+        num_kitchens=base_filters.get('num_kitchens'),
+    )
+
+def nest_events(
+        data: list[dict],
+        min_days_on_market: int | None,
+        today: str = None,
+        new_mls: frozenset = None,
+) -> list[dict]:
 
     """
     Nests price change events within each listing
     Applies a 'new' flag to each listing if there are new events
     Adds seller motivation fields to each listing
+    new_mls, from new_today.NEW_TODAY, replaces the checks for the 'new' flag
     """
 
-    base_meta = [x for x in data if x['rn'] == 1]
-    for listing in base_meta:
+    today = today or current_day()
+
+    # Index the price change events by mls_number in a single pass so each
+    # listing only looks at its own events rather than rescanning all rows
+    base_meta = []
+    events_by_mls = {}
+    for row in data:
+        if row['rn'] == 1:
+            base_meta.append(row)
+
+        price_diff = row['price_diff']
+        if price_diff is not None and price_diff != 0.0:
+            event_obj = {
+                'mls_number': row['mls_number'],
+                'event_date': row['event_date'],
+                'new_price': row['new_price'],
+                'old_price': row['price'],
+                'price_diff': price_diff,
+            }
+            events_by_mls.setdefault(row['mls_number'], []).append(event_obj)
 
-        mls_num = listing['mls_number']
+    for listing in base_meta:
 
-        listing['events'] = []
-        extra_events = [
-            x for x in data
-            if x['mls_number'] == mls_num
-            and x['price_diff'] is not None
-            and x['price_diff'] != 0.0
-        ]
+        # Nest events within each listing, ordered by date (newest first)
+        extra_events = events_by_mls.get(listing['mls_number'], [])
+        listing['events'] = sorted(extra_events, key=lambda k: k['event_date'], reverse=True)
 
-        # Check for events that are new today
-        listing['new'] = False
-        all_dates = [y['event_date'][:10] for y in extra_events]
-        if TODAY in all_dates:
-            listing['new'] = True
+        # Check for events that are new today. The index covers the days
+        # on market checks below as well
+        if new_mls is not None:
+            listing['new'] = listing['mls_number'] in new_mls
+        else:
+            listing['new'] = any(x['event_date'][:10] == today for x in extra_events)
 
         # Check for brand-new listings or listings that just matched the days filters
-        if (
+        if new_mls is None and (
             listing['current_days_on_market'] == 0
             or listing['current_days_on_market'] == min_days_on_market
         ):
             listing['new'] = True
 
-        # Nest events within each listing
-        for event in extra_events:
-            event_obj = {
-                'mls_number': event['mls_number'],
-                'event_date': event['event_date'],
-                'new_price': event['new_price'],
-                'old_price': event['price'],
-                'price_diff': event['price_diff'],
-            }
-            listing['events'].append(event_obj)
-
         # Get the seller motivation score
         listing['seller_motivation_score'] = seller_motivation_score(listing)
 
-        # Order events by date within each date
-        listing['events'] = sorted(listing['events'], key=lambda k: k['event_date'], reverse=True)
-
     return base_meta
 
-def seller_motivation_score(listing: dict) -> SellerMotivationScore:
-
-    score = 0
-
-    # Get the gpt3.5 rated score based on description
-    if listing.get('seller_motivation') is True:
-        score += 4
-
-    # Account for days on market
-    if 90 < listing.get('current_days_on_market') < 180:
-        score += 3
-    elif listing.get('current_days_on_market') > 60:
-        score += 2
-    elif listing.get('current_days_on_market') > 30:
-        score += 1
-
-    # Account for the number of price drops
-    events = listing.get('events')
-    num_price_drops = [x for x in events if x.get('price_diff') < 0]
-
-    if len(num_price_drops) == 1:
-        score += 1
-    elif len(num_price_drops) == 2:
-        score += 2
-    elif len(num_price_drops) > 2:
-        score += 3
-
-    # Assign score
-    if score >= 6:
-        return "High"
-    elif score >= 3:
-        return "Moderate"
-    else:
-        return "Undetected"
+def score_listings(data: list[dict]) -> list[dict]:
+
+    """
+    Adds seller motivation scores to rows from nested_listings_cte, which
+    already carry their events, drop counts and 'new' flags.
+    """
+
+    for listing in data:
+        listing['seller_motivation_score'] = seller_motivation_score(listing)
+        del listing['num_price_drops']
+
+    return data
 
 
 
@@ -0,0 +1,207 @@
+from __future__ import annotations
+import os
+from db_pool import POOL
+from alert_models import RentalAlertFilters, GoodApiResponse
+from rental_alerts import RENTAL_DATA_VERSION_TABLE, RENTAL_FILTER_LOOKUP_SQL, compile_rental_query
+from pagination import InvalidCursor, decode_cursor, encode_cursor
+from alert_cache import RESULT_CACHE, cache_key, query_with_version
+from instrumentation import RequestTrace
+from single_flight import IN_FLIGHT
+from delta_feed import etag_matches, make_etag
+from new_today import market_today
+
+# Pins the date, see get_matching_listings.TODAY
+TODAY = None
+
+# Read the listing rows from rental_current_state, which ingestion keeps up
+# to date. 'events' runs the window functions per request instead
+RENTAL_QUERY_SOURCE = os.environ.get('RENTALS_QUERY_SOURCE', 'state')
+
+def handler(event: dict, context=None) -> dict:
+
+    """
+    /rentals/{alert_id}?user_id={}&email={}&page={}
+    /rentals/{alert_id}?user_id={}&email={}&cursor={}
+    GetMatchingRentals
+
+    Gets rental listings that match given rental alert filters, newest
+    activity first, each with its rent change history in price_history.
+    Listings with activity today are marked new. Paging works as in
+    GetMatchingListings: an empty cursor starts keyset paging, follow
+    next_cursor until it is null.
+    """
+
+    trace = RequestTrace('GetMatchingRentals', request_id=getattr(context, 'aws_request_id', None))
+
+    try:
+
+        query_params = event.get('queryStringParameters')
+        path_params = event.get('pathParameters')
+
+        alert_id = path_params.get('alert_id')
+        user_id = query_params.get('user_id')
+        email = query_params.get('email')
+        page = int(query_params.get('page', 1))
+        page_size = 500
+        today = TODAY or market_today()
+        trace.set('alert_id', alert_id)
+        trace.set('paging', 'cursor' if 'cursor' in query_params else 'page')
+
+        use_cursor = 'cursor' in query_params
+        try:
+            cursor = decode_cursor(query_params['cursor']) if query_params.get('cursor') else None
+        except InvalidCursor as e:
+            res = GoodApiResponse(
+                status_code=400,
+                body={'err': str(e)}
+            )
+            return trace.respond(res)
+
+        with POOL.connection() as db:
+
+            with trace.span('filter_lookup'):
+                rows = query_with_version(
+                    db,
+                    RENTAL_FILTER_LOOKUP_SQL,
+                    {'alert_id': alert_id, 'user_id': user_id, 'email': email},
+                    RENTAL_DATA_VERSION_TABLE,
+                )
+            trace.set('connect_ms', round(db.connect_ms, 1))
+            trace.set('warm', db.warm)
+
+            if not rows:
+                res = GoodApiResponse(
+                    status_code=404,
+                    body={'err': 'No rental alert found with given id'}
+                )
+                return trace.respond(res)
+
+            base_filters = rows[0]
+            with trace.span('parse_filters'):
+                filters = rental_filters_from_row(base_filters)
+            filter_meta = rental_alert_meta(base_filters, filters)
+
+            data_version = base_filters.get('data_version') or 0
+            trace.set('data_version', data_version)
+            with trace.span('cache_get'):
+                RESULT_CACHE.observe_version(data_version, namespace='rentals')
+                key = cache_key(
+                    filters,
+                    data_version,
+                    today,
+                    namespace='rentals',
+                    page=None if use_cursor else page,
+                    cursor=query_params.get('cursor') if use_cursor else None,
+                    page_size=page_size,
+                    source=RENTAL_QUERY_SOURCE,
+                )
+
+            etag = make_etag(key, filter_meta)
+            request_headers = {k.lower(): v for k, v in (event.get('headers') or {}).items()}
+            if etag_matches(request_headers.get('if-none-match'), etag):
+                trace.set('cache', 'not_modified')
+                res = GoodApiResponse(status_code=304, body=None, headers={'ETag': etag})
+                return trace.respond(res)
+
+            with trace.span('cache_get'):
+                cached = RESULT_CACHE.get(key)
+            trace.set('cache', 'miss' if cached is None else 'hit')
+
+            if cached is None:
+
+                def load_results() -> dict:
+                    with trace.span('sql_build'):
+                        query, params = compile_rental_query(
+                            filters,
+                            today=today,
+                            page=page,
+                            page_size=page_size,
+                            use_cursor=use_cursor,
+                            cursor=cursor,
+                            source=RENTAL_QUERY_SOURCE,
+                        )
+                    trace.set('query', query.name)
+
+                    # Rows come back finished, one per listing with its history
+                    with trace.span('listing_query'):
+                        data = db.query_compiled(query, params)
+                    trace.count('rows', len(data))
+
+                    next_cursor = None
+                    if use_cursor and len(data) >= page_size:
+                        next_cursor = encode_cursor(data[-1]['listing_id'], data[-1]['event_date'])
+                    results = {'results': data, 'next_cursor': next_cursor}
+                    RESULT_CACHE.set(key, results)
+                    return results
+
+                shared = RESULT_CACHE.shared.get if RESULT_CACHE.shared is not None else None
+                cached, flight = IN_FLIGHT.do(key, load_results, lookup=shared)
+                trace.set('flight', flight)
+
+        data = cached['results']
+        trace.count('num_results', len(data))
+
+        final_obj = {
+            **filter_meta,
+            'num_results': len(data),
+            'results': data,
+        }
+        if use_cursor:
+            final_obj['next_cursor'] = cached['next_cursor']
+
+        res = GoodApiResponse(
+            status_code=200,
+            body=final_obj,
+            headers={'ETag': etag},
+            accept_encoding=request_headers.get('accept-encoding', ''),
+        )
+
+    except Exception as e:
+
+        trace.error(e)
+        res = GoodApiResponse(
+            status_code=500,
+            body={'err': str(e)}
+        )
+
+    return trace.respond(res)
+
+
+def rental_alert_meta(base_filters: dict, filters: RentalAlertFilters) -> dict:
+
+    """
+    The alert fields that go at the top of the response body.
+    """
+
+    return {
+        'filter_id': base_filters.get('id'),
+        'owner_id': base_filters.get('owner_id'),
+        'recipient_email': base_filters.get('recipient_email'),
+        'owner_email': base_filters.get('owner_email'),
+        'nickname': base_filters.get('nickname'),
+        **filters.__dict__
+    }
+
+
+def rental_filters_from_row(base_filters: dict) -> RentalAlertFilters:
+
+    """
+    Builds RentalAlertFilters from a rental_report_recipients row.
+    """
+
+    available_by = base_filters.get('available_by')
+    return RentalAlertFilters(
+        min_price=base_filters.get('min_price'),
+        max_price=base_filters.get('max_price'),
+        min_beds=base_filters.get('min_beds'),
+        max_beds=base_filters.get('max_beds'),
+        min_baths=base_filters.get('min_baths'),
+        max_baths=base_filters.get('max_baths'),
+        min_sq_ft=base_filters.get('min_sq_ft'),
+        max_sq_ft=base_filters.get('max_sq_ft'),
+        pets_allowed=base_filters.get('pets_allowed'),
+        available_by=str(available_by) if available_by is not None else None,
+        amenities=base_filters.get('amenities'),
+        cities=base_filters.get('cities'),
+        zip_codes=base_filters.get('zip_codes'),
+    )
@@ -0,0 +1,191 @@
+from __future__ import annotations
+import os
+import json
+import time
+import random
+import logging
+import traceback
+
+# ALERTS_TRACE=0 turns spans and counters into no-ops. The one log line
+# per request is still written, just without the stage timings
+TRACE_ENABLED = os.environ.get('ALERTS_TRACE', '1') != '0'
+
+# Fraction of requests run under cProfile. A profile is only written out
+# when the request turns out slower than SLOW_REQUEST_MS
+PROFILE_SAMPLE_RATE = float(os.environ.get('ALERTS_PROFILE_SAMPLE_RATE', 0))
+SLOW_REQUEST_MS = float(os.environ.get('ALERTS_SLOW_REQUEST_MS', 1000))
+PROFILE_DIR = os.environ.get('ALERTS_PROFILE_DIR', '/tmp/alert_profiles')
+
+# Request lines are logged at INFO. The Lambda runtime's root logger
+# only passes WARNING and up, so this logger sets its own level
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Where finish() writes a trace's line unless it was given emit.
+# Benchmarks swap in a no-op so handler calls don't log
+EMIT = logger.info
+
+
+class _NullSpan:
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NULL_SPAN = _NullSpan()
+
+
+class _Span:
+
+    def __init__(self, trace: RequestTrace, name: str):
+        self.trace = trace
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+
+        # Spans with the same name add up, e.g. a retried query
+        elapsed = (time.perf_counter() - self.start) * 1000
+        self.trace.spans[self.name] = self.trace.spans.get(self.name, 0.0) + elapsed
+        return False
+
+
+class RequestTrace:
+
+    """
+    Timings and counters for one request, written out as a single JSON
+    log line by finish().
+
+        trace = RequestTrace('GetMatchingListings')
+        with trace.span('listing_query'):
+            ...
+        trace.count('rows', len(data))
+        return trace.respond(res)
+    """
+
+    def __init__(
+            self,
+            name: str,
+            request_id: str = None,
+            enabled: bool = None,
+            profile_sample_rate: float = None,
+            slow_request_ms: float = None,
+            emit=None,
+    ):
+        self.name = name
+        self.request_id = request_id
+        self.enabled = TRACE_ENABLED if enabled is None else enabled
+        self.slow_request_ms = SLOW_REQUEST_MS if slow_request_ms is None else slow_request_ms
+        self.emit = EMIT if emit is None else emit
+        self.spans = {}
+        self.counters = {}
+        self.fields = {}
+        self.finished = False
+        self.start = time.perf_counter()
+
+        rate = PROFILE_SAMPLE_RATE if profile_sample_rate is None else profile_sample_rate
+        self.profiler = None
+        if rate > 0 and random.random() < rate:
+            import cProfile
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+
+    def span(self, name: str):
+        if not self.enabled:
+            return NULL_SPAN
+        return _Span(self, name)
+
+    def count(self, name: str, value: int = 1):
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def set(self, name: str, value):
+
+        # Fields are cheap and always kept, they describe the request
+        self.fields[name] = value
+
+    def merge(self, other: RequestTrace):
+
+        # Spans and counters from a trace kept by a worker thread. Spans
+        # add up, so they are time spent rather than wall time
+        for name, ms in other.spans.items():
+            self.spans[name] = self.spans.get(name, 0.0) + ms
+        for name, value in other.counters.items():
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def error(self, e: Exception):
+        self.fields['error'] = f'{type(e).__name__}: {e}'
+        self.fields['traceback'] = traceback.format_exc()
+
+    def respond(self, res) -> dict:
+
+        """
+        Serializes a GoodApiResponse inside the serialize span, finishes
+        the trace and returns the Lambda response.
+        """
+
+        with self.span('serialize'):
+            response = res.get_response()
+        self.count('payload_bytes', len(response['body']))
+        if 'Content-Encoding' in response['headers']:
+            self.set('content_encoding', response['headers']['Content-Encoding'])
+        self.finish(response['statusCode'])
+        return response
+
+    def finish(self, status_code: int) -> dict:
+        if self.finished:
+            return {}
+        self.finished = True
+        total_ms = (time.perf_counter() - self.start) * 1000
+
+        line = {
+            'event': self.name,
+            'request_id': self.request_id,
+            'status_code': status_code,
+            'total_ms': round(total_ms, 3),
+            **self.fields,
+        }
+        if self.enabled:
+            line['spans_ms'] = {k: round(v, 3) for k, v in self.spans.items()}
+            line['counters'] = self.counters
+
+        if self.profiler is not None:
+            self.profiler.disable()
+            if total_ms >= self.slow_request_ms:
+                line['profile'] = self._dump_profile()
+
+        self.emit(json.dumps(line, default=str))
+        return line
+
+    def _dump_profile(self) -> str:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        request_id = self.request_id or f'{int(time.time() * 1000)}-{os.getpid()}'
+        path = os.path.join(PROFILE_DIR, f'{self.name}-{request_id}.prof')
+        self.profiler.dump_stats(path)
+        return path
+
+    def __repr__(self):
+        return f'RequestTrace - {self.name} {self.request_id}'
+
+
+if __name__ == '__main__':
+
+    # Overhead of a request's worth of spans and counters, on and off
+    for enabled in (True, False):
+        start = time.perf_counter()
+        for _ in range(10000):
+            trace = RequestTrace('bench', enabled=enabled, emit=lambda line: None)
+            for stage in ('filter_lookup', 'cache_get', 'sql_build', 'listing_query', 'nest_events'):
+                with trace.span(stage):
+                    pass
+            trace.count('rows', 500)
+            trace.set('cache', 'miss')
+            trace.finish(200)
+        per_request_us = (time.perf_counter() - start) / 10000 * 1e6
+        print(f'enabled={enabled}: {per_request_us:.1f}us per request')
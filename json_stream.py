@@ -0,0 +1,141 @@
+from __future__ import annotations
+import json
+from json.encoder import encode_basestring_ascii
+from typing import Iterator
+from row_records import Record
+
+CHUNK_SIZE = 64 * 1024
+
+# Subtrees this deep are handed to the C encoder whole. For an alerts body
+# that is one listing at a time, so streaming stays fine grained without
+# walking every images array in Python
+C_ENCODER_DEPTH = 2
+
+
+def json_default(o):
+
+    """
+    default for json encoders: compact_rows records encode as the dicts
+    they stand for.
+    """
+
+    if isinstance(o, Record):
+        return o.as_dict()
+    raise TypeError(f'Object of type {o.__class__.__name__} is not JSON serializable')
+
+
+_c_encoder = json.JSONEncoder(allow_nan=False, default=json_default)
+
+
+def _float_str(o: float) -> str:
+    if o != o:
+        return 'null'
+    if o == float('inf'):
+        return 'Infinity'
+    if o == -float('inf'):
+        return '-Infinity'
+    return float.__repr__(o)
+
+
+def _key_str(key) -> str:
+
+    # Same key coercion as the stdlib encoder
+    if isinstance(key, str):
+        return key
+    if key is True:
+        return 'true'
+    if key is False:
+        return 'false'
+    if key is None:
+        return 'null'
+    if isinstance(key, int):
+        return int.__repr__(key)
+    if isinstance(key, float):
+        return 'NaN' if key != key else _float_str(key)
+    raise TypeError(f'keys must be str, int, float, bool or None, not {key.__class__.__name__}')
+
+
+def _iterencode(o, empty_string_to_none: bool, depth: int) -> Iterator[str]:
+
+    # Fast path, the C encoder refuses NaN so anything it accepts is final
+    if depth >= C_ENCODER_DEPTH and not empty_string_to_none:
+        try:
+            yield _c_encoder.encode(o)
+            return
+        except ValueError:
+            pass
+
+    if isinstance(o, str):
+        yield 'null' if empty_string_to_none and o == '' else encode_basestring_ascii(o)
+    elif o is None:
+        yield 'null'
+    elif o is True:
+        yield 'true'
+    elif o is False:
+        yield 'false'
+    elif isinstance(o, int):
+        yield int.__repr__(o)
+    elif isinstance(o, float):
+        yield _float_str(o)
+    elif isinstance(o, dict):
+        if not o:
+            yield '{}'
+            return
+        first = True
+        for key, value in o.items():
+            yield '{' if first else ', '
+            first = False
+            yield encode_basestring_ascii(_key_str(key))
+            yield ': '
+            yield from _iterencode(value, empty_string_to_none, depth + 1)
+        yield '}'
+    elif isinstance(o, (list, tuple)):
+        if not o:
+            yield '[]'
+            return
+        first = True
+        for value in o:
+            yield '[' if first else ', '
+            first = False
+            yield from _iterencode(value, empty_string_to_none, depth + 1)
+        yield ']'
+    elif isinstance(o, Record):
+        yield from _iterencode(o.as_dict(), empty_string_to_none, depth)
+    else:
+        raise TypeError(f'Object of type {o.__class__.__name__} is not JSON serializable')
+
+
+def iter_json(obj, empty_string_to_none: bool = False, chunk_size: int = CHUNK_SIZE) -> Iterator[str]:
+
+    """
+    Encodes obj as JSON in chunks of roughly chunk_size characters. NaN
+    becomes null, and optionally "" becomes null, while encoding, so the
+    input is never copied. Output matches json.dumps(cls=ResponseEncoder).
+    """
+
+    buffer = []
+    size = 0
+    for piece in _iterencode(obj, empty_string_to_none, depth=0):
+        buffer.append(piece)
+        size += len(piece)
+        if size >= chunk_size:
+            yield ''.join(buffer)
+            buffer = []
+            size = 0
+    if buffer:
+        yield ''.join(buffer)
+
+
+def dumps(obj, empty_string_to_none: bool = False) -> str:
+
+    """
+    One-shot version of iter_json. Bodies without NaN go straight through
+    the C encoder.
+    """
+
+    if not empty_string_to_none:
+        try:
+            return _c_encoder.encode(obj)
+        except ValueError:
+            pass
+    return ''.join(_iterencode(obj, empty_string_to_none, depth=0))
@@ -0,0 +1,136 @@
+from __future__ import annotations
+import os
+import re
+import sys
+
+# 'ilike' keeps the original substring semantics and is served by a
+# trigram index. 'fulltext' matches whole (stemmed) words and phrases
+# through a tsvector column, which is faster still but not equivalent
+KEYWORD_MODE = os.environ.get('ALERTS_KEYWORD_MODE', 'ilike')
+KEYWORD_MODES = ('ilike', 'fulltext')
+
+KEYWORD_SEARCH_DDL = {
+    'ilike': """
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+CREATE INDEX IF NOT EXISTS listing_meta_description_trgm_idx
+    ON listing_meta USING gin (description gin_trgm_ops);
+""",
+    'fulltext': """
+ALTER TABLE listing_meta ADD COLUMN IF NOT EXISTS description_tsv tsvector
+    GENERATED ALWAYS AS (to_tsvector('english', coalesce(description, ''))) STORED;
+CREATE INDEX IF NOT EXISTS listing_meta_description_tsv_idx
+    ON listing_meta USING gin (description_tsv);
+""",
+}
+
+# Synonyms used when an alert has enhance_keywords set
+SYNONYMS = {
+    'motivated': ['motivated seller', 'must sell', 'priced to sell', 'bring all offers'],
+    'fixer': ['fixer upper', 'needs work', 'handyman special', 'tlc', 'investor special'],
+    'adu': ['accessory dwelling', 'mother in law', 'basement apartment', 'separate entrance'],
+    'pool': ['swimming pool'],
+    'views': ['mountain views', 'city views', 'view'],
+    'remodeled': ['renovated', 'updated', 'remodel'],
+}
+
+
+def default_expander(term: str) -> list[str]:
+    return SYNONYMS.get(term, [])
+
+
+# Swap this out to plug in a different synonym source
+KEYWORD_EXPANDER = default_expander
+
+
+def split_terms(value) -> list[str]:
+
+    """
+    Keywords come in as a comma separated string, or a list for
+    exclude_keywords on older rows. Lower cased, blanks dropped.
+    """
+
+    if not value:
+        return []
+    if isinstance(value, str):
+        value = value.split(',')
+    return [x.strip().lower() for x in value if x and x.strip()]
+
+
+def expand_terms(terms: list[str], enhance: bool = False) -> list[str]:
+    if not enhance:
+        return terms
+    expanded = list(terms)
+    for term in terms:
+        expanded.extend(x.lower() for x in KEYWORD_EXPANDER(term))
+    return list(dict.fromkeys(expanded))
+
+
+def ilike_patterns(terms: list[str]) -> list[str]:
+    return [f"%{x}%" for x in terms]
+
+
+def tsquery_text(terms: list[str]) -> str:
+
+    """
+    Each term becomes a phrase query, terms are OR'd. Only word characters
+    make it through, so user input can't break the tsquery syntax.
+    """
+
+    phrases = []
+    for term in terms:
+        words = re.findall(r'\w+', term)
+        if words:
+            phrases.append('(' + ' <-> '.join(words) + ')')
+    return ' | '.join(phrases)
+
+
+def include_clause(mode: str) -> str:
+    if mode == 'fulltext':
+        return "AND description_tsv @@ to_tsquery('english', %(keywords)s)"
+    return "AND description ILIKE ANY (%(keywords)s)"
+
+
+def exclude_clause(mode: str) -> str:
+
+    # Listings without a description can't contain an excluded word
+    if mode == 'fulltext':
+        return "AND NOT COALESCE(description_tsv @@ to_tsquery('english', %(exclude_keywords)s), FALSE)"
+    return "AND NOT COALESCE(description ILIKE ANY (%(exclude_keywords)s), FALSE)"
+
+
+def keyword_param(value, mode: str, enhance: bool = False):
+
+    """
+    Bind parameter for include_clause/exclude_clause.
+    """
+
+    terms = expand_terms(split_terms(value), enhance)
+    if mode == 'fulltext':
+        return tsquery_text(terms)
+    return ilike_patterns(terms)
+
+
+def create_indexes(db, mode: str = KEYWORD_MODE):
+    for statement in KEYWORD_SEARCH_DDL[mode].split(';'):
+        if statement.strip():
+            db.query(statement)
+
+
+if __name__ == '__main__':
+
+    # python keyword_search.py [ilike|fulltext] term,term
+    # Creates the index for the mode and shows the plan for a search
+    from db_pool import POOL
+
+    mode = sys.argv[1] if len(sys.argv) > 1 else KEYWORD_MODE
+    terms = sys.argv[2] if len(sys.argv) > 2 else 'motivated, fixer upper'
+
+    with POOL.connection() as db:
+        create_indexes(db, mode)
+        db.query('ANALYZE listing_meta')
+        plan = db.query(
+            f"EXPLAIN (ANALYZE, BUFFERS) SELECT count(*) FROM listing_meta WHERE TRUE {include_clause(mode)}",
+            params={'keywords': keyword_param(terms, mode)},
+        )
+    for row in plan:
+        print(row['QUERY PLAN'])
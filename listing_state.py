@@ -0,0 +1,164 @@
+from __future__ import annotations
+import sys
+import json
+from shared_sql_utils import price_lead_cte, final_agg_cte, nested_listings_cte, current_state_cte
+from query_compiler import base_listings_template
+from new_today import market_today
+
+# One row per active listing holding what the alert query otherwise
+# recomputes with DISTINCT ON and window functions on every request.
+# events is json rather than jsonb so the nested event keys keep the same
+# order nest_events gives them
+LISTING_STATE_DDL = """
+CREATE TABLE IF NOT EXISTS listing_current_state (
+    mls_number text PRIMARY KEY,
+    price float8,
+    sq_ft int,
+    price_per_sq_ft float8,
+    beds int,
+    baths int,
+    year_built int,
+    status text,
+    days_on_market int,
+    last_event_date timestamp,
+    events json NOT NULL DEFAULT '[]',
+    biggest_price_drop float8,
+    num_price_drops int NOT NULL DEFAULT 0,
+    updated_at timestamptz NOT NULL DEFAULT now()
+);
+CREATE INDEX IF NOT EXISTS listing_current_state_price_idx ON listing_current_state (price);
+CREATE INDEX IF NOT EXISTS listing_current_state_beds_baths_idx ON listing_current_state (beds, baths);
+CREATE INDEX IF NOT EXISTS listing_current_state_drop_idx ON listing_current_state (biggest_price_drop);
+"""
+
+STATE_COLUMNS = [
+    'price', 'sq_ft', 'price_per_sq_ft', 'beds', 'baths', 'year_built', 'status',
+    'days_on_market', 'last_event_date', 'events', 'biggest_price_drop', 'num_price_drops',
+]
+
+
+def _upsert_sql(only_listed: bool) -> str:
+
+    """
+    Recomputes state with the same CTEs the alert query uses, with no alert
+    filters, either for %(mls_numbers)s or for everything.
+    """
+
+    extra = "\n            AND mls_number = ANY (%(mls_numbers)s)" if only_listed else ""
+    updates = ",\n        ".join(f"{x} = EXCLUDED.{x}" for x in STATE_COLUMNS)
+    return f"""
+    {base_listings_template((), extra=extra)},
+    {price_lead_cte()},
+    {final_agg_cte()},
+    {nested_listings_cte()}
+    INSERT INTO listing_current_state (mls_number, {", ".join(STATE_COLUMNS)}, updated_at)
+    SELECT mls_number, price, sq_ft, price_per_sq_ft, beds, baths, year_built, status,
+    days_on_market, event_date::timestamp, events, biggest_price_drop, num_price_drops, now()
+    FROM nested_listings
+    ON CONFLICT (mls_number) DO UPDATE SET
+        {updates},
+        updated_at = now()
+    """
+
+
+# Listings that went inactive or lost all their events
+DELETE_STALE_SQL = """
+DELETE FROM listing_current_state s
+WHERE s.mls_number = ANY (%(mls_numbers)s)
+AND NOT EXISTS (
+    SELECT 1 FROM listing_meta lm
+    JOIN listing_events le USING (mls_number)
+    WHERE lm.mls_number = s.mls_number AND lm.active IS TRUE
+)
+"""
+
+
+def create_table(db):
+    for statement in LISTING_STATE_DDL.split(';'):
+        if statement.strip():
+            db.query(statement)
+
+
+def apply_ingested_events(db, mls_numbers: list[str]) -> int:
+
+    """
+    Called by ingestion after new ListingEvents or ListingMeta changes are
+    committed. Only the listings that changed are recomputed.
+    """
+
+    mls_numbers = sorted(set(mls_numbers))
+    if not mls_numbers:
+        return 0
+    params = {'mls_numbers': mls_numbers, 'today': None, 'new_min_days': None}
+    db.query(_upsert_sql(only_listed=True), params=params)
+    db.query(DELETE_STALE_SQL, params=params)
+    return len(mls_numbers)
+
+
+def rebuild(db):
+
+    """
+    Backfills the table from scratch.
+    """
+
+    create_table(db)
+    db.query("TRUNCATE listing_current_state")
+    db.query(_upsert_sql(only_listed=False), params={'today': None, 'new_min_days': None})
+
+
+def check_consistency(db, today: str = None) -> list[str]:
+
+    """
+    Compares every listing in the state table with what the CTE pipeline
+    gives right now. Returns the mls_numbers that differ.
+    """
+
+    today = today or market_today()
+    params = {'today': today, 'new_min_days': None}
+
+    expected = db.query(f"""
+        {base_listings_template(())},
+        {price_lead_cte()},
+        {final_agg_cte()},
+        {nested_listings_cte()}
+        SELECT * FROM nested_listings
+    """, params=params)
+    actual = db.query(f"WITH {current_state_cte()} SELECT * FROM nested_listings", params=params)
+
+    expected = {x['mls_number']: x for x in expected}
+    actual = {x['mls_number']: x for x in actual}
+
+    mismatched = []
+    for mls_number in sorted(expected.keys() | actual.keys()):
+        a, b = expected.get(mls_number), actual.get(mls_number)
+        if a is None or b is None:
+            mismatched.append(mls_number)
+            continue
+
+        # Both sides are listing rows; compare them as the API would render them
+        a = json.dumps({k: a[k] for k in sorted(a)}, default=str)
+        b = json.dumps({k: b[k] for k in sorted(b)}, default=str)
+        if a != b:
+            mismatched.append(mls_number)
+
+    return mismatched
+
+
+if __name__ == '__main__':
+
+    # python listing_state.py rebuild|check
+    from db_pool import POOL
+
+    command = sys.argv[1] if len(sys.argv) > 1 else 'check'
+    with POOL.connection() as db:
+        if command == 'rebuild':
+            rebuild(db)
+            print('listing_current_state rebuilt')
+        elif command == 'check':
+            mismatched = check_consistency(db)
+            print(f'{len(mismatched)} listings differ from the CTE output')
+            for mls_number in mismatched[:50]:
+                print(mls_number)
+            sys.exit(1 if mismatched else 0)
+        else:
+            sys.exit(f'unknown command {command}')
@@ -0,0 +1,366 @@
+from __future__ import annotations
+import sys
+import time
+import datetime
+import argparse
+from new_today import market_date
+
+# Daily market rollup, one row per day x area x property type. Areas are
+# cities, zip codes and the whole state; property_type '*' is all types.
+# Building a day reads listing_events once. Reading it back is a primary
+# key lookup, so the alerts response can carry comparables for free
+MARKET_STATS_DDL = """
+CREATE TABLE IF NOT EXISTS market_daily_stats (
+    stat_date date NOT NULL,
+    geo_level text NOT NULL,
+    geo_value text NOT NULL,
+    property_type text NOT NULL,
+    active_listings int NOT NULL,
+    new_listings int NOT NULL,
+    price_drops int NOT NULL,
+    price_p25 float8,
+    price_median float8,
+    price_p75 float8,
+    price_per_sq_ft_p25 float8,
+    price_per_sq_ft_median float8,
+    price_per_sq_ft_p75 float8,
+    days_on_market_median float8,
+    updated_at timestamptz NOT NULL DEFAULT now(),
+    PRIMARY KEY (stat_date, geo_level, geo_value, property_type)
+);
+"""
+
+STAT_COLUMNS = [
+    'active_listings', 'new_listings', 'price_drops', 'price_p25', 'price_median', 'price_p75',
+    'price_per_sq_ft_p25', 'price_per_sq_ft_median', 'price_per_sq_ft_p75', 'days_on_market_median',
+]
+
+# Fewer listings of the same type than this in a zip and comparables fall
+# back to all types in the zip
+MIN_COMPARABLES = 5
+
+# The market as of the end of %(day)s: each active listing at its latest
+# price on or before that day, plus that day's new listings and price
+# drops, rolled up by every area and property type at once
+ROLLUP_SQL = """
+WITH snapshot AS (
+    SELECT DISTINCT ON (le.mls_number) le.mls_number, le.price, le.price_per_sq_ft,
+    lm.city, lm.zip_code, COALESCE(lm.property_type, 'Unknown') AS property_type,
+    lm.date_listed::date AS date_listed, %(day)s::date - lm.date_listed::date AS days_on_market
+    FROM listing_events le
+    JOIN listing_meta lm USING (mls_number)
+    WHERE lm.active IS TRUE
+    AND le.event_date < %(day)s::date + 1
+    ORDER BY le.mls_number, le.event_date DESC
+),
+drops AS (
+    SELECT mls_number, COUNT(*) AS price_drops
+    FROM (
+        SELECT mls_number, event_date,
+        price - LAG(price) OVER (PARTITION BY mls_number ORDER BY event_date) AS price_diff
+        FROM listing_events
+        WHERE event_date < %(day)s::date + 1
+        AND mls_number IN (
+            SELECT mls_number FROM listing_events
+            WHERE event_date >= %(day)s::date AND event_date < %(day)s::date + 1
+        )
+    ) x
+    WHERE event_date >= %(day)s::date AND price_diff < 0
+    GROUP BY mls_number
+),
+rolled AS (
+    SELECT
+    GROUPING(s.city) AS no_city,
+    GROUPING(s.zip_code) AS no_zip,
+    s.city, s.zip_code,
+    CASE WHEN GROUPING(s.property_type) = 0 THEN s.property_type ELSE '*' END AS property_type,
+    COUNT(*) AS active_listings,
+    COUNT(*) FILTER (WHERE s.date_listed = %(day)s::date) AS new_listings,
+    COALESCE(SUM(d.price_drops), 0) AS price_drops,
+    percentile_cont(ARRAY[0.25, 0.5, 0.75]) WITHIN GROUP (ORDER BY s.price) AS price,
+    percentile_cont(ARRAY[0.25, 0.5, 0.75]) WITHIN GROUP (ORDER BY s.price_per_sq_ft) AS price_per_sq_ft,
+    percentile_cont(0.5) WITHIN GROUP (ORDER BY s.days_on_market) AS days_on_market_median
+    FROM snapshot s
+    LEFT JOIN drops d USING (mls_number)
+    WHERE s.date_listed IS NULL OR s.date_listed <= %(day)s::date
+    GROUP BY GROUPING SETS (
+        (s.city, s.property_type), (s.city),
+        (s.zip_code, s.property_type), (s.zip_code),
+        (s.property_type), ()
+    )
+)
+INSERT INTO market_daily_stats (stat_date, geo_level, geo_value, property_type, active_listings, new_listings,
+    price_drops, price_p25, price_median, price_p75, price_per_sq_ft_p25, price_per_sq_ft_median,
+    price_per_sq_ft_p75, days_on_market_median, updated_at)
+SELECT %(day)s::date,
+CASE WHEN no_city = 0 THEN 'city' WHEN no_zip = 0 THEN 'zip' ELSE 'state' END,
+CASE WHEN no_city = 0 THEN city WHEN no_zip = 0 THEN zip_code ELSE 'UT' END,
+property_type, active_listings, new_listings, price_drops,
+price[1], price[2], price[3], price_per_sq_ft[1], price_per_sq_ft[2], price_per_sq_ft[3],
+days_on_market_median, now()
+FROM rolled
+WHERE (no_city = 1 OR city IS NOT NULL) AND (no_zip = 1 OR zip_code IS NOT NULL)
+"""
+
+CLEAR_DAY_SQL = "DELETE FROM market_daily_stats WHERE stat_date = %(day)s::date"
+
+STATS_SQL = """
+SELECT * FROM market_daily_stats
+WHERE stat_date = (SELECT max(stat_date) FROM market_daily_stats WHERE stat_date <= %(day)s::date)
+AND geo_level = %(geo_level)s AND geo_value = %(geo_value)s AND property_type = %(property_type)s
+"""
+
+# Each listing's zip code stats for its own property type and for all
+# types, from the latest rollup on or before %(day)s
+COMPARABLES_SQL = """
+SELECT lm.mls_number, lm.zip_code, t.active_listings AS type_listings,
+t.price_median AS type_price_median, t.price_per_sq_ft_median AS type_price_per_sq_ft_median,
+t.days_on_market_median AS type_days_on_market_median,
+a.active_listings AS all_listings, a.price_median AS all_price_median,
+a.price_per_sq_ft_median AS all_price_per_sq_ft_median,
+a.days_on_market_median AS all_days_on_market_median
+FROM listing_meta lm
+CROSS JOIN (SELECT max(stat_date) AS stat_date FROM market_daily_stats WHERE stat_date <= %(day)s::date) latest
+LEFT JOIN market_daily_stats t ON t.stat_date = latest.stat_date AND t.geo_level = 'zip'
+    AND t.geo_value = lm.zip_code AND t.property_type = COALESCE(lm.property_type, 'Unknown')
+LEFT JOIN market_daily_stats a ON a.stat_date = latest.stat_date AND a.geo_level = 'zip'
+    AND a.geo_value = lm.zip_code AND a.property_type = '*'
+WHERE lm.mls_number = ANY (%(mls_numbers)s)
+"""
+
+
+def create_table(db):
+    db.query(MARKET_STATS_DDL)
+
+
+def refresh_day(db, day: datetime.date):
+
+    """
+    Recomputes one day's slice of the cube in a single transaction, so
+    readers see either the old slice or the new one.
+    """
+
+    params = {'day': day.strftime('%Y-%m-%d')}
+    with db.transaction():
+        db.query(CLEAR_DAY_SQL, params=params)
+        db.query(ROLLUP_SQL, params=params)
+
+
+def market_stats(
+        db,
+        day: str,
+        geo_level: str = 'state',
+        geo_value: str = 'UT',
+        property_type: str = '*',
+) -> dict | None:
+
+    """
+    One cube row from the latest rollup on or before day. geo_level is
+    'city', 'zip' or 'state'.
+    """
+
+    rows = db.query(STATS_SQL, params={
+        'day': day,
+        'geo_level': geo_level,
+        'geo_value': geo_value,
+        'property_type': property_type,
+    })
+    return rows[0] if rows else None
+
+
+def comparables(db, mls_numbers: list[str], day: str) -> dict[str, dict]:
+
+    """
+    How each listing compares with its zip code, by mls_number. Uses the
+    listing's own property type when the zip has MIN_COMPARABLES of them,
+    otherwise all types. Listings with no stats for their zip are left out.
+    """
+
+    if not mls_numbers:
+        return {}
+
+    result = {}
+    for row in db.query(COMPARABLES_SQL, params={'mls_numbers': list(mls_numbers), 'day': day}):
+        prefix = 'type' if (row['type_listings'] or 0) >= MIN_COMPARABLES else 'all'
+        if row[f'{prefix}_listings'] is None:
+            continue
+        result[row['mls_number']] = {
+            'zip_code': row['zip_code'],
+            'property_type': 'same' if prefix == 'type' else 'all',
+            'zip_listings': row[f'{prefix}_listings'],
+            'zip_median_price': row[f'{prefix}_price_median'],
+            'zip_median_price_per_sq_ft': row[f'{prefix}_price_per_sq_ft_median'],
+            'zip_median_days_on_market': row[f'{prefix}_days_on_market_median'],
+        }
+    return result
+
+
+def listing_comparables(db, listings: list[dict], day: str) -> list[dict | None]:
+
+    """
+    comparables for each listing in order, with price_per_sq_ft_vs_zip as
+    the percentage above (positive) or below the zip median.
+    """
+
+    stats = comparables(db, [x['mls_number'] for x in listings], day)
+    result = []
+    for listing in listings:
+        comparable = stats.get(listing['mls_number'])
+        if comparable is not None:
+            median = comparable['zip_median_price_per_sq_ft']
+            ppsf = listing.get('price_per_sq_ft')
+            comparable['price_per_sq_ft_vs_zip'] = round((ppsf / median - 1) * 100, 1) if ppsf and median else None
+        result.append(comparable)
+    return result
+
+
+class MarketStatsJob:
+
+    """
+    Daily rollup into market_daily_stats. Each run rebuilds only the
+    trailing days, by default yesterday (late events) and today, so the
+    cube grows a day at a time. A longer days backfills history.
+    """
+
+    def __init__(self, pool, today: datetime.date = None, days: int = 2):
+        self.pool = pool
+        self.today = today or market_date()
+        self.days = days
+        self.stats = {}
+
+    def run(self) -> dict:
+        start = time.perf_counter()
+        days = [self.today - datetime.timedelta(days=i) for i in range(self.days - 1, -1, -1)]
+        with self.pool.connection() as db:
+            create_table(db)
+            for day in days:
+                refresh_day(db, day)
+            db.query('ANALYZE market_daily_stats')
+            rows = db.query(
+                'SELECT COUNT(*) AS n FROM market_daily_stats WHERE stat_date >= %(first)s',
+                params={'first': days[0].strftime('%Y-%m-%d')},
+            )[0]['n']
+
+        total_seconds = time.perf_counter() - start
+        self.stats = {
+            'days': len(days),
+            'rows': rows,
+            'total_seconds': round(total_seconds, 3),
+            'seconds_per_day': round(total_seconds / len(days), 3),
+        }
+        return self.stats
+
+
+if __name__ == '__main__':
+
+    # python market_stats.py --dsn ... [--days 2]
+    #     rolls up the trailing days
+    # python market_stats.py --synthetic --dsn scratch-db
+    #     loads the synthetic dataset, backfills a month, checks rows
+    #     against numpy and compares lookups with the ad hoc scan
+    import numpy as np
+    from db_pool import ConnectionPool
+
+    parser = argparse.ArgumentParser(description='Roll up listing events into market_daily_stats')
+    parser.add_argument('--dsn', required=True)
+    parser.add_argument('--days', type=int, default=2)
+    parser.add_argument('--synthetic', action='store_true')
+    parser.add_argument('--events', type=int, default=100000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    pool = ConnectionPool(dsn=args.dsn)
+    if not args.synthetic:
+        print(MarketStatsJob(pool, days=args.days).run())
+        sys.exit(0)
+
+    from synthetic_data import EVENT_COLUMNS, META_COLUMNS, generate_dataset, load_postgres
+
+    dataset = generate_dataset(args.events, seed=args.seed)
+    with pool.connection() as db:
+        load_postgres(db, dataset)
+        db.query('DROP TABLE IF EXISTS market_daily_stats')
+    print(f'backfill: {MarketStatsJob(pool, today=dataset.today, days=30).run()}')
+    print(f'daily:    {MarketStatsJob(pool, today=dataset.today).run()}')
+
+    # Rows match a direct computation for a few days and areas
+    meta = {x[0]: dict(zip(META_COLUMNS, x)) for x in dataset.meta}
+    events = [dict(zip(EVENT_COLUMNS, x)) for x in dataset.events]
+    checked = 0
+    for days_back in (0, 3, 17):
+        day = dataset.today - datetime.timedelta(days=days_back)
+        day_text = day.strftime('%Y-%m-%d')
+        latest = {}
+        for event in sorted(events, key=lambda x: x['event_date']):
+            if event['event_date'] < (day + datetime.timedelta(days=1)).strftime('%Y-%m-%d'):
+                latest[event['mls_number']] = event
+        snapshot = [
+            (x, meta[x['mls_number']]) for x in latest.values()
+            if meta[x['mls_number']]['active'] and meta[x['mls_number']]['date_listed'] <= day_text
+        ]
+        for geo_level, key in [('zip', 'zip_code'), ('city', 'city')]:
+            for geo_value in sorted({m[key] for _, m in snapshot})[:5]:
+                for property_type in ('*', 'Condo'):
+                    rows = [
+                        (e, m) for e, m in snapshot
+                        if m[key] == geo_value and property_type in ('*', m['property_type'])
+                    ]
+                    with pool.connection() as db:
+                        row = market_stats(db, day_text, geo_level, geo_value, property_type)
+                    if not rows:
+                        assert row is None or row['stat_date'] != day
+                        continue
+                    prices = np.array([e['price'] for e, _ in rows])
+                    days_on_market = np.array([(day - datetime.date.fromisoformat(m['date_listed'])).days for _, m in rows])
+                    assert row['active_listings'] == len(rows)
+                    assert row['new_listings'] == sum(m['date_listed'] == day_text for _, m in rows)
+                    assert np.allclose([row['price_p25'], row['price_median'], row['price_p75']], np.percentile(prices, [25, 50, 75]))
+                    assert np.isclose(row['days_on_market_median'], np.median(days_on_market))
+                    checked += 1
+    print(f'{checked} cube rows match numpy')
+
+    def best_ms(func, repeat: int = 5) -> float:
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            func()
+            times.append(time.perf_counter() - start)
+        return min(times) * 1000
+
+    # The zip median the ad hoc way, and from the cube
+    zip_code = '84101'
+    adhoc_sql = """
+        SELECT percentile_cont(0.5) WITHIN GROUP (ORDER BY price_per_sq_ft) AS median
+        FROM (
+            SELECT DISTINCT ON (mls_number) price_per_sq_ft
+            FROM listing_events JOIN listing_meta lm USING (mls_number)
+            WHERE lm.active IS TRUE AND lm.zip_code = %(zip_code)s
+            ORDER BY mls_number, event_date DESC
+        ) x
+    """
+    today = dataset.today.strftime('%Y-%m-%d')
+    with pool.connection() as db:
+        adhoc = db.query(adhoc_sql, params={'zip_code': zip_code})[0]['median']
+        cube = market_stats(db, today, 'zip', zip_code)['price_per_sq_ft_median']
+        assert np.isclose(adhoc, cube), (adhoc, cube)
+        adhoc_ms = best_ms(lambda: db.query(adhoc_sql, params={'zip_code': zip_code}))
+        cube_ms = best_ms(lambda: market_stats(db, today, 'zip', zip_code))
+        mls_numbers = [x[0] for x in dataset.meta[:500]]
+        comparables_ms = best_ms(lambda: comparables(db, mls_numbers, today))
+    print(f'zip {zip_code} median price/sq ft: ad hoc scan {adhoc_ms:.2f}ms, cube {cube_ms:.2f}ms, '
+          f'comparables for 500 listings {comparables_ms:.2f}ms')
+
+    # The alerts handler with comparables on a realistic alert
+    import json
+    import get_matching_listings
+    from synthetic_data import BENCH_OWNER_ID
+    get_matching_listings.POOL = pool
+    get_matching_listings.TODAY = today
+    event = {
+        'queryStringParameters': {'user_id': BENCH_OWNER_ID, 'email': None, 'comparables': '1', 'fields': 'card'},
+        'pathParameters': {'alert_id': str(dataset.alert_id('broad'))},
+    }
+    body = json.loads(get_matching_listings.handler(event)['body'])
+    listing = body['results'][0]
+    assert all('comparables' in x for x in body['results'])
+    print(f"{body['num_results']} listings with comparables, e.g. {listing['mls_number']}: {listing['comparables']}")
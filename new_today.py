@@ -0,0 +1,261 @@
+from __future__ import annotations
+import sys
+import time
+import datetime
+import argparse
+import threading
+from shared_sql_utils import price_lead_cte, final_agg_cte
+from query_compiler import base_listings_template, filter_shape
+
+# The days on which each active listing counts as new: the day it was
+# listed and the days of its price change events, dated the way
+# nest_events dates them. Ingestion keeps it current for the listings a
+# batch touches, so a request looks up today's rows instead of scanning
+# every event it returns
+NEW_DAYS_DDL = """
+CREATE TABLE IF NOT EXISTS listing_new_days (
+    day date NOT NULL,
+    kind text NOT NULL,
+    mls_number text NOT NULL,
+    PRIMARY KEY (day, kind, mls_number)
+);
+CREATE INDEX IF NOT EXISTS listing_new_days_mls_idx ON listing_new_days (mls_number);
+"""
+
+# Filters on listing_events columns. They drop single events before
+# price_lead_cte pairs them up, so the scan sees other price changes, or
+# none, where the index has every one. Alerts with any of these keep the
+# scan, the index only knows listings
+EVENT_FILTERS = frozenset((
+    'min_price', 'max_price', 'min_sq_ft', 'max_sq_ft', 'min_beds', 'max_beds',
+    'min_baths', 'max_baths', 'min_year_built', 'max_year_built',
+    'min_price_per_sq_ft', 'max_price_per_sq_ft',
+))
+
+NEW_DAYS_TABLE_SQL = "SELECT to_regclass('listing_new_days') IS NOT NULL AS exists"
+
+CLEAR_LISTINGS_SQL = "DELETE FROM listing_new_days WHERE mls_number = ANY (%(mls_numbers)s)"
+
+# Listings new on %(day)s, plus those listed exactly %(min_days)s days
+# before it, which just crossed an alert's minimum days on market
+NEW_ON_DAY_SQL = """
+SELECT DISTINCT mls_number FROM listing_new_days
+WHERE day = %(day)s::date
+OR (kind = 'listed' AND day = %(day)s::date - %(min_days)s::int)
+"""
+
+
+def _record_sql(only_listed: bool) -> str:
+
+    """
+    The listing_new_days rows for %(mls_numbers)s or for everything,
+    with the same CTEs the alert query nests events with.
+    """
+
+    extra = "\n            AND mls_number = ANY (%(mls_numbers)s)" if only_listed else ""
+    return f"""
+    {base_listings_template((), extra=extra)},
+    {price_lead_cte()},
+    {final_agg_cte()}
+    INSERT INTO listing_new_days (day, kind, mls_number)
+    SELECT DISTINCT left(event_date, 10)::date, 'price_change', mls_number
+    FROM final_fields
+    WHERE price_diff IS NOT NULL AND price_diff <> 0
+    UNION
+    SELECT date_listed::date, 'listed', mls_number
+    FROM listing_meta
+    WHERE active IS TRUE AND date_listed IS NOT NULL{extra}
+    ON CONFLICT DO NOTHING
+    """
+
+
+def market_date() -> datetime.date:
+
+    """
+    Today in mountain time, the market's calendar, rather than the
+    worker's clock, which is UTC on Lambda. Read it per request: a warm
+    worker keeps going past midnight.
+    """
+
+    # umc_models is only needed here, so it isn't imported at cold start
+    from umc_models import get_now_mountain_time
+    return get_now_mountain_time().date()
+
+
+def market_today() -> str:
+    return market_date().strftime('%Y-%m-%d')
+
+
+def index_applies(filters) -> bool:
+
+    """
+    Whether the index gives the same 'new' flags as the scan for an
+    alert's filters, see EVENT_FILTERS.
+    """
+
+    return EVENT_FILTERS.isdisjoint(filter_shape(filters))
+
+
+def create_table(db):
+    for statement in NEW_DAYS_DDL.split(';'):
+        if statement.strip():
+            db.query(statement)
+
+
+def apply_ingested_events(db, mls_numbers: list[str]) -> int:
+
+    """
+    Called by ingestion in the same transaction as the rows it loaded,
+    like listing_state.apply_ingested_events. Replaces the touched
+    listings' days.
+    """
+
+    mls_numbers = sorted(set(mls_numbers))
+    if not mls_numbers:
+        return 0
+    params = {'mls_numbers': mls_numbers}
+    db.query(CLEAR_LISTINGS_SQL, params=params)
+    db.query(_record_sql(only_listed=True), params=params)
+    return len(mls_numbers)
+
+
+def rebuild(db):
+
+    """
+    Backfills the table from scratch.
+    """
+
+    create_table(db)
+    db.query("TRUNCATE listing_new_days")
+    db.query(_record_sql(only_listed=False))
+
+
+class NewTodayIndex:
+
+    """
+    Per worker cache of the mls_numbers that are new on a day, one lookup
+    per day, data version and alert min_days_on_market. A new day or a
+    new version empties it, so a warm worker rolls over at midnight
+    without a restart.
+    """
+
+    def __init__(self):
+        self.key = None
+        self.entries = {}
+        self.num_lookups = 0
+        self._lock = threading.Lock()
+
+    def get(self, db, day: str, data_version: int, min_days: int | None = None) -> frozenset:
+        with self._lock:
+            if self.key != (day, data_version):
+                self.key = (day, data_version)
+                self.entries = {}
+            found = self.entries.get(min_days)
+        if found is not None:
+            return found
+
+        rows = db.query(NEW_ON_DAY_SQL, params={'day': day, 'min_days': min_days})
+        found = frozenset(x['mls_number'] for x in rows)
+        self.num_lookups += 1
+        with self._lock:
+            if self.key == (day, data_version):
+                self.entries[min_days] = found
+        return found
+
+    def __repr__(self):
+        return f'NewTodayIndex - {self.key}'
+
+
+# Module level so warm invocations share it
+NEW_TODAY = NewTodayIndex()
+
+
+if __name__ == '__main__':
+
+    # python new_today.py --dsn ...
+    #     backfills listing_new_days
+    # python new_today.py --synthetic --dsn scratch-db
+    #     loads the synthetic dataset and checks the index against the
+    #     nest_events scan for every alert profile
+    parser = argparse.ArgumentParser(description='Maintain listing_new_days')
+    parser.add_argument('--dsn', required=True)
+    parser.add_argument('--synthetic', action='store_true')
+    parser.add_argument('--events', type=int, default=100000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    from db_pool import ConnectionPool
+    pool = ConnectionPool(dsn=args.dsn)
+    if not args.synthetic:
+        with pool.connection() as db:
+            start = time.perf_counter()
+            rebuild(db)
+        print(f'rebuilt listing_new_days in {time.perf_counter() - start:.2f}s')
+        sys.exit(0)
+
+    import get_matching_listings
+    from synthetic_data import ALERT_PROFILES, generate_dataset, load_postgres
+    from query_compiler import compile_listings_query
+
+    # Pin the dataset to today's market date so 'new' has something to find
+    today = market_date()
+    dataset = generate_dataset(args.events, seed=args.seed, today=today)
+    with pool.connection() as db:
+        load_postgres(db, dataset)
+        start = time.perf_counter()
+        rebuild(db)
+        rebuild_seconds = time.perf_counter() - start
+        num_rows = db.query('SELECT COUNT(*) AS n FROM listing_new_days')[0]['n']
+    print(f'rebuild: {num_rows} rows in {rebuild_seconds:.2f}s')
+
+    def best_ms(func, repeat: int = 5) -> float:
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            func()
+            times.append(time.perf_counter() - start)
+        return min(times) * 1000
+
+    # Same 'new' flags either way for every profile the index applies to
+    day = today.strftime('%Y-%m-%d')
+    index = NewTodayIndex()
+    num_differ = 0
+    for profile in ALERT_PROFILES:
+        with pool.connection() as db:
+            row = db.query('SELECT * FROM report_recipients WHERE id = %(id)s', params={'id': dataset.alert_id(profile)})[0]
+            filters = get_matching_listings.filters_from_row(row)
+            query, params = compile_listings_query(filters, page_size=100000, today=day)
+            rows = db.query_compiled(query, params)
+            new_mls = index.get(db, day, 0, filters.min_days_on_market)
+
+        scanned = get_matching_listings.nest_events([dict(x) for x in rows], filters.min_days_on_market, today=day)
+        indexed = get_matching_listings.nest_events([dict(x) for x in rows], filters.min_days_on_market, new_mls=new_mls)
+        differ = [a['mls_number'] for a, b in zip(scanned, indexed) if a['new'] != b['new']]
+        if index_applies(filters):
+            num_differ += len(differ)
+        scan_ms = best_ms(lambda: get_matching_listings.nest_events([dict(x) for x in rows], filters.min_days_on_market, today=day))
+        index_ms = best_ms(lambda: get_matching_listings.nest_events([dict(x) for x in rows], filters.min_days_on_market, new_mls=new_mls))
+        print(
+            f"{profile:<12} listings {len(scanned):>6}  new {sum(x['new'] for x in scanned):>4}  differ {len(differ):>3}"
+            f" {'index' if index_applies(filters) else 'scan ':<5}"
+            f"  nest_events scan {scan_ms:7.2f}ms, index {index_ms:7.2f}ms"
+        )
+    assert num_differ == 0, f'{num_differ} flags differ where the index applies'
+
+    # Ingestion refresh and the cached lookup
+    mls_numbers = [x[0] for x in dataset.meta[:1000]]
+    with pool.connection() as db:
+        start = time.perf_counter()
+        apply_ingested_events(db, mls_numbers)
+        refresh_ms = (time.perf_counter() - start) * 1000
+        lookup_ms = best_ms(lambda: NewTodayIndex().get(db, day, 0))
+        cached_ms = best_ms(lambda: index.get(db, day, 0))
+    print(f'refresh of 1000 listings {refresh_ms:.1f}ms, lookup {lookup_ms:.2f}ms, cached {cached_ms * 1000:.1f}us')
+
+    # A day change empties the cache without anything else happening
+    tomorrow = (today + datetime.timedelta(days=1)).strftime('%Y-%m-%d')
+    with pool.connection() as db:
+        before = index.num_lookups
+        index.get(db, tomorrow, 0)
+        assert index.num_lookups == before + 1 and index.key == (tomorrow, 0)
+    print(f'market date {day} in mountain time, worker clock {datetime.date.today()}')
@@ -0,0 +1,173 @@
+from __future__ import annotations
+import re
+import json
+import base64
+
+# Rows are walked in this order for both paging modes so a cursor taken
+# from one page always lines up with the next one
+ORDER_BY = "ORDER BY mls_number, event_date DESC"
+
+EVENT_DATE_PATTERN = re.compile(r'^\d{4}-\d{2}-\d{2}( \d{2}:\d{2}:\d{2}(\.\d+)?)?$')
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(mls_number: str, event_date: str) -> str:
+
+    """
+    Packs the sort tuple of the last row on a page into an opaque token.
+    """
+
+    raw = json.dumps([mls_number, event_date], separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str) -> tuple[str, str]:
+
+    """
+    Unpacks a token from encode_cursor. Raises InvalidCursor for anything
+    that was not produced by encode_cursor, since the values end up in SQL.
+    """
+
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        mls_number, event_date = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    except (ValueError, TypeError):
+        raise InvalidCursor('Invalid cursor')
+
+    if not isinstance(mls_number, str) or not isinstance(event_date, str):
+        raise InvalidCursor('Invalid cursor')
+    if not EVENT_DATE_PATTERN.match(event_date):
+        raise InvalidCursor('Invalid cursor')
+
+    return mls_number, event_date
+
+
+# Rows after the cursor in ORDER_BY order. The plain mls_number bound is
+# kept separate from the tuple comparison so Postgres can push it down
+# through the window function CTEs, which are partitioned by mls_number,
+# and start the scan at the cursor
+KEYSET_FILTER = """
+        AND mls_number >= %(cursor_mls)s
+        AND (mls_number > %(cursor_mls)s OR event_date < %(cursor_date)s)
+        """
+
+
+# Before every event date, so a cursor on it goes past whatever is left of
+# that listing's events
+FIRST_EVENT_DATE = '0001-01-01'
+
+
+def listing_end_cursor(mls_number: str) -> str:
+
+    """
+    Cursor for the listing after mls_number.
+    """
+
+    return encode_cursor(mls_number, FIRST_EVENT_DATE)
+
+
+def trim_partial_listing(data: list[dict], page_size: int) -> tuple[list[dict], str | None]:
+
+    """
+    A full page usually ends part way through a listing's events. Drop
+    that trailing listing so it comes back whole on the next page, and
+    return the cursor for the last complete listing. The cursor is None
+    once there are no more pages.
+
+    A listing with more events than a page never comes back whole. It is
+    returned on its own with its newest page_size events, and the cursor
+    skips the rest of them. Its older events would otherwise start the
+    next page without the rn = 1 row that nest_events hangs them on.
+    """
+
+    if len(data) < page_size:
+        return data, None
+
+    last_mls = data[-1]['mls_number']
+    complete = [x for x in data if x['mls_number'] != last_mls]
+
+    # A single listing with more events than a page, see above
+    if not complete:
+        return data, listing_end_cursor(last_mls)
+
+    last_row = complete[-1]
+    return complete, encode_cursor(last_row['mls_number'], last_row['event_date'])
+
+
+def next_listing_cursor(data: list[dict], page_size: int) -> str | None:
+
+    """
+    Cursor for pages that already hold one row per listing.
+    """
+
+    if len(data) < page_size:
+        return None
+    return encode_cursor(data[-1]['mls_number'], data[-1]['event_date'])
+
+
+if __name__ == '__main__':
+
+    # Walks cursor pages in row mode, with many listings holding more
+    # events than a page, for row dicts, compact rows and columns. No page
+    # starts part way through a listing, every listing comes back exactly
+    # once, each oversized listing with its newest page_size events, and
+    # every other listing whole
+    import copy
+    import json
+    import columnar
+    import get_matching_listings
+    from alert_models import AlertFilters
+    from benchmark_nest_events import make_event_rows
+    from db_pool import ResultColumns, ResultRows
+    from json_stream import json_default
+
+    def after(rows: list[dict], cursor: str | None) -> list[dict]:
+
+        # What KEYSET_FILTER leaves of rows in ORDER_BY order
+        if cursor is None:
+            return rows
+        cursor_mls, cursor_date = decode_cursor(cursor)
+        return [x for x in rows if x['mls_number'] > cursor_mls or (x['mls_number'] == cursor_mls and x['event_date'] < cursor_date)]
+
+    def build(kind: str, page: list[dict], page_size: int, today: str):
+        names = list(page[0]) if page else []
+        if kind == 'rows':
+            data = ResultRows(names, [tuple(row[x] for x in names) for row in page])
+        elif kind == 'columns':
+            data = ResultColumns(names, [[row[x] for row in page] for x in names])
+            return columnar.build_results(data, None, page_size, True, False, today)
+        else:
+            data = copy.deepcopy(page)
+        return get_matching_listings.build_results(data, AlertFilters(), page_size, True, False, today)
+
+    today = get_matching_listings.current_day()
+    # In ORDER_BY order: mls_number, then newest event first
+    rows = make_event_rows(3000, seed=1, events_per_listing=10)
+    rows.sort(key=lambda x: x['event_date'], reverse=True)
+    rows.sort(key=lambda x: x['mls_number'])
+    num_events = {}
+    for row in rows:
+        num_events[row['mls_number']] = num_events.get(row['mls_number'], 0) + 1
+    whole = {x['mls_number']: x for x in get_matching_listings.nest_events(copy.deepcopy(rows), None, today)}
+
+    for page_size in (3, 8, 19, 500):
+        oversized = {mls for mls, n in num_events.items() if n > page_size}
+        for kind in ('dicts', 'rows', 'columns'):
+            seen = []
+            cursor = ''
+            while cursor is not None:
+                page = after(rows, cursor or None)[:page_size]
+                assert not page or page[0]['rn'] == 1, (page_size, kind, page[0]['mls_number'])
+                listings, cursor = build(kind, page, page_size, today)
+                seen.extend(listings)
+            assert sorted(x['mls_number'] for x in seen) == sorted(num_events), (page_size, kind)
+            for listing in seen:
+                expected = whole[listing['mls_number']]['events']
+                if listing['mls_number'] in oversized:
+                    head = [x for x in rows if x['mls_number'] == listing['mls_number']][:page_size]
+                    expected = [x for x in expected if x['event_date'] >= head[-1]['event_date']]
+                assert json.dumps(listing['events'], default=json_default) == json.dumps(expected), (page_size, kind, listing['mls_number'])
+        print(f'page size {page_size:>3}: {len(num_events)} listings once each, {len(oversized)} longer than a page')
@@ -0,0 +1,404 @@
+from __future__ import annotations
+import sys
+import hashlib
+from functools import lru_cache
+from alert_models import RentalAlertFilters
+from alert_cache import bump_data_version, data_version_column, data_version_ddl
+from query_compiler import CompiledQuery
+
+# Rentals get a state table from the start. Everything the alert query
+# filters on is denormalized into one row per listing, next to the rent
+# history, so a request is an indexed scan of rental_current_state plus a
+# join to rental_listing_meta for the page it returns. The window functions
+# that build the rows run at ingestion, see apply_ingested_rentals
+RENTAL_STATE_DDL = """
+CREATE TABLE IF NOT EXISTS rental_current_state (
+    listing_id text PRIMARY KEY,
+    price float8,
+    sq_ft int,
+    price_per_sq_ft float8,
+    year_built int,
+    beds int,
+    baths int,
+    last_event_date timestamp,
+    price_history json NOT NULL DEFAULT '[]',
+    num_price_changes int NOT NULL DEFAULT 0,
+    city text,
+    zip_code text,
+    pets_allowed bool,
+    available_date date,
+    available_now bool,
+    amenities text[] NOT NULL DEFAULT '{}',
+    updated_at timestamptz NOT NULL DEFAULT now()
+);
+CREATE INDEX IF NOT EXISTS rental_current_state_order_idx ON rental_current_state (last_event_date DESC, listing_id DESC);
+CREATE INDEX IF NOT EXISTS rental_current_state_price_idx ON rental_current_state (price);
+CREATE INDEX IF NOT EXISTS rental_current_state_beds_baths_idx ON rental_current_state (beds, baths);
+CREATE INDEX IF NOT EXISTS rental_current_state_city_idx ON rental_current_state (city);
+CREATE INDEX IF NOT EXISTS rental_current_state_zip_code_idx ON rental_current_state (zip_code);
+CREATE INDEX IF NOT EXISTS rental_current_state_available_idx ON rental_current_state (available_date);
+CREATE INDEX IF NOT EXISTS rental_current_state_amenities_idx ON rental_current_state USING gin (amenities);
+"""
+
+# The rental alerts themselves, one row per saved search. Same role as
+# report_recipients for sales; the filter columns are RentalAlertFilters
+RENTAL_ALERTS_DDL = """
+CREATE TABLE IF NOT EXISTS rental_report_recipients (
+    id int GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+    owner_id text NOT NULL,
+    owner_email text,
+    recipient_email text,
+    cadence text,
+    active bool NOT NULL DEFAULT TRUE,
+    nickname text,
+    min_price float8,
+    max_price float8,
+    min_beds int,
+    max_beds int,
+    min_baths int,
+    max_baths int,
+    min_sq_ft int,
+    max_sq_ft int,
+    pets_allowed bool,
+    available_by date,
+    amenities jsonb,
+    cities jsonb,
+    zip_codes jsonb
+);
+CREATE INDEX IF NOT EXISTS rental_report_recipients_owner_idx ON rental_report_recipients (owner_id);
+"""
+
+STATE_COLUMNS = [
+    'price', 'sq_ft', 'price_per_sq_ft', 'year_built', 'beds', 'baths', 'last_event_date',
+    'price_history', 'num_price_changes', 'city', 'zip_code', 'pets_allowed',
+    'available_date', 'available_now', 'amenities',
+]
+
+# Filters on the current listing row, in the order they are applied. The
+# columns exist in rental_current_state and in rental_listings_cte alike
+RENTAL_FILTERS = [
+    ('min_price', "AND r.price >= %(min_price)s"),
+    ('max_price', "AND r.price <= %(max_price)s"),
+    ('min_beds', "AND r.beds >= %(min_beds)s"),
+    ('max_beds', "AND r.beds <= %(max_beds)s"),
+    ('min_baths', "AND r.baths >= %(min_baths)s"),
+    ('max_baths', "AND r.baths <= %(max_baths)s"),
+    ('min_sq_ft', "AND r.sq_ft >= %(min_sq_ft)s"),
+    ('max_sq_ft', "AND r.sq_ft <= %(max_sq_ft)s"),
+    ('pets_allowed', "AND r.pets_allowed = %(pets_allowed)s"),
+    ('available_by', "AND (r.available_now IS TRUE OR r.available_date <= %(available_by)s::date)"),
+    ('amenities', "AND r.amenities @> %(amenities)s::text[]"),
+    ('cities', None),
+    ('zip_codes', None),
+]
+
+# What a rental result holds, listing row and meta, in response order
+RENTAL_SELECT = [
+    'r.listing_id', 'rm.property_id', 'r.price', 'r.beds', 'r.baths', 'r.sq_ft',
+    'r.price_per_sq_ft', 'r.year_built', 'rm.property_type', 'rm.street_address', 'r.city',
+    'rm.state', 'r.zip_code', 'rm.primary_image', 'rm.image_urls', 'rm.listing_url',
+    'r.available_date::text', 'r.available_now', 'r.pets_allowed', 'rm.min_lease_length',
+    'rm.max_lease_length', 'rm.deposit_total', 'rm.deposit_refundable', 'rm.utilities',
+    'r.amenities', 'rm.contact_name', 'rm.contact_email', 'rm.contact_phone', 'rm.contact_sms',
+    'r.last_event_date::text AS event_date', 'r.price_history', 'r.num_price_changes',
+    'left(r.last_event_date::text, 10) = %(today)s AS new',
+]
+
+# Newest activity first, for both paging modes
+RENTAL_ORDER_BY = "ORDER BY r.last_event_date DESC, r.listing_id DESC"
+
+RENTAL_KEYSET_FILTER = "AND (r.last_event_date, r.listing_id) < (%(cursor_date)s::timestamp, %(cursor_id)s)"
+
+# Rentals' own data version, so a rental batch leaves cached sales pages
+# and their ETags alone, and the other way round
+RENTAL_DATA_VERSION_TABLE = 'rental_ingestion_state'
+RENTAL_DATA_VERSION_DDL = data_version_ddl(RENTAL_DATA_VERSION_TABLE)
+
+RENTAL_FILTER_LOOKUP_SQL = f"""select *, {data_version_column(RENTAL_DATA_VERSION_TABLE)} as data_version
+              from rental_report_recipients where id = %(alert_id)s
+              and (owner_id = %(user_id)s or recipient_email = %(email)s)
+              """
+
+# Listings with events newer than their state row, or none at all. The
+# catch up for batches whose loader didn't call apply_ingested_rentals
+STALE_LISTINGS_SQL = """
+SELECT e.listing_id
+FROM rental_listing_events e
+LEFT JOIN rental_current_state s USING (listing_id)
+GROUP BY e.listing_id, s.last_event_date
+HAVING s.last_event_date IS NULL OR max(e.event_date) > s.last_event_date
+"""
+
+# Listings whose events or meta are gone
+DELETE_STALE_SQL = """
+DELETE FROM rental_current_state s
+WHERE s.listing_id = ANY (%(listing_ids)s)
+AND NOT EXISTS (
+    SELECT 1 FROM rental_listing_meta rm
+    JOIN rental_listing_events USING (listing_id)
+    WHERE rm.listing_id = s.listing_id
+)
+"""
+
+
+def rental_listings_cte(extra: str = "") -> str:
+
+    """
+    One row per rental listing from the raw tables in a single grouped
+    pass: its latest event, the rent changes newest first and the meta
+    columns the filters read. extra is appended to the event WHERE clause
+    as is. This is what every request would run without
+    rental_current_state.
+    """
+
+    sql = f"""
+    rental_events AS (
+            SELECT *,
+            LAG(price) OVER (PARTITION BY listing_id ORDER BY event_date) AS old_price
+            FROM rental_listing_events
+            WHERE TRUE
+            {extra}
+        ),
+    rental_listings AS (
+            SELECT e.*,
+            rm.city, rm.zip_code, rm.pets_allowed, rm.available_date, rm.available_now,
+            ARRAY(
+                SELECT DISTINCT jsonb_array_elements_text(
+                    COALESCE(rm.property_amenities, '[]') || COALESCE(rm.community_amenities, '[]')
+                ) ORDER BY 1
+            ) AS amenities
+            FROM (
+                SELECT listing_id,
+                (array_agg(price ORDER BY event_date DESC))[1] AS price,
+                (array_agg(sq_ft ORDER BY event_date DESC))[1] AS sq_ft,
+                (array_agg(price_per_sq_ft ORDER BY event_date DESC))[1] AS price_per_sq_ft,
+                (array_agg(year_built ORDER BY event_date DESC))[1] AS year_built,
+                (array_agg(beds ORDER BY event_date DESC))[1] AS beds,
+                (array_agg(baths ORDER BY event_date DESC))[1] AS baths,
+                max(event_date) AS last_event_date,
+                COALESCE(
+                    json_agg(
+                        json_build_object(
+                            'event_date', event_date::text,
+                            'price', price,
+                            'old_price', old_price,
+                            'price_diff', price - old_price
+                        )
+                        ORDER BY event_date DESC
+                    ) FILTER (WHERE price <> old_price),
+                    '[]'::json
+                ) AS price_history,
+                COUNT(*) FILTER (WHERE price <> old_price) AS num_price_changes
+                FROM rental_events
+                GROUP BY listing_id
+            ) e
+            JOIN rental_listing_meta rm USING (listing_id)
+        )
+    """
+    return sql
+
+
+def _upsert_sql(only_listed: bool) -> str:
+    extra = "AND listing_id = ANY (%(listing_ids)s)" if only_listed else ""
+    updates = ",\n        ".join(f"{x} = EXCLUDED.{x}" for x in STATE_COLUMNS)
+    return f"""
+    WITH {rental_listings_cte(extra)}
+    INSERT INTO rental_current_state (listing_id, {", ".join(STATE_COLUMNS)}, updated_at)
+    SELECT listing_id, {", ".join(STATE_COLUMNS)}, now()
+    FROM rental_listings
+    ON CONFLICT (listing_id) DO UPDATE SET
+        {updates},
+        updated_at = now()
+    """
+
+
+def create_table(db):
+
+    """
+    Creates rental_report_recipients, rental_current_state and
+    rental_ingestion_state.
+    """
+
+    for statement in (RENTAL_ALERTS_DDL + RENTAL_STATE_DDL + RENTAL_DATA_VERSION_DDL).split(';'):
+        if statement.strip():
+            db.query(statement)
+
+
+def apply_ingested_rentals(db, listing_ids: list[str]) -> int:
+
+    """
+    Called by the rental loader, in the transaction that writes a batch
+    of RentalListingEvents or RentalListingMeta and before it bumps the
+    rental data version. Only the listings that changed are recomputed. The
+    rental scraper's loader lives outside this repo; it can also run
+    `python rental_alerts.py refresh` after each batch, see refresh.
+    """
+
+    listing_ids = sorted(set(listing_ids))
+    if not listing_ids:
+        return 0
+    params = {'listing_ids': listing_ids}
+    db.query(_upsert_sql(only_listed=True), params=params)
+    db.query(DELETE_STALE_SQL, params=params)
+    return len(listing_ids)
+
+
+def refresh(db, listing_ids: list[str] = None) -> int:
+
+    """
+    apply_ingested_rentals for listing_ids, or for every listing whose
+    events are newer than its state row, then bumps the rental data
+    version so cached rental pages are dropped. Meta only changes have no
+    timestamp to find them by, so loaders pass those listing_ids.
+    """
+
+    with db.transaction():
+        if listing_ids is None:
+            listing_ids = [x['listing_id'] for x in db.query(STALE_LISTINGS_SQL)]
+        num_listings = apply_ingested_rentals(db, listing_ids)
+    if num_listings:
+        bump_data_version(db, RENTAL_DATA_VERSION_TABLE)
+    return num_listings
+
+
+def rebuild(db):
+
+    """
+    Backfills the table from scratch.
+    """
+
+    create_table(db)
+    db.query("TRUNCATE rental_current_state")
+    db.query(_upsert_sql(only_listed=False))
+    db.query("ANALYZE rental_current_state")
+
+
+def rental_filter_shape(filters: RentalAlertFilters) -> tuple[str, ...]:
+
+    """
+    The names of the filters that are set. Like query_compiler.filter_shape,
+    0, False and empty lists count as unset, so pets_allowed False means
+    pets don't matter rather than no pets.
+    """
+
+    return tuple(name for name, _ in RENTAL_FILTERS if getattr(filters, name))
+
+
+def rental_filter_params(filters: RentalAlertFilters) -> dict:
+    params = {}
+    for name in rental_filter_shape(filters):
+        value = getattr(filters, name)
+        params[name] = list(value) if isinstance(value, (list, tuple)) else value
+    return params
+
+
+def rental_filter_clauses(shape: tuple[str, ...]) -> str:
+    clauses = []
+    for name, clause in RENTAL_FILTERS:
+        if name == 'cities':
+            if 'cities' in shape and 'zip_codes' in shape:
+                clauses.append("AND (r.city = ANY (%(cities)s) OR r.zip_code = ANY (%(zip_codes)s))")
+            elif 'cities' in shape:
+                clauses.append("AND r.city = ANY (%(cities)s)")
+            elif 'zip_codes' in shape:
+                clauses.append("AND r.zip_code = ANY (%(zip_codes)s)")
+        elif name in shape and clause:
+            clauses.append(clause)
+    return "\n        ".join(clauses)
+
+
+@lru_cache(maxsize=256)
+def compile_rental_shape(shape: tuple[str, ...], paging: str, source: str = 'state') -> CompiledQuery:
+
+    """
+    Builds the rental listing query for a filter shape once per process.
+    paging is 'offset', 'cursor' or 'cursor_start'. source='events'
+    computes the listing rows from the raw tables with
+    rental_listings_cte instead of reading rental_current_state, for
+    comparison and for databases where the table hasn't been built.
+    """
+
+    if paging == 'offset':
+        page_sql = "OFFSET %(offset)s LIMIT %(limit)s"
+    else:
+        page_sql = "LIMIT %(limit)s"
+
+    if source == 'state':
+        ctes = ""
+        table = "rental_current_state"
+    else:
+        ctes = f"WITH {rental_listings_cte()}"
+        table = "rental_listings"
+
+    sql = f"""
+        {ctes}
+        SELECT {', '.join(RENTAL_SELECT)}
+        FROM {table} r
+        JOIN rental_listing_meta rm USING (listing_id)
+        WHERE TRUE
+        {rental_filter_clauses(shape)}
+        {RENTAL_KEYSET_FILTER if paging == 'cursor' else ""}
+        {RENTAL_ORDER_BY}
+        {page_sql};
+        """
+
+    digest = hashlib.sha1(repr((shape, paging, source)).encode()).hexdigest()[:12]
+    return CompiledQuery(name=f"rental_listings_{digest}", sql=sql)
+
+
+def compile_rental_query(
+        filters: RentalAlertFilters,
+        today: str,
+        page: int = 1,
+        page_size: int = 500,
+        use_cursor: bool = False,
+        cursor: tuple[str, str] | None = None,
+        source: str = 'state',
+) -> tuple[CompiledQuery, dict]:
+
+    """
+    compile_listings_query for rentals. cursor is a decoded
+    pagination cursor, (listing_id, event_date) of the last row of the
+    previous page.
+    """
+
+    params = rental_filter_params(filters)
+    params['today'] = today
+    params['limit'] = page_size
+
+    if not use_cursor:
+        paging = 'offset'
+        params['offset'] = (page - 1) * page_size
+    elif cursor:
+        paging = 'cursor'
+        params['cursor_id'], params['cursor_date'] = cursor
+    else:
+        paging = 'cursor_start'
+
+    query = compile_rental_shape(rental_filter_shape(filters), paging, source)
+    return query, params
+
+
+if __name__ == '__main__':
+
+    # python rental_alerts.py create
+    #     creates the rental alert and state tables
+    # python rental_alerts.py rebuild
+    # python rental_alerts.py refresh [listing_id ...]
+    #     after a rental ingestion batch, for its listings or, without
+    #     any, for every listing with newer events than its state row
+    from db_pool import POOL
+
+    command = sys.argv[1] if len(sys.argv) > 1 else 'rebuild'
+    with POOL.connection() as db:
+        if command == 'create':
+            create_table(db)
+            print('rental tables created')
+        elif command == 'rebuild':
+            rebuild(db)
+            print('rental_current_state rebuilt')
+        elif command == 'refresh':
+            num_listings = refresh(db, sys.argv[2:] or None)
+            print(f'rental_current_state refreshed for {num_listings} listings')
+        else:
+            sys.exit(f'unknown command {command}')
@@ -0,0 +1,89 @@
+from __future__ import annotations
+import os
+import zlib
+
+# Bodies smaller than this aren't worth the CPU or the base64 overhead
+MIN_COMPRESS_BYTES = int(os.environ.get('ALERTS_MIN_COMPRESS_BYTES', 1024))
+
+# Fast settings, the body is compressed on every cache miss and the
+# higher levels buy little on JSON this repetitive
+GZIP_LEVEL = int(os.environ.get('ALERTS_GZIP_LEVEL', 5))
+BROTLI_QUALITY = int(os.environ.get('ALERTS_BROTLI_QUALITY', 4))
+
+_brotli = None
+
+
+def brotli_module():
+
+    """
+    brotli is optional. Without it only gzip is offered.
+    """
+
+    global _brotli
+    if _brotli is None:
+        try:
+            import brotli
+            _brotli = brotli
+        except ImportError:
+            _brotli = False
+    return _brotli or None
+
+
+def accepted_encodings(accept_encoding: str | None) -> dict[str, float]:
+
+    """
+    Accept-Encoding as {coding: q}. Codings with q=0 are refused.
+    """
+
+    accepted = {}
+    for item in (accept_encoding or '').split(','):
+        coding, _, params = item.strip().partition(';')
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in params.split(';'):
+            name, _, value = param.strip().partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        accepted[coding] = q
+    return accepted
+
+
+def choose_encoding(accept_encoding: str | None) -> str | None:
+
+    """
+    br if the client takes it and brotli is installed, else gzip, else
+    None for an uncompressed body.
+    """
+
+    accepted = accepted_encodings(accept_encoding)
+    candidates = ['br', 'gzip'] if brotli_module() else ['gzip']
+    best = None
+    for coding in candidates:
+        q = accepted.get(coding, accepted.get('*', 0.0))
+        if q > 0 and (best is None or q > best[1]):
+            best = coding, q
+    return best[0] if best else None
+
+
+def compress(data: bytes, encoding: str) -> bytes:
+    if encoding == 'br':
+        return brotli_module().compress(data, quality=BROTLI_QUALITY)
+    if encoding == 'gzip':
+
+        # wbits 31 writes the gzip header and trailer
+        compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+        return compressor.compress(data) + compressor.flush()
+    raise ValueError(f'Unsupported encoding: {encoding}')
+
+
+def decompress(data: bytes, encoding: str) -> bytes:
+    if encoding == 'br':
+        return brotli_module().decompress(data)
+    if encoding == 'gzip':
+        return zlib.decompress(data, 31)
+    raise ValueError(f'Unsupported encoding: {encoding}')
@@ -0,0 +1,112 @@
+from __future__ import annotations
+from functools import lru_cache
+from operator import itemgetter
+
+# The row type compact_rows builds pages from, on its own so json_stream
+# and field_projection can handle records without importing compact_rows
+# and, through it, the database layer
+
+
+class Record:
+
+    """
+    One row as a tuple of values. The subclasses record_type makes carry
+    the field names and their positions. Reads like a dict that can't be
+    changed, so a cached page is safe to share between requests.
+    """
+
+    __slots__ = ('row',)
+    fields: tuple[str, ...] = ()
+    index: dict[str, int] = {}
+
+    def __init__(self, row: tuple):
+        self.row = row
+
+    def __getitem__(self, name: str):
+        return self.row[self.index[name]]
+
+    def get(self, name: str, default=None):
+        i = self.index.get(name)
+        return default if i is None else self.row[i]
+
+    def __contains__(self, name) -> bool:
+        return name in self.index
+
+    def __iter__(self):
+        return iter(self.fields)
+
+    def __len__(self):
+        return len(self.fields)
+
+    def keys(self) -> tuple[str, ...]:
+        return self.fields
+
+    def values(self) -> tuple:
+        return self.row
+
+    def items(self):
+        return zip(self.fields, self.row)
+
+    def __eq__(self, other):
+        if type(other) is type(self):
+            return self.row == other.row
+        if isinstance(other, (dict, Record)):
+            return self.as_dict() == dict(other.items())
+        return NotImplemented
+
+    __hash__ = None
+
+    def as_dict(self) -> dict:
+        return dict(zip(self.fields, self.row))
+
+    def __repr__(self):
+        return f'Record - {self.as_dict()}'
+
+
+@lru_cache(maxsize=256)
+def record_type(fields: tuple[str, ...]) -> type[Record]:
+
+    """
+    The Record subclass for one schema, shared by every row with those
+    fields in that order.
+    """
+
+    return type('Record', (Record,), {
+        '__slots__': (),
+        'fields': fields,
+        'index': {x: i for i, x in enumerate(fields)},
+    })
+
+
+def project(records: list[Record], fields: tuple[str, ...]) -> list[Record]:
+
+    """
+    field_projection.Projection.apply for a page of records, which all
+    share one schema. Fields the records don't have are left out.
+    """
+
+    if not records:
+        return records
+    source = type(records[0])
+    names = tuple(x for x in fields if x in source.index)
+    positions = [source.index[x] for x in names]
+    target = record_type(names)
+
+    # itemgetter returns a bare value, not a tuple, for a single field
+    if len(positions) == 1:
+        i = positions[0]
+        return [target((x.row[i],)) for x in records]
+    pick = itemgetter(*positions)
+    return [target(pick(x.row)) for x in records]
+
+
+def append_field(records: list[Record], name: str, values: list) -> list[Record]:
+
+    """
+    The records with one more field at the end, one value per record.
+    """
+
+    if not records:
+        return records
+    target = record_type(type(records[0]).fields + (name,))
+    return [target(x.row + (value,)) for x, value in zip(records, values)]
@@ -0,0 +1,56 @@
+from __future__ import annotations
+from typing import Literal
+
+# Seller motivation scoring, shared by the dict and record result
+# builders. Imports nothing from the project so either can use it
+
+SellerMotivationScore = Literal["High", "Moderate", "Undetected"]
+
+
+def seller_motivation_score(listing: dict) -> SellerMotivationScore:
+
+    # Account for the number of price drops, already counted when the
+    # listing comes from nested_listings_cte
+    num_price_drops = listing.get('num_price_drops')
+    if num_price_drops is None:
+        events = listing.get('events')
+        num_price_drops = len([x for x in events if x.get('price_diff') < 0])
+
+    return motivation_score(listing.get('seller_motivation'), listing.get('current_days_on_market'), num_price_drops)
+
+def motivation_score(seller_motivation: bool | None, days_on_market: int, num_price_drops: int) -> SellerMotivationScore:
+
+    """
+    seller_motivation_score from the three values it depends on, for
+    callers that don't hold the listing as a dict.
+    """
+
+    score = 0
+
+    # Get the gpt3.5 rated score based on description
+    if seller_motivation is True:
+        score += 4
+
+    # Account for days on market
+    if 90 < days_on_market < 180:
+        score += 3
+    elif days_on_market > 60:
+        score += 2
+    elif days_on_market > 30:
+        score += 1
+
+    # Account for the number of price drops
+    if num_price_drops == 1:
+        score += 1
+    elif num_price_drops == 2:
+        score += 2
+    elif num_price_drops > 2:
+        score += 3
+
+    # Assign score
+    if score >= 6:
+        return "High"
+    elif score >= 3:
+        return "Moderate"
+    else:
+        return "Undetected"
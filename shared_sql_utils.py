@@ -1,111 +1,275 @@
-from __future__ import annotations
-from umc_models import AlertFilters
-
-def format_cities_zips(cities: list[str], zips: list[str]) -> str:
-
-    """
-    Handles filtering by cities and zips in the case of each being
-    present or each being null.
-    """
-
-    if cities and zips:
-        return f"AND lm.city in {tuple(cities)} OR lm.zip in {tuple(zips)}"
-    elif cities:
-        return f"AND lm.city in {tuple(cities)}"
-    elif zips:
-        return f"AND lm.zip_code in {tuple(zips)}"
-    else:
-        return ""
-
-
-def format_keywords(keywords: str) -> str:
-
-    """
-    Formats keywords for filtering in listing descriptions.
-    """
-
-    if keywords:
-        keywords = keywords.split(',')
-        keywords = [x.strip().lower() for x in keywords]
-        keywords = [f"'%{x}%'" for x in keywords]
-        sql = f"""
-        AND description ILIKE ANY (array[{", ".join(keywords)}]) 
-        """
-        return sql
-    else:
-        return ""
-
-
-def base_listings_cte(filters: AlertFilters) -> str:
-
-    """
-    Pass in AlertFilters to get the base listing events given the filters.
-    Joins the listing_meta as well to get all rows needed for the further
-    aggregations and calculations.
-    """
-
-    sql = f"""
-    WITH base_listings AS (
-            SELECT DISTINCT ON (mls_number, price) mls_number,
-            date_listed::text, price, event_date::text, beds, baths, street_address, city, sq_ft, year_built, price_per_sq_ft,
-            images, property_type, seller_motivation, num_kitchens, status, days_on_market, description, url, active,
-            (CURRENT_DATE - date_listed::date) AS current_days_on_market
-            FROM listing_events
-            JOIN listing_meta lm USING (mls_number)
-            WHERE lm.active IS TRUE
-            {f"AND price >= {filters.min_price}" if filters.min_price else ""}
-            {f"AND price <= {filters.max_price}" if filters.max_price else ""}
-            {f"AND sq_ft >= {filters.min_sq_ft}" if filters.min_sq_ft else ""}
-            {f"AND sq_ft <= {filters.max_sq_ft}" if filters.max_sq_ft else ""}
-            {f"AND beds >= {filters.min_beds}" if filters.min_beds else ""}
-            {f"AND beds <= {filters.max_beds}" if filters.max_beds else ""}
-            {f"AND baths >= {filters.min_baths}" if filters.min_baths else ""}
-            {f"AND baths <= {filters.max_baths}" if filters.max_baths else ""}
-            {f"AND year_built >= {filters.min_year_built}" if filters.min_year_built else ""}
-            {f"AND year_built <= {filters.max_year_built}" if filters.max_year_built else ""}
-            {f"AND price_per_sq_ft >= {filters.min_price_per_sq_ft}" if filters.min_price_per_sq_ft else ""}
-            {f"AND price_per_sq_ft <= {filters.max_price_per_sq_ft}" if filters.max_price_per_sq_ft else ""}
-            {format_cities_zips(filters.cities, filters.zip_codes)}
-            {f"AND lm.property_type in {tuple(filters.property_types)}" if filters.property_types else ""}
-            {format_keywords(filters.keywords)}
-            {f"AND num_kitchens >= {filters.num_kitchens}" if filters.num_kitchens else ""}
-            {f"AND (CURRENT_DATE - date_listed::date) >= {filters.min_days_on_market}" if filters.min_days_on_market else ""}
-            {f"AND (CURRENT_DATE - date_listed::date) <= {filters.max_days_on_market}" if filters.max_days_on_market else ""}
-            ORDER BY mls_number, price, event_date DESC
-            )
-    """
-
-    return sql
-
-def price_lead_cte(cte_name: str = "price_lead") -> str:
-
-    """
-    Adds the price lead column using LEAD window function in order to track
-    price changes.
-    """
-
-    sql = f"""
-    {cte_name} AS (
-            SELECT *,
-            ROW_NUMBER() OVER (PARTITION BY mls_number ORDER BY event_date DESC) AS rn,
-            LEAD(price) OVER (PARTITION BY mls_number ORDER BY event_date) AS new_price
-            FROM base_listings
-        )
-    """
-    return sql
-
-def final_agg_cte(cte_name: str = "final_fields") -> str:
-
-    """
-    Gets a few final fields to include in the response rather than doing it on the FE.
-    """
-
-    sql = f"""
-    {cte_name} AS (
-            SELECT *,
-            (new_price - price) as price_diff,
-            MAX(ABS(new_price - price)) OVER (PARTITION BY mls_number) AS biggest_price_drop
-            FROM price_lead
-        )
-    """
-    return sql
\ No newline at end of file
+from __future__ import annotations
+from alert_models import AlertFilters
+from keyword_search import split_terms, expand_terms, ilike_patterns
+from geography import geo_zip_codes
+
+def sql_array(values: list) -> str:
+
+    """
+    Renders a list as a Postgres array literal. Unlike tuple(), this is
+    valid SQL for a single value and quotes embedded apostrophes.
+    """
+
+    items = []
+    for x in values:
+        if isinstance(x, str):
+            items.append("'" + x.replace("'", "''") + "'")
+        else:
+            items.append(str(x))
+    return f"ARRAY[{', '.join(items)}]"
+
+
+def format_cities_zips(cities: list[str], zips: list[str], counties: list[str] = None, entire_state: bool = None) -> str:
+
+    """
+    Handles filtering by cities and zips in the case of each being
+    present or each being null. Counties match through their zip codes,
+    and entire_state drops the filter.
+    """
+
+    if entire_state:
+        return ""
+    if counties:
+        zips = geo_zip_codes(zips, counties)
+
+    if cities and zips:
+        return f"AND (lm.city = ANY ({sql_array(cities)}) OR lm.zip_code = ANY ({sql_array(zips)}))"
+    elif cities:
+        return f"AND lm.city = ANY ({sql_array(cities)})"
+    elif zips:
+        return f"AND lm.zip_code = ANY ({sql_array(zips)})"
+    elif counties:
+
+        # None of the counties are known, so nothing is in them
+        return "AND FALSE"
+    else:
+        return ""
+
+
+def format_keywords(keywords: str, enhance: bool = False) -> str:
+
+    """
+    Formats keywords for filtering in listing descriptions.
+    """
+
+    if keywords:
+        keywords = ilike_patterns(expand_terms(split_terms(keywords), enhance))
+        sql = f"""
+        AND description ILIKE ANY ({sql_array(keywords)})
+        """
+        return sql
+    else:
+        return ""
+
+
+def format_exclude_keywords(keywords: str, enhance: bool = False) -> str:
+
+    """
+    Drops listings whose description mentions any of the keywords.
+    """
+
+    if keywords:
+        keywords = ilike_patterns(expand_terms(split_terms(keywords), enhance))
+        return f"AND NOT COALESCE(description ILIKE ANY ({sql_array(keywords)}), FALSE)"
+    else:
+        return ""
+
+
+def base_listings_cte(filters: AlertFilters) -> str:
+
+    """
+    Pass in AlertFilters to get the base listing events given the filters.
+    Joins the listing_meta as well to get all rows needed for the further
+    aggregations and calculations.
+    """
+
+    sql = f"""
+    WITH base_listings AS (
+            SELECT DISTINCT ON (mls_number, price) mls_number,
+            date_listed::text, price, event_date::text, beds, baths, street_address, city, sq_ft, year_built, price_per_sq_ft,
+            images, property_type, seller_motivation, num_kitchens, status, days_on_market, description, url, active,
+            (CURRENT_DATE - date_listed::date) AS current_days_on_market
+            FROM listing_events
+            JOIN listing_meta lm USING (mls_number)
+            WHERE lm.active IS TRUE
+            {f"AND price >= {filters.min_price}" if filters.min_price else ""}
+            {f"AND price <= {filters.max_price}" if filters.max_price else ""}
+            {f"AND sq_ft >= {filters.min_sq_ft}" if filters.min_sq_ft else ""}
+            {f"AND sq_ft <= {filters.max_sq_ft}" if filters.max_sq_ft else ""}
+            {f"AND beds >= {filters.min_beds}" if filters.min_beds else ""}
+            {f"AND beds <= {filters.max_beds}" if filters.max_beds else ""}
+            {f"AND baths >= {filters.min_baths}" if filters.min_baths else ""}
+            {f"AND baths <= {filters.max_baths}" if filters.max_baths else ""}
+            {f"AND year_built >= {filters.min_year_built}" if filters.min_year_built else ""}
+            {f"AND year_built <= {filters.max_year_built}" if filters.max_year_built else ""}
+            {f"AND price_per_sq_ft >= {filters.min_price_per_sq_ft}" if filters.min_price_per_sq_ft else ""}
+            {f"AND price_per_sq_ft <= {filters.max_price_per_sq_ft}" if filters.max_price_per_sq_ft else ""}
+            {format_cities_zips(filters.cities, filters.zip_codes, filters.counties, filters.entire_state)}
+            {f"AND lm.property_type = ANY ({sql_array(filters.property_types)})" if filters.property_types else ""}
+            {format_keywords(filters.keywords, filters.enhance_keywords)}
+            {format_exclude_keywords(filters.exclude_keywords, filters.enhance_keywords)}
+            {f"AND num_kitchens >= {filters.num_kitchens}" if filters.num_kitchens else ""}
+            {f"AND (CURRENT_DATE - date_listed::date) >= {filters.min_days_on_market}" if filters.min_days_on_market else ""}
+            {f"AND (CURRENT_DATE - date_listed::date) <= {filters.max_days_on_market}" if filters.max_days_on_market else ""}
+            ORDER BY mls_number, price, event_date DESC
+            )
+    """
+
+    return sql
+
+def price_lead_cte(cte_name: str = "price_lead") -> str:
+
+    """
+    Adds the price lead column using LEAD window function in order to track
+    price changes.
+    """
+
+    sql = f"""
+    {cte_name} AS (
+            SELECT *,
+            ROW_NUMBER() OVER (PARTITION BY mls_number ORDER BY event_date DESC) AS rn,
+            LEAD(price) OVER (PARTITION BY mls_number ORDER BY event_date) AS new_price
+            FROM base_listings
+        )
+    """
+    return sql
+
+def final_agg_cte(cte_name: str = "final_fields") -> str:
+
+    """
+    Gets a few final fields to include in the response rather than doing it on the FE.
+    """
+
+    sql = f"""
+    {cte_name} AS (
+            SELECT *,
+            (new_price - price) as price_diff,
+            MAX(ABS(new_price - price)) OVER (PARTITION BY mls_number) AS biggest_price_drop
+            FROM price_lead
+        )
+    """
+    return sql
+
+def nested_listings_cte(cte_name: str = "nested_listings") -> str:
+
+    """
+    One row per listing with its price change events already nested, the
+    SQL version of nest_events. Also works out the drop count and the 'new'
+    flag so only listing level fields come back over the wire.
+    Takes %(today)s (YYYY-MM-DD) and %(new_min_days)s as bind parameters.
+    """
+
+    sql = f"""
+    {cte_name} AS (
+            SELECT f.*,
+            COALESCE(e.events, '[]'::json) AS events,
+            COALESCE(e.num_price_drops, 0) AS num_price_drops,
+            (
+                COALESCE(e.new_today, FALSE)
+                OR f.current_days_on_market = 0
+                OR COALESCE(f.current_days_on_market = %(new_min_days)s, FALSE)
+            ) AS new
+            FROM final_fields f
+            LEFT JOIN (
+                SELECT mls_number,
+                json_agg(
+                    json_build_object(
+                        'mls_number', mls_number,
+                        'event_date', event_date,
+                        'new_price', new_price,
+                        'old_price', price,
+                        'price_diff', price_diff
+                    )
+                    ORDER BY event_date DESC
+                ) AS events,
+                COUNT(*) FILTER (WHERE price_diff < 0) AS num_price_drops,
+                bool_or(left(event_date, 10) = %(today)s) AS new_today
+                FROM final_fields
+                WHERE price_diff IS NOT NULL AND price_diff <> 0
+                GROUP BY mls_number
+            ) e USING (mls_number)
+            WHERE f.rn = 1
+        )
+    """
+    return sql
+
+# listing_current_state and listing_meta columns as (name, select
+# expression), with the names and order nested_listings_cte gives them
+STATE_SELECT = [
+    ('mls_number', 'mls_number'),
+    ('date_listed', 'lm.date_listed::text'),
+    ('price', 's.price'),
+    ('event_date', 's.last_event_date::text AS event_date'),
+    ('beds', 's.beds'),
+    ('baths', 's.baths'),
+    ('street_address', 'lm.street_address'),
+    ('city', 'lm.city'),
+    ('sq_ft', 's.sq_ft'),
+    ('year_built', 's.year_built'),
+    ('price_per_sq_ft', 's.price_per_sq_ft'),
+    ('images', 'lm.images'),
+    ('property_type', 'lm.property_type'),
+    ('seller_motivation', 'lm.seller_motivation'),
+    ('num_kitchens', 'lm.num_kitchens'),
+    ('status', 's.status'),
+    ('days_on_market', 's.days_on_market'),
+    ('description', 'lm.description'),
+    ('url', 'lm.url'),
+    ('active', 'lm.active'),
+    ('current_days_on_market', '(CURRENT_DATE - lm.date_listed::date) AS current_days_on_market'),
+    ('rn', '1 AS rn'),
+    ('new_price', 'NULL::float8 AS new_price'),
+    ('price_diff', 'NULL::float8 AS price_diff'),
+    ('biggest_price_drop', 's.biggest_price_drop'),
+    ('events', 's.events'),
+    ('num_price_drops', 's.num_price_drops'),
+    ('new', """(
+                COALESCE(left(s.events->0->>'event_date', 10) = %(today)s, FALSE)
+                OR (CURRENT_DATE - lm.date_listed::date) = 0
+                OR COALESCE((CURRENT_DATE - lm.date_listed::date) = %(new_min_days)s, FALSE)
+            ) AS new"""),
+]
+
+def select_list(select: list[tuple[str, str]], columns: tuple[str, ...] = None, max_images: int = None) -> str:
+
+    """
+    Joins the select expressions, only those named in columns when it is
+    given. max_images keeps just the first few entries of the images
+    array. to_jsonb takes it as jsonb, json or a text array alike, and
+    each comes back as the same list.
+    """
+
+    items = []
+    for name, expression in select:
+        if columns is not None and name not in columns:
+            continue
+        if name == 'images' and max_images:
+            expression = f"jsonb_path_query_array(to_jsonb({expression}), '$[0 to {max_images - 1}]') AS images"
+        items.append(expression)
+    return ', '.join(items)
+
+def current_state_cte(
+        where: str = "",
+        cte_name: str = "nested_listings",
+        columns: tuple[str, ...] = None,
+        max_images: int = None,
+) -> str:
+
+    """
+    Same columns as nested_listings_cte, read from the incrementally
+    maintained listing_current_state table instead of re-running the
+    window functions. where is extra AND clauses on the state/meta row.
+    columns and max_images narrow the select list, see select_list.
+    Takes %(today)s and %(new_min_days)s as bind parameters.
+    """
+
+    sql = f"""
+    {cte_name} AS (
+            SELECT {select_list(STATE_SELECT, columns, max_images)}
+            FROM listing_current_state s
+            JOIN listing_meta lm USING (mls_number)
+            WHERE lm.active IS TRUE
+            {where}
+        )
+    """
+    return sql
@@ -0,0 +1,293 @@
+from __future__ import annotations
+import os
+import time
+import uuid
+import threading
+
+# How long a request waits on someone else's computation before running
+# it itself. Well under the Lambda timeout, above a slow listing query
+WAIT_TIMEOUT_SECONDS = float(os.environ.get('ALERTS_FLIGHT_WAIT_SECONDS', 10))
+
+# Cross-worker waits poll the shared cache this often
+POLL_SECONDS = float(os.environ.get('ALERTS_FLIGHT_POLL_SECONDS', 0.05))
+
+
+class _Call:
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class RedisFlightLock:
+
+    """
+    Shared lock so only one worker at a time computes a key. Takes any
+    client with redis-py's set(nx=, px=), get and delete methods. The lock
+    expires on its own if its holder dies.
+    """
+
+    def __init__(self, client, ttl: float = WAIT_TIMEOUT_SECONDS, prefix: str = 'flight:'):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    @classmethod
+    def from_url(cls, url: str, ttl: float = WAIT_TIMEOUT_SECONDS):
+        import redis
+        return cls(redis.Redis.from_url(url), ttl=ttl)
+
+    def acquire(self, key: str) -> str | None:
+
+        """
+        A token for release, or None when another worker holds the lock.
+        """
+
+        token = uuid.uuid4().hex
+        if self.client.set(self.prefix + key, token, nx=True, px=int(self.ttl * 1000)):
+            return token
+        return None
+
+    def held(self, key: str) -> bool:
+        return self.client.get(self.prefix + key) is not None
+
+    def release(self, key: str, token: str):
+
+        # Only drop the lock if it's still ours, it may have expired and
+        # been taken by someone else in the meantime
+        raw = self.client.get(self.prefix + key)
+        if raw is not None and (raw.decode() if isinstance(raw, bytes) else raw) == token:
+            self.client.delete(self.prefix + key)
+
+
+class SingleFlight:
+
+    """
+    Coalesces identical work that is in flight at the same time. The first
+    caller for a key runs fn, and anyone asking for the same key meanwhile
+    waits for and shares its result, or its exception.
+
+        value, role = flight.do(key, fn)
+
+    role is 'leader', 'coalesced' (shared an in-process call), 'shared'
+    (another worker computed it, found through lookup) or 'timeout' (gave
+    up waiting and ran fn itself). With a shared_lock, leaders first take
+    the key's lock across workers; lookup is then how a worker that lost
+    the lock reads the winner's result, e.g. the shared result cache.
+    """
+
+    def __init__(self, shared_lock: RedisFlightLock = None, wait_timeout: float = WAIT_TIMEOUT_SECONDS):
+        self.shared_lock = shared_lock
+        self.wait_timeout = wait_timeout
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.stats = {'leader': 0, 'coalesced': 0, 'shared': 0, 'timeout': 0, 'error': 0}
+
+    def _count(self, role: str):
+        with self._lock:
+            self.stats[role] += 1
+
+    def do(self, key: str, fn, lookup=None) -> tuple:
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            if not call.done.wait(self.wait_timeout):
+                self._count('timeout')
+                return fn(), 'timeout'
+            self._count('coalesced')
+            if call.error is not None:
+                raise call.error
+            return call.value, 'coalesced'
+
+        role = 'leader'
+        try:
+            if self.shared_lock is not None and lookup is not None:
+                call.value, role = self._do_shared(key, fn, lookup)
+            else:
+                call.value = fn()
+        except Exception as e:
+            call.error = e
+            self._count('error')
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+        self._count(role)
+        return call.value, role
+
+    def _do_shared(self, key: str, fn, lookup) -> tuple:
+        deadline = time.monotonic() + self.wait_timeout
+        while True:
+            token = self.shared_lock.acquire(key)
+            if token is not None:
+                try:
+                    return fn(), 'leader'
+                finally:
+                    self.shared_lock.release(key, token)
+
+            # Another worker has it. Wait for its result to land, or for its
+            # lock to go away without one (it failed), then try again
+            while self.shared_lock.held(key) and time.monotonic() < deadline:
+                time.sleep(POLL_SECONDS)
+            value = lookup(key)
+            if value is not None:
+                return value, 'shared'
+            if time.monotonic() >= deadline:
+                return fn(), 'timeout'
+
+
+def default_single_flight() -> SingleFlight:
+
+    """
+    In-process coalescing always. Across workers too when
+    ALERTS_SHARED_SINGLE_FLIGHT=1 and a Redis URL is set for the result
+    cache, which is where the other workers find the result.
+    """
+
+    redis_url = os.environ.get('ALERT_CACHE_REDIS_URL')
+    if redis_url and os.environ.get('ALERTS_SHARED_SINGLE_FLIGHT') == '1':
+        return SingleFlight(shared_lock=RedisFlightLock.from_url(redis_url))
+    return SingleFlight()
+
+
+# Module level so concurrent invocations in one worker share it
+IN_FLIGHT = default_single_flight()
+
+
+if __name__ == '__main__':
+
+    # Concurrent identical requests against the in-memory stand-in for
+    # Postgres, then the cross-worker lock with a stand-in for Redis
+    import instrumentation
+    import get_matching_listings
+    import alert_cache
+    from concurrent.futures import ThreadPoolExecutor
+    from db_pool import ConnectionPool
+    from fake_db import FakeDatabase, FakeDriver
+    from synthetic_data import BENCH_OWNER_ID, generate_dataset
+
+    dataset = generate_dataset(20000, seed=0)
+    db = FakeDatabase(dataset, latency=0.2)
+    get_matching_listings.POOL = ConnectionPool(driver=FakeDriver(db))
+    instrumentation.EMIT = lambda line: None
+    alert_id = dataset.alert_id('broad')
+
+    def burst(queries: list[dict]) -> list[dict]:
+        alert_cache.RESULT_CACHE.local.clear()
+        barrier = threading.Barrier(len(queries))
+
+        def request(query: dict) -> dict:
+            event = {
+                'queryStringParameters': {'user_id': BENCH_OWNER_ID, 'email': None, **query},
+                'pathParameters': {'alert_id': str(alert_id)},
+            }
+            barrier.wait()
+            return get_matching_listings.handler(event)
+
+        with ThreadPoolExecutor(len(queries)) as pool:
+            return list(pool.map(request, queries))
+
+    # 20 recipients open the same page at once: one listing query. This
+    # file runs as __main__, so the handler's flight is another instance
+    in_flight = get_matching_listings.IN_FLIGHT
+    before, stats_before = db.num_listing_queries, dict(in_flight.stats)
+    start = time.perf_counter()
+    responses = burst([{}] * 20)
+    elapsed = time.perf_counter() - start
+    assert all(x['statusCode'] == 200 and x['body'] == responses[0]['body'] for x in responses)
+    assert db.num_listing_queries - before == 1, db.num_listing_queries - before
+    assert in_flight.stats['coalesced'] - stats_before['coalesced'] == 19
+    print(f'20 identical requests: 1 listing query, 19 coalesced, {elapsed * 1000:.0f}ms with a 200ms query')
+
+    # Different pages and field sets are different keys
+    before = db.num_listing_queries
+    responses = burst([{'page': '1'}, {'page': '2'}, {'page': '2', 'fields': 'card'}] * 4)
+    assert all(x['statusCode'] == 200 for x in responses)
+    assert db.num_listing_queries - before == 3
+    print('3 distinct pages x 4 requests: 3 listing queries')
+
+    # A failure is shared by the requests waiting on it, and not remembered
+    flight = SingleFlight()
+    calls = []
+
+    def failing():
+        calls.append(1)
+        time.sleep(0.1)
+        raise RuntimeError('listing query failed')
+
+    def attempt(_):
+        try:
+            flight.do('k', failing)
+        except RuntimeError as e:
+            return str(e)
+
+    with ThreadPoolExecutor(5) as pool:
+        assert list(pool.map(attempt, range(5))) == ['listing query failed'] * 5
+    assert len(calls) == 1 and flight.stats['error'] == 1
+    assert flight.do('k', lambda: 'ok') == ('ok', 'leader')
+    print('errors: shared by waiters, next call runs again')
+
+    # A waiter gives up on a leader that takes too long and runs fn itself
+    slow = SingleFlight(wait_timeout=0.05)
+    with ThreadPoolExecutor(2) as pool:
+        first = pool.submit(slow.do, 'k', lambda: time.sleep(0.3) or 'slow')
+        time.sleep(0.01)
+        second = pool.submit(slow.do, 'k', lambda: 'fast')
+        assert first.result() == ('slow', 'leader') and second.result() == ('fast', 'timeout')
+    print('timeouts: waiter runs fn itself')
+
+    class FakeRedis:
+
+        # Just the commands RedisFlightLock and alert_cache.RedisBackend use
+        def __init__(self):
+            self.data = {}
+            self.lock = threading.Lock()
+
+        def set(self, name, value, nx=False, px=None, ex=None):
+            with self.lock:
+                expires, _ = self.data.get(name, (None, None))
+                if nx and name in self.data and (expires is None or expires > time.monotonic()):
+                    return None
+                ttl = px / 1000 if px else ex
+                self.data[name] = (time.monotonic() + ttl if ttl else None, value)
+                return True
+
+        def get(self, name):
+            with self.lock:
+                expires, value = self.data.get(name, (None, None))
+                if expires is not None and expires <= time.monotonic():
+                    return None
+                return value
+
+        def delete(self, name):
+            with self.lock:
+                self.data.pop(name, None)
+
+    # Two workers, each with its own in-process flight, one Redis
+    redis = FakeRedis()
+    shared_cache = alert_cache.RedisBackend(redis)
+    workers = [SingleFlight(shared_lock=RedisFlightLock(redis)) for _ in range(2)]
+    computed = []
+
+    def compute():
+        computed.append(1)
+        time.sleep(0.2)
+        shared_cache.set('page', {'results': [1, 2, 3]})
+        return {'results': [1, 2, 3]}
+
+    def worker_request(i):
+        return workers[i % 2].do('page', compute, lookup=shared_cache.get)
+
+    with ThreadPoolExecutor(10) as pool:
+        results = list(pool.map(worker_request, range(10)))
+    roles = sorted(role for _, role in results)
+    assert len(computed) == 1 and all(value == {'results': [1, 2, 3]} for value, _ in results)
+    assert roles.count('leader') == 1 and roles.count('shared') == 1 and roles.count('coalesced') == 8, roles
+    print('2 workers x 5 requests: 1 computation, 1 shared through the cache, 8 coalesced')
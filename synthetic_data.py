@@ -0,0 +1,407 @@
+from __future__ import annotations
+import io
+import csv
+import json
+import random
+import datetime
+
+# Column order of the tables as the alert queries read them
+EVENT_COLUMNS = [
+    'mls_number', 'price', 'sq_ft', 'price_per_sq_ft', 'days_on_market', 'status',
+    'beds', 'baths', 'year_built', 'event_date',
+]
+META_COLUMNS = [
+    'mls_number', 'url', 'street_address', 'city', 'state', 'zip_code', 'images',
+    'property_type', 'property_style', 'description', 'features', 'date_listed',
+    'num_kitchens', 'active', 'seller_motivation',
+]
+
+# Tables for loading a dataset into a scratch Postgres
+SCHEMA_DDL = """
+CREATE TABLE IF NOT EXISTS listing_events (
+    mls_number text, price float8, sq_ft int, price_per_sq_ft float8, days_on_market int,
+    status text, beds int, baths int, year_built int, event_date timestamp
+);
+CREATE INDEX IF NOT EXISTS listing_events_mls_number_idx ON listing_events (mls_number, event_date);
+CREATE TABLE IF NOT EXISTS listing_meta (
+    mls_number text PRIMARY KEY, url text, street_address text, city text, state text,
+    zip_code text, images jsonb, property_type text, property_style text, description text,
+    features text, date_listed date, num_kitchens int, active bool, seller_motivation bool
+);
+CREATE TABLE IF NOT EXISTS report_recipients (
+    id int PRIMARY KEY, owner_id text, owner_email text, recipient_email text,
+    recipient_first_name text, recipient_last_name text, cadence text, cities jsonb,
+    zip_codes jsonb, entire_state bool, active bool, min_price float8, max_price float8,
+    min_days_on_market int, max_days_on_market int, min_beds int, max_beds int,
+    min_baths int, max_baths int, min_sq_ft int, max_sq_ft int, min_price_per_sq_ft float8,
+    max_price_per_sq_ft float8, min_year_built int, max_year_built int, price_reduction float8,
+    keywords text, enhance_keywords bool, exclude_keywords text, property_types jsonb,
+    counties jsonb, num_kitchens int, nickname text
+);
+"""
+
+# (city, zip_code) pairs the generator draws from
+CITY_ZIPS = [
+    ('Salt Lake City', '84101'), ('Salt Lake City', '84102'), ('Salt Lake City', '84103'),
+    ('Salt Lake City', '84105'), ('Salt Lake City', '84106'), ('Provo', '84601'),
+    ('Provo', '84604'), ('Orem', '84057'), ('Orem', '84058'), ('Lehi', '84043'),
+    ('Sandy', '84070'), ('Sandy', '84092'), ('Draper', '84020'), ('Ogden', '84401'),
+    ('Ogden', '84403'), ('West Jordan', '84084'), ('South Jordan', '84095'),
+    ('Layton', '84041'), ('St. George', '84770'), ('Logan', '84321'),
+]
+PROPERTY_TYPES = ['Single Family', 'Condo', 'Townhouse', 'Multi Family', 'Land']
+DESCRIPTION_PHRASES = [
+    'Beautiful home on a quiet street', 'Updated kitchen with granite counters',
+    'Motivated seller, bring all offers', 'Needs some TLC, great investor special',
+    'Fixer upper with good bones', 'Mountain views from the back deck',
+    'Basement apartment with separate entrance', 'Large fenced yard',
+    'Swimming pool and hot tub', 'Walking distance to schools and parks',
+    'Recently remodeled bathrooms', 'Two car garage with workshop',
+    'Open floor plan and vaulted ceilings', 'Priced to sell',
+]
+
+# Alert filters the benchmarks run, stored as report_recipients rows
+ALERT_PROFILES = {
+    'broad': {},
+    'city': {'cities': ['Provo', 'Orem', 'Lehi']},
+    'price_band': {'min_price': 350000, 'max_price': 650000, 'min_beds': 3},
+    'keywords': {'keywords': 'motivated, fixer upper, priced to sell', 'exclude_keywords': 'land'},
+    'price_drop': {'price_reduction': 20000, 'min_days_on_market': 30},
+    'combined': {
+        'zip_codes': ['84101', '84102', '84105'], 'min_price': 300000, 'max_price': 900000,
+        'property_types': ['Single Family', 'Townhouse'], 'min_sq_ft': 1500,
+    },
+}
+BENCH_OWNER_ID = 'bench-user'
+
+# Rental tables, in RentalListingEvent / RentalListingMeta field order
+RENTAL_EVENT_COLUMNS = [
+    'listing_id', 'property_id', 'event_date', 'price', 'sq_ft', 'price_per_sq_ft',
+    'year_built', 'beds', 'baths',
+]
+RENTAL_META_COLUMNS = [
+    'listing_id', 'property_id', 'image_urls', 'primary_image', 'property_type',
+    'street_address', 'city', 'state', 'zip_code', 'available_date', 'available_now',
+    'listing_url', 'contact_name', 'contact_email', 'contact_phone', 'contact_sms',
+    'pets_allowed', 'min_lease_length', 'max_lease_length', 'deposit_total',
+    'deposit_refundable', 'utilities', 'property_amenities', 'community_amenities',
+]
+
+RENTAL_SCHEMA_DDL = """
+CREATE TABLE IF NOT EXISTS rental_listing_events (
+    listing_id text, property_id text, event_date timestamp, price float8, sq_ft int,
+    price_per_sq_ft float8, year_built int, beds int, baths int
+);
+CREATE INDEX IF NOT EXISTS rental_listing_events_listing_id_idx ON rental_listing_events (listing_id, event_date);
+CREATE TABLE IF NOT EXISTS rental_listing_meta (
+    listing_id text PRIMARY KEY, property_id text, image_urls jsonb, primary_image text,
+    property_type text, street_address text, city text, state text, zip_code text,
+    available_date date, available_now bool, listing_url text, contact_name text,
+    contact_email text, contact_phone text, contact_sms text, pets_allowed bool,
+    min_lease_length int, max_lease_length int, deposit_total float8,
+    deposit_refundable float8, utilities jsonb, property_amenities jsonb,
+    community_amenities jsonb
+);
+"""
+
+RENTAL_PROPERTY_TYPES = ['Apartment', 'Condo', 'Townhouse', 'Single Family', 'Basement']
+RENTAL_AMENITIES = [
+    'Washer/Dryer', 'Dishwasher', 'Air Conditioning', 'Garage', 'Pool', 'Gym',
+    'Balcony', 'Fireplace', 'Storage', 'EV Charging',
+]
+RENTAL_UTILITIES = ['Water', 'Sewer', 'Trash', 'Gas', 'Electric', 'Internet']
+
+# Rental alert filters the benchmarks run, stored as rental_report_recipients rows
+RENTAL_ALERT_PROFILES = {
+    'broad': {},
+    'city': {'cities': ['Provo', 'Orem', 'Lehi']},
+    'price_band': {'min_price': 1200, 'max_price': 2200, 'min_beds': 2},
+    'pets': {'pets_allowed': True, 'max_price': 2500},
+    'amenities': {'amenities': ['Washer/Dryer', 'Air Conditioning']},
+    'combined': {
+        'zip_codes': ['84101', '84102', '84105'], 'min_price': 900, 'max_price': 3000,
+        'min_sq_ft': 700, 'pets_allowed': True, 'amenities': ['Dishwasher'],
+        'available_by': 'today+30',
+    },
+}
+
+
+class SyntheticDataset:
+
+    """
+    Rows for listing_events and listing_meta (tuples in EVENT_COLUMNS /
+    META_COLUMNS order, to keep 1M events in memory) plus one
+    report_recipients dict per alert profile.
+    """
+
+    def __init__(self, events: list[tuple], meta: list[tuple], report_recipients: list[dict], today: datetime.date):
+        self.events = events
+        self.meta = meta
+        self.report_recipients = report_recipients
+        self.today = today
+
+    def alert_id(self, profile: str) -> int:
+        return next(x['id'] for x in self.report_recipients if x['nickname'] == profile)
+
+    def __repr__(self):
+        return f'SyntheticDataset - {len(self.events)} events, {len(self.meta)} listings'
+
+
+def generate_dataset(num_events: int, seed: int = 0, today: datetime.date = None) -> SyntheticDataset:
+
+    """
+    Seeded, so the same size and seed always give the same rows. Around
+    five price events per listing, most listings active.
+    """
+
+    rng = random.Random(seed)
+    today = today or datetime.date.today()
+    midnight = datetime.datetime.combine(today, datetime.time())
+
+    events = []
+    meta = []
+    listing_num = 0
+    while len(events) < num_events:
+
+        listing_num += 1
+        mls_number = str(1000000 + listing_num)
+        city, zip_code = rng.choice(CITY_ZIPS)
+        property_type = rng.choice(PROPERTY_TYPES)
+        days_listed = int(rng.expovariate(1 / 60))
+        date_listed = today - datetime.timedelta(days=days_listed)
+        sq_ft = rng.randint(600, 5500)
+        beds = rng.randint(1, 7)
+        baths = rng.randint(1, 5)
+        year_built = rng.randint(1900, today.year)
+        num_images = rng.randint(5, 40)
+
+        meta.append((
+            mls_number,
+            f'https://listings.example.com/{mls_number}',
+            f'{rng.randint(10, 9999)} {rng.choice("NSEW")} {rng.randint(100, 9900)} {rng.choice("NSEW")}',
+            city,
+            'UT',
+            zip_code,
+            [f'https://images.example.com/{mls_number}/{n}.jpg' for n in range(num_images)],
+            property_type,
+            None,
+            '. '.join(rng.sample(DESCRIPTION_PHRASES, rng.randint(2, 6))) + '.',
+            None,
+            date_listed.strftime('%Y-%m-%d'),
+            rng.choice([1, 1, 1, 2]),
+            rng.random() < 0.9,
+            rng.random() < 0.15,
+        ))
+
+        # Price history walks mostly down from the list price
+        num_listing_events = min(1 + int(rng.expovariate(1 / 4)), num_events - len(events))
+        offsets = sorted(rng.uniform(0, days_listed + 1) for _ in range(num_listing_events))
+        price = float(rng.randrange(150000, 1800000, 5000))
+        for i, offset in enumerate(offsets):
+            if i:
+                price = max(50000.0, price + rng.choice([-1, -1, -1, 1]) * rng.randrange(5000, 60000, 1000))
+            event_date = midnight - datetime.timedelta(days=days_listed) + datetime.timedelta(days=offset)
+            event_date = min(event_date, midnight + datetime.timedelta(hours=23, minutes=59))
+            events.append((
+                mls_number,
+                price,
+                sq_ft,
+                round(price / sq_ft, 2),
+                (event_date.date() - date_listed).days,
+                'Active',
+                beds,
+                baths,
+                year_built,
+                event_date.strftime('%Y-%m-%d %H:%M:%S'),
+            ))
+
+    report_recipients = []
+    for i, (profile, filters) in enumerate(ALERT_PROFILES.items()):
+        report_recipients.append({
+            'id': i + 1,
+            'owner_id': BENCH_OWNER_ID,
+            'owner_email': 'bench@example.com',
+            'recipient_email': 'bench@example.com',
+            'cadence': 'daily',
+            'active': True,
+            'entire_state': False,
+            'nickname': profile,
+            **filters,
+        })
+
+    return SyntheticDataset(events, meta, report_recipients, today)
+
+
+def load_postgres(db, dataset: SyntheticDataset):
+
+    """
+    Replaces the tables in a scratch database with the dataset, using COPY.
+    db is a db_pool Session.
+    """
+
+    for statement in SCHEMA_DDL.split(';'):
+        if statement.strip():
+            db.query(statement)
+    db.query('TRUNCATE listing_events, listing_meta, report_recipients')
+
+    cur = db.conn.raw.cursor()
+    for table, columns, rows in [
+        ('listing_events', EVENT_COLUMNS, dataset.events),
+        ('listing_meta', META_COLUMNS, dataset.meta),
+    ]:
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for row in rows:
+            writer.writerow(
+                json.dumps(x) if isinstance(x, list) else ('' if x is None else x)
+                for x in row
+            )
+        buffer.seek(0)
+        cur.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)", buffer)
+
+    for row in dataset.report_recipients:
+        row = {k: json.dumps(v) if isinstance(v, list) else v for k, v in row.items()}
+        columns = ', '.join(row)
+        values = ', '.join(f'%({k})s' for k in row)
+        cur.execute(f"INSERT INTO report_recipients ({columns}) VALUES ({values})", row)
+
+    cur.execute('ANALYZE listing_events')
+    cur.execute('ANALYZE listing_meta')
+    cur.close()
+
+
+def generate_rental_dataset(num_events: int, seed: int = 0, today: datetime.date = None) -> SyntheticDataset:
+
+    """
+    Rental listings, seeded like generate_dataset. Rents move a few times
+    per listing, more often down than up. report_recipients holds one
+    rental_report_recipients dict per RENTAL_ALERT_PROFILES entry.
+    """
+
+    rng = random.Random(seed)
+    today = today or datetime.date.today()
+    midnight = datetime.datetime.combine(today, datetime.time())
+
+    events = []
+    meta = []
+    listing_num = 0
+    while len(events) < num_events:
+
+        listing_num += 1
+        listing_id = f'R{2000000 + listing_num}'
+        property_id = f'P{3000000 + listing_num // 3}'
+        city, zip_code = rng.choice(CITY_ZIPS)
+        days_listed = int(rng.expovariate(1 / 30))
+        available_date = today + datetime.timedelta(days=rng.randint(-10, 60))
+        sq_ft = rng.randint(350, 3500)
+        beds = rng.randint(0, 5)
+        baths = rng.randint(1, 4)
+        year_built = rng.randint(1920, today.year)
+        num_images = rng.randint(3, 25)
+        images = [f'https://images.example.com/{listing_id}/{n}.jpg' for n in range(num_images)]
+        deposit = float(rng.randrange(300, 3000, 50))
+
+        meta.append((
+            listing_id,
+            property_id,
+            images,
+            images[0],
+            rng.choice(RENTAL_PROPERTY_TYPES),
+            f'{rng.randint(10, 9999)} {rng.choice("NSEW")} {rng.randint(100, 9900)} {rng.choice("NSEW")}',
+            city,
+            'UT',
+            zip_code,
+            available_date.strftime('%Y-%m-%d'),
+            available_date <= today,
+            f'https://rentals.example.com/{listing_id}',
+            'Leasing Office',
+            f'leasing+{listing_id}@example.com',
+            f'801-555-{rng.randint(0, 9999):04d}',
+            None,
+            rng.random() < 0.4,
+            rng.choice([6, 12, 12, 12]),
+            rng.choice([12, 12, 24]),
+            deposit,
+            round(deposit * rng.choice([0.5, 1.0, 1.0]), 2),
+            rng.sample(RENTAL_UTILITIES, rng.randint(0, 4)),
+            rng.sample(RENTAL_AMENITIES, rng.randint(0, 5)),
+            rng.sample(RENTAL_AMENITIES, rng.randint(0, 2)),
+        ))
+
+        num_listing_events = min(1 + int(rng.expovariate(1 / 3)), num_events - len(events))
+        offsets = sorted(rng.uniform(0, days_listed + 1) for _ in range(num_listing_events))
+        price = float(rng.randrange(600, 4500, 25))
+        for i, offset in enumerate(offsets):
+            if i:
+                price = max(400.0, price + rng.choice([-1, -1, 1]) * rng.randrange(25, 300, 25))
+            event_date = midnight - datetime.timedelta(days=days_listed) + datetime.timedelta(days=offset)
+            event_date = min(event_date, midnight + datetime.timedelta(hours=23, minutes=59))
+            events.append((
+                listing_id,
+                property_id,
+                event_date.strftime('%Y-%m-%d %H:%M:%S'),
+                price,
+                sq_ft,
+                round(price / sq_ft, 2),
+                year_built,
+                beds,
+                baths,
+            ))
+
+    report_recipients = []
+    for i, (profile, filters) in enumerate(RENTAL_ALERT_PROFILES.items()):
+        filters = dict(filters)
+        if filters.get('available_by') == 'today+30':
+            filters['available_by'] = (today + datetime.timedelta(days=30)).strftime('%Y-%m-%d')
+        report_recipients.append({
+            'id': i + 1,
+            'owner_id': BENCH_OWNER_ID,
+            'owner_email': 'bench@example.com',
+            'recipient_email': 'bench@example.com',
+            'cadence': 'daily',
+            'active': True,
+            'nickname': profile,
+            **filters,
+        })
+
+    return SyntheticDataset(events, meta, report_recipients, today)
+
+
+def load_rental_postgres(db, dataset: SyntheticDataset):
+
+    """
+    load_postgres for a generate_rental_dataset dataset.
+    """
+
+    # The alerts table ships with the endpoint, the rest stands in for
+    # the rental scraper's tables
+    from rental_alerts import RENTAL_ALERTS_DDL
+    for statement in (RENTAL_SCHEMA_DDL + RENTAL_ALERTS_DDL).split(';'):
+        if statement.strip():
+            db.query(statement)
+    db.query('TRUNCATE rental_listing_events, rental_listing_meta, rental_report_recipients')
+
+    cur = db.conn.raw.cursor()
+    for table, columns, rows in [
+        ('rental_listing_events', RENTAL_EVENT_COLUMNS, dataset.events),
+        ('rental_listing_meta', RENTAL_META_COLUMNS, dataset.meta),
+    ]:
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for row in rows:
+            writer.writerow(
+                json.dumps(x) if isinstance(x, list) else ('' if x is None else x)
+                for x in row
+            )
+        buffer.seek(0)
+        cur.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)", buffer)
+
+    for row in dataset.report_recipients:
+        row = {k: json.dumps(v) if isinstance(v, list) else v for k, v in row.items()}
+        columns = ', '.join(row)
+        values = ', '.join(f'%({k})s' for k in row)
+        cur.execute(f"INSERT INTO rental_report_recipients ({columns}) VALUES ({values})", row)
+
+    cur.execute('ANALYZE rental_listing_events')
+    cur.execute('ANALYZE rental_listing_meta')
+    cur.close()
@@ -3,13 +3,19 @@ import json
 import math
 import datetime
 import pydantic
-import pandas as pd
-from dateutil import tz
-from typing import Union, Literal
+from typing import Union
 from enum import Enum, unique
 
+# The alerts models live in alert_models so the alerts Lambda can import
+# them without everything below. Re-exported here under the old names
+from alert_models import GoodApiResponse, SellerMotivationScore, AlertFilters
+
 
 def get_now_mountain_time(offset_days=0):
+
+    # dateutil is only needed here, so it isn't imported at cold start
+    from dateutil import tz
+
     from_zone = tz.tzutc()
     to_zone = tz.gettz('America/Denver')
 
@@ -104,29 +110,6 @@ class ApiResponse:
         return self.__dict__
 
 
-class GoodApiResponse:
-
-    def __init__(self, status_code: int, body: Union[dict, list]):
-        self.status_code = status_code
-        self.body = body
-
-    def get_response(self) -> dict:
-        return {
-            'statusCode': self.status_code,
-            'headers': {
-                'Access-Control-Allow-Headers': 'Content-Type',
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'OPTIONS,POST,GET',
-                "content-type": "application/json",
-            },
-            'body': json.dumps(self.body, cls=ResponseEncoder)
-        }
-
-    def __repr__(self):
-        return f'UmcApiResponse'
-
-
-
 class RealtorLead:
 
     def __init__(
@@ -287,30 +270,24 @@ class RentalListingMeta(pydantic.BaseModel):
         return self.__dict__
 
 
-SellerMotivationScore = Literal["High", "Moderate", "Undetected"]
-class AlertFilters(pydantic.BaseModel):
-    min_price: float = None
-    max_price: float = None
-    min_sq_ft: int = None
-    max_sq_ft: int = None
-    min_beds: int = None
-    max_beds: int = None
-    min_baths: int = None
-    max_baths: int = None
-    min_year_built: int = None
-    max_year_built: int = None
-    min_days_on_market: int = None
-    max_days_on_market: int = None
-    min_price_per_sq_ft: float = None
-    max_price_per_sq_ft: float = None
-    price_reduction: float = None
-    num_kitchens: int = None
-    cities: list = None
-    zip_codes: list = None
-    counties: list = None
-    entire_state: bool = None
-    property_types: list = None
-    seller_motivation_score: SellerMotivationScore = None
-    keywords: str = None
-    enhance_keywords: bool = None
-    exclude_keywords: list = None
\ No newline at end of file
+class DailyStats(pydantic.BaseModel):
+    stat_date: str # %Y-%m-%d
+    geo_level: str # city, zip or state
+    geo_value: str
+    property_type: str # '*' for all types
+    active_listings: int
+    new_listings: int
+    price_drops: int
+    price_p25: float = None
+    price_median: float = None
+    price_p75: float = None
+    price_per_sq_ft_p25: float = None
+    price_per_sq_ft_median: float = None
+    price_per_sq_ft_p75: float = None
+    days_on_market_median: float = None
+
+    def __repr__(self):
+        return f'<DailyStats> - {self.stat_date} {self.geo_level} {self.geo_value} {self.property_type}'
+
+    def to_dict(self):
+        return self.__dict__